@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+"""Throughput and latency benchmark for grader.py against a mock ARK server.
+
+Starts ``mock_ark.py`` in-process, then for every scenario and concurrency
+level spawns ``grader.py serve --concurrency N``, feeds it jobs over stdin
+and records per-job latency. Scenarios:
+
+- ``cache-hit``: every job grades the same question, so after one prefix
+  warmup all model calls go through ``previous_response_id``;
+- ``cache-miss``: every job has its own question and warms its own prefix;
+- ``image-heavy``: cache-hit jobs with several large photos each (needs
+  Pillow to generate the photos; skipped otherwise);
+- ``faults``: cache-hit jobs with 429, 5xx and cache errors injected;
+- ``cache-denied``: the provider answers prefix warmups with 403
+  ``AccessDenied.CacheService``, so every job falls back to full requests.
+
+For each run the report has jobs/s, p50/p95/p99 latency, bytes received by
+the mock and the peak RSS of the grader process. Reports are written to
+``tools/test-reports/grader-bench-<RUN_ID>.{json,md}``. With ``--baseline``
+the run is compared against an earlier JSON report and the exit code is 1
+when throughput or p95 regress by more than ``--max-regression``.
+
+    python3 server/ai_worker/bench/bench_grader.py --jobs 200 --concurrency 1,4,16
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from mock_ark import start_server
+
+try:
+    from PIL import Image  # type: ignore
+except Exception:  # pragma: no cover - optional dependency
+    Image = None
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+GRADER_PATH = os.path.join(os.path.dirname(BENCH_DIR), "grader.py")
+ROOT_DIR = os.path.abspath(os.path.join(BENCH_DIR, "..", "..", ".."))
+REPORT_DIR = os.path.join(ROOT_DIR, "tools", "test-reports")
+RUN_ID = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
+SCENARIOS = ["cache-hit", "cache-miss", "image-heavy", "faults", "cache-denied"]
+FAULT_FREE_CONFIG = {
+    "rate429": 0.0,
+    "rate5xx": 0.0,
+    "rateCacheError": 0.0,
+    "cacheServiceDenied": False,
+}
+SCENARIO_CONFIG = {
+    "faults": {"rate429": 0.05, "rate5xx": 0.03, "rateCacheError": 0.05},
+    "cache-denied": {"cacheServiceDenied": True},
+}
+JOB_TIMEOUT_SECONDS = 300
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, -(-len(ordered) * p // 100) - 1))
+    return round(ordered[int(index)], 2)
+
+
+def build_job(index: int, question_key: int, images: List[str]) -> Dict:
+    payload = {
+        "submissionVersionId": f"bench-{index}",
+        "studentAnswerText": f"解：设 x 为未知数，2x + {index % 7} = {index % 7 + 2}，所以 x = 1。",
+        "question": {
+            "questionIndex": 1,
+            "questionType": "CALCULATION",
+            "prompt": f"第 {question_key} 题：解方程 2x + a = a + 2，并写出步骤。",
+            "standardAnswer": "x = 1",
+            "rubric": [
+                {"rubricItemKey": "R1", "maxScore": 6, "criteria": "列式正确"},
+                {"rubricItemKey": "R2", "maxScore": 4, "criteria": "结果正确"},
+            ],
+        },
+        "options": {"minConfidence": 0.7},
+    }
+    return {"id": str(index), "payload": payload, "images": images, "stream": False}
+
+
+def build_jobs(scenario: str, count: int, images: List[str]) -> List[Dict]:
+    jobs = []
+    for index in range(count):
+        question_key = index if scenario == "cache-miss" else 0
+        job_images = []
+        if scenario == "image-heavy":
+            job_images = [images[(index + offset) % len(images)] for offset in range(3)]
+        jobs.append(build_job(index, question_key, job_images))
+    return jobs
+
+
+def make_images(out_dir: str, count: int) -> List[str]:
+    # Noisy full-resolution "phone photos": the worst case for encode time.
+    if Image is None:
+        return []
+    paths = []
+    for index in range(count):
+        path = os.path.join(out_dir, f"photo-{index}.jpg")
+        image = Image.effect_noise((3000, 4000), 40 + index).convert("RGB")
+        image.save(path, format="JPEG", quality=92)
+        paths.append(path)
+    return paths
+
+
+def mock_request(base_url: str, path: str, body: Optional[Dict] = None) -> Dict:
+    data = None if body is None else json.dumps(body).encode("utf-8")
+    req = urllib.request.Request(
+        f"{base_url}{path}", data=data, method="GET" if data is None else "POST"
+    )
+    with urllib.request.urlopen(req, timeout=10) as resp:
+        return json.loads(resp.read())
+
+
+def read_peak_rss_kb(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def run_grader(
+    jobs: List[Dict], concurrency: int, env: Dict[str, str]
+) -> Dict:
+    proc = subprocess.Popen(
+        [sys.executable, GRADER_PATH, "serve", "--concurrency", str(concurrency)],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        env=env,
+        text=True,
+        encoding="utf-8",
+    )
+    ready = json.loads(proc.stdout.readline() or "{}")
+    if ready.get("event") != "ready":
+        proc.kill()
+        raise RuntimeError("grader.py serve did not start")
+
+    started_at: Dict[str, float] = {}
+    latencies: List[float] = []
+    succeeded = []
+    failures: Dict[str, int] = {}
+    done = threading.Event()
+    pending = {job["id"] for job in jobs}
+
+    def read_replies() -> None:
+        for line in proc.stdout:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            if "ok" not in message or message.get("id") not in pending:
+                continue
+            request_id = message["id"]
+            pending.discard(request_id)
+            latencies.append((time.perf_counter() - started_at[request_id]) * 1000)
+            if message["ok"]:
+                succeeded.append(request_id)
+            else:
+                key = str(message.get("status") or "error")
+                failures[key] = failures.get(key, 0) + 1
+            if not pending:
+                done.set()
+                return
+
+    reader = threading.Thread(target=read_replies, daemon=True)
+    reader.start()
+    begin = time.perf_counter()
+    # The grader queues jobs internally, so everything is submitted up front
+    # and latency includes queueing, the way the worker pool sees it.
+    for job in jobs:
+        started_at[job["id"]] = time.perf_counter()
+        proc.stdin.write(json.dumps(job, ensure_ascii=False) + "\n")
+        proc.stdin.flush()
+    finished = done.wait(JOB_TIMEOUT_SECONDS)
+    duration = time.perf_counter() - begin
+    peak_rss_kb = read_peak_rss_kb(proc.pid)
+    proc.stdin.close()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+    if not finished:
+        failures["timeout"] = len(pending)
+
+    return {
+        "jobs": len(jobs),
+        "ok": len(succeeded),
+        "failures": failures,
+        "durationSec": round(duration, 3),
+        "jobsPerSec": round(len(latencies) / duration, 2) if duration else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "peakRssKb": peak_rss_kb,
+    }
+
+
+def run_scenario(
+    scenario: str,
+    concurrency: int,
+    jobs: List[Dict],
+    mock_url: str,
+    base_env: Dict[str, str],
+    work_dir: str,
+) -> Dict:
+    mock_request(mock_url, "/__reset", {})
+    mock_request(
+        mock_url, "/__config", dict(FAULT_FREE_CONFIG, **SCENARIO_CONFIG.get(scenario, {}))
+    )
+    # Fresh image cache per run so image-heavy measures encoding, not reads.
+    image_cache = os.path.join(work_dir, f"image-cache-{scenario}-{concurrency}")
+    env = dict(base_env, AI_GRADING_IMAGE_CACHE_DIR=image_cache)
+    result = run_grader(jobs, concurrency, env)
+    stats = mock_request(mock_url, "/__stats")
+    shutil.rmtree(image_cache, ignore_errors=True)
+    result.update(
+        {
+            "scenario": scenario,
+            "concurrency": concurrency,
+            "bytesSent": int(stats.get("bytes_received", 0)),
+            "modelRequests": int(stats.get("requests", 0)),
+            "prefixCreates": int(stats.get("prefix_creates", 0)),
+            "prefixHits": int(stats.get("prefix_hits", 0)),
+            "injectedErrors": {
+                key: int(value) for key, value in stats.items() if key.startswith("status_")
+            },
+        }
+    )
+    return result
+
+
+def compare(results: List[Dict], baseline_path: str, max_regression: float) -> List[str]:
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {
+            (item["scenario"], item["concurrency"]): item
+            for item in json.load(f).get("results", [])
+        }
+    regressions = []
+    for item in results:
+        previous = baseline.get((item["scenario"], item["concurrency"]))
+        if not previous:
+            continue
+        name = f"{item['scenario']}@c{item['concurrency']}"
+        if previous["jobsPerSec"] and item["jobsPerSec"] < previous["jobsPerSec"] * (
+            1 - max_regression
+        ):
+            regressions.append(
+                f"{name}: jobs/s {previous['jobsPerSec']} -> {item['jobsPerSec']}"
+            )
+        if previous["p95"] and item["p95"] > previous["p95"] * (1 + max_regression):
+            regressions.append(f"{name}: p95 {previous['p95']}ms -> {item['p95']}ms")
+    return regressions
+
+
+def write_report(summary: Dict) -> None:
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    json_path = os.path.join(REPORT_DIR, f"grader-bench-{RUN_ID}.json")
+    md_path = os.path.join(REPORT_DIR, f"grader-bench-{RUN_ID}.md")
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+
+    lines = [
+        "# Grader Benchmark Report",
+        "",
+        f"- generatedAt: {summary['generatedAt']}",
+        f"- runId: {RUN_ID}",
+        f"- mock: {json.dumps(summary['mock'], ensure_ascii=False)}",
+        "",
+        "| scenario | concurrency | jobs | ok | jobs/s | p50(ms) | p95(ms) | p99(ms) | bytes sent | peak RSS(MB) | failures |",
+        "|---|---:|---:|---:|---:|---:|---:|---:|---:|---:|---|",
+    ]
+    for item in summary["results"]:
+        rss = item["peakRssKb"]
+        lines.append(
+            f"| {item['scenario']} | {item['concurrency']} | {item['jobs']} | {item['ok']} "
+            f"| {item['jobsPerSec']} | {item['p50']} | {item['p95']} | {item['p99']} "
+            f"| {item['bytesSent']} | {round(rss / 1024, 1) if rss else '-'} "
+            f"| {json.dumps(item['failures']) if item['failures'] else '-'} |"
+        )
+    if summary.get("regressions") is not None:
+        lines += ["", "## Regressions", ""]
+        lines += [f"- {item}" for item in summary["regressions"]] or ["- none"]
+    with open(md_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    print(f"json: {json_path}")
+    print(f"md: {md_path}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark grader.py against a mock ARK server.")
+    parser.add_argument("--jobs", type=int, default=100, help="Jobs per run.")
+    parser.add_argument(
+        "--concurrency", default="1,4,16", help="Comma-separated serve concurrency levels."
+    )
+    parser.add_argument(
+        "--scenarios", default=",".join(SCENARIOS), help="Comma-separated scenarios."
+    )
+    parser.add_argument(
+        "--latency-ms", type=float, default=400.0, help="Mean mock model latency."
+    )
+    parser.add_argument(
+        "--latency",
+        choices=["fixed", "uniform", "lognormal"],
+        default="lognormal",
+        help="Mock latency distribution.",
+    )
+    parser.add_argument("--baseline", help="Earlier grader-bench JSON report to compare against.")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.15,
+        help="Allowed relative drop in jobs/s or rise in p95 before failing.",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    levels = [int(item) for item in args.concurrency.split(",") if item.strip()]
+    scenarios = [item.strip() for item in args.scenarios.split(",") if item.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        print(f"Unknown scenarios: {', '.join(sorted(unknown))}", file=sys.stderr)
+        return 2
+
+    mock_config = {"latency": args.latency, "latencyMs": args.latency_ms}
+    server = start_server("127.0.0.1", 0, mock_config)
+    mock_url = f"http://127.0.0.1:{server.server_port}"
+    work_dir = tempfile.mkdtemp(prefix="grader-bench-")
+    base_env = dict(
+        os.environ,
+        ARK_API_KEY="bench",
+        ARK_BASE_URL=mock_url,
+        AI_GRADING_PREFIX_CACHE_REDIS_URL="",
+        AI_GRADING_RESULT_CACHE="off",
+        AI_GRADING_METRICS_LOG="false",
+        AI_GRADING_METRICS_TEXTFILE="",
+        AI_GRADING_METRICS_PUSHGATEWAY_URL="",
+        AI_GRADING_RATE_LIMIT_RPM="0",
+        AI_GRADING_RATE_LIMIT_TPM="0",
+        AI_GRADING_RETRY_BASE_DELAY_SECONDS="0.05",
+        AI_GRADING_RETRY_MAX_ATTEMPTS="6",
+    )
+    base_env.pop("REDIS_URL", None)
+
+    results = []
+    try:
+        images = make_images(work_dir, 4) if "image-heavy" in scenarios else []
+        for scenario in scenarios:
+            if scenario == "image-heavy" and not images:
+                print("[BENCH] image-heavy skipped: Pillow is not installed")
+                continue
+            jobs = build_jobs(scenario, args.jobs, images)
+            for concurrency in levels:
+                print(f"[BENCH] {scenario} c={concurrency} start", flush=True)
+                result = run_scenario(
+                    scenario, concurrency, jobs, mock_url, base_env, work_dir
+                )
+                results.append(result)
+                print(
+                    f"[BENCH] {scenario} c={concurrency} done => "
+                    f"jobs/s={result['jobsPerSec']} p50={result['p50']}ms "
+                    f"p95={result['p95']}ms p99={result['p99']}ms "
+                    f"bytes={result['bytesSent']} rssKb={result['peakRssKb']} "
+                    f"failures={result['failures']}",
+                    flush=True,
+                )
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    regressions = None
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.max_regression)
+    summary = {
+        "generatedAt": datetime.now(timezone.utc).isoformat(),
+        "runId": RUN_ID,
+        "jobsPerRun": args.jobs,
+        "mock": mock_config,
+        "results": results,
+        "regressions": regressions,
+    }
+    write_report(summary)
+    if regressions:
+        print("Regressions:\n" + "\n".join(f"- {item}" for item in regressions))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
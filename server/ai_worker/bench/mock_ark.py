@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""Local mock of the ARK Responses API for grader benchmarks.
+
+Serves ``POST /responses`` the way grader.py uses it:
+
+- requests with ``caching.prefix`` store the input and return a response id;
+  requests with ``previous_response_id`` must reference a stored prefix,
+  otherwise they fail with the "previous_response_id not found" error that
+  grader.py falls back from (``should_fallback_cache_error``);
+- ``stream: true`` answers with SSE ``response.output_text.delta`` events;
+- latency is drawn from a configurable distribution, with extra time per
+  megabyte of request body and per output chunk;
+- 429 (with Retry-After), 5xx, cache errors and 403 ``AccessDenied.CacheService``
+  can be injected at configurable rates.
+
+The behaviour is set on start-up from command line flags and can be changed
+at runtime with ``POST /__config`` (same keys as ``DEFAULT_CONFIG``).
+``GET /__stats`` returns request/byte counters and ``POST /__reset`` clears
+them along with the stored prefixes.
+"""
+import argparse
+import gzip
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+
+
+DEFAULT_CONFIG = {
+    # fixed | uniform | lognormal
+    "latency": "lognormal",
+    "latencyMs": 400.0,
+    # uniform: +/- spread; lognormal: sigma
+    "latencySpread": 0.35,
+    "prefixLatencyMs": 150.0,
+    "msPerMb": 40.0,
+    "streamChunks": 20,
+    "rate429": 0.0,
+    "retryAfterSeconds": 0.2,
+    "rate5xx": 0.0,
+    "rateCacheError": 0.0,
+    "cacheServiceDenied": False,
+}
+
+RESULT_TEXT = json.dumps(
+    {
+        "result": {
+            "comment": "步骤完整，结论正确。",
+            "confidence": 0.92,
+            "isUncertain": False,
+            "uncertaintyReasons": [],
+            "items": [
+                {
+                    "questionIndex": 1,
+                    "rubricItemKey": "R1",
+                    "score": 8,
+                    "maxScore": 10,
+                    "reason": "主要步骤正确，最后一步计算有误。",
+                    "uncertaintyScore": 0.1,
+                }
+            ],
+            "totalScore": 8,
+        }
+    },
+    ensure_ascii=False,
+)
+
+
+class MockState:
+    def __init__(self, config: Dict):
+        self.config = dict(DEFAULT_CONFIG, **config)
+        self.prefixes: Dict[str, bool] = {}
+        self.stats: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def count(self, name: str, value: float = 1) -> None:
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + value
+
+    def reset(self) -> None:
+        with self.lock:
+            self.prefixes.clear()
+            self.stats.clear()
+
+    def latency_seconds(self, base_ms: float, body_bytes: int) -> float:
+        config = self.config
+        spread = float(config["latencySpread"])
+        if config["latency"] == "fixed":
+            value = base_ms
+        elif config["latency"] == "uniform":
+            value = random.uniform(base_ms * (1 - spread), base_ms * (1 + spread))
+        else:
+            value = random.lognormvariate(0, spread) * base_ms
+        value += float(config["msPerMb"]) * body_bytes / (1024 * 1024)
+        return max(0.0, value) / 1000.0
+
+
+def make_handler(state: MockState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            return
+
+        def send_json(self, status: int, payload: Dict, headers: Dict = None) -> None:
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_error_body(self, status: int, code: str, message: str, headers=None):
+            state.count(f"status_{status}")
+            self.send_json(
+                status, {"error": {"code": code, "message": message}}, headers
+            )
+
+        def do_GET(self):
+            if self.path == "/__stats":
+                with state.lock:
+                    stats = dict(state.stats, prefixes=len(state.prefixes))
+                self.send_json(200, stats)
+                return
+            self.send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length)
+            if self.path == "/__config":
+                state.config.update(json.loads(raw or b"{}"))
+                self.send_json(200, state.config)
+                return
+            if self.path == "/__reset":
+                state.reset()
+                self.send_json(200, {"ok": True})
+                return
+            if not self.path.endswith("/responses"):
+                self.send_json(404, {"error": "not found"})
+                return
+
+            state.count("requests")
+            state.count("bytes_received", length)
+            if self.headers.get("Content-Encoding") == "gzip":
+                raw = gzip.decompress(raw)
+            payload = json.loads(raw)
+            config = state.config
+            roll = random.random()
+            if roll < config["rate429"]:
+                self.send_error_body(
+                    429,
+                    "RateLimitExceeded",
+                    "Too many requests",
+                    {"Retry-After": str(config["retryAfterSeconds"])},
+                )
+                return
+            if roll < config["rate429"] + config["rate5xx"]:
+                self.send_error_body(503, "ServiceUnavailable", "Upstream overloaded")
+                return
+
+            caching = payload.get("caching") or {}
+            previous = payload.get("previous_response_id")
+            if caching and config["cacheServiceDenied"]:
+                self.send_error_body(
+                    403,
+                    "AccessDenied.CacheService",
+                    "AccessDenied.CacheService: cache service is not enabled",
+                )
+                return
+            if previous:
+                with state.lock:
+                    known = previous in state.prefixes
+                if not known or random.random() < config["rateCacheError"]:
+                    self.send_error_body(
+                        400,
+                        "InvalidParameter",
+                        f"The previous_response_id {previous} was not found",
+                    )
+                    return
+                state.count("prefix_hits")
+
+            response_id = f"resp_{uuid.uuid4().hex[:16]}"
+            if caching.get("prefix"):
+                state.count("prefix_creates")
+                time.sleep(state.latency_seconds(config["prefixLatencyMs"], length))
+                with state.lock:
+                    state.prefixes[response_id] = True
+                self.send_json(
+                    200,
+                    {
+                        "id": response_id,
+                        "output": [],
+                        "usage": {"input_tokens": length // 4, "output_tokens": 0},
+                    },
+                )
+                return
+
+            delay = state.latency_seconds(config["latencyMs"], length)
+            usage = {
+                "input_tokens": length // 4,
+                "output_tokens": len(RESULT_TEXT) // 2,
+                "input_tokens_details": {"cached_tokens": 1200 if previous else 0},
+            }
+            if payload.get("stream"):
+                self.stream_result(response_id, usage, delay)
+                return
+            time.sleep(delay)
+            self.send_json(
+                200,
+                {
+                    "id": response_id,
+                    "output": [
+                        {
+                            "type": "message",
+                            "content": [{"type": "output_text", "text": RESULT_TEXT}],
+                        }
+                    ],
+                    "usage": usage,
+                },
+            )
+
+        def stream_result(self, response_id: str, usage: Dict, delay: float) -> None:
+            chunks = max(1, int(state.config["streamChunks"]))
+            step = max(1, len(RESULT_TEXT) // chunks)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            def write(text: str) -> None:
+                body = text.encode("utf-8")
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(body), body))
+                self.wfile.flush()
+
+            # Half of the latency before the first token, the rest spread out.
+            time.sleep(delay / 2)
+            pieces = [RESULT_TEXT[i : i + step] for i in range(0, len(RESULT_TEXT), step)]
+            for piece in pieces:
+                event = {"type": "response.output_text.delta", "delta": piece}
+                write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n")
+                time.sleep(delay / 2 / len(pieces))
+            completed = {
+                "type": "response.completed",
+                "response": {"id": response_id, "usage": usage},
+            }
+            write(f"data: {json.dumps(completed)}\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+
+    return Handler
+
+
+def start_server(host: str, port: int, config: Dict) -> ThreadingHTTPServer:
+    state = MockState(config)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Mock ARK Responses API server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--config", default="{}", help="JSON overrides of DEFAULT_CONFIG.")
+    args = parser.parse_args()
+    server = start_server(args.host, args.port, json.loads(args.config))
+    print(f"Mock ARK listening on http://{args.host}:{server.server_port}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
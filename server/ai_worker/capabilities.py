@@ -0,0 +1,282 @@
+"""Provider capabilities and circuit breakers shared by grader processes.
+
+Most grader runs are short-lived processes, so anything learned in module
+globals (the account has no prefix cache service, Redis is down, the endpoint
+keeps failing) used to be forgotten after every job. This module keeps that
+state per name in Redis (``ai-grading:capability:<name>``), or in a JSON file
+under the temp directory without Redis, so the next job starts from it.
+
+Every name is a small circuit breaker:
+
+- closed: calls go through; ``record_failure`` counts consecutive failures
+  within ``AI_GRADING_BREAKER_WINDOW_SECONDS``;
+- open: after ``AI_GRADING_BREAKER_FAILURES`` of them, ``allow`` says no for
+  ``AI_GRADING_BREAKER_OPEN_SECONDS``;
+- half-open: once that time is up, exactly one caller is let through as a
+  probe (another one after ``AI_GRADING_BREAKER_PROBE_SECONDS`` if it never
+  reports back); its success closes the breaker, its failure reopens it.
+
+Provider features (``prefix_cache``, ``stream``, ``gzip``) use the same
+machinery per endpoint and API key: one rejection marks the feature
+unsupported for ``AI_GRADING_CAPABILITY_TTL_SECONDS``, after which a single
+job probes it again. Redis health itself (``redis:`` names) always lives in
+the file, since it cannot be stored in the Redis it describes.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+try:
+    import fcntl
+except Exception:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+try:
+    import redis  # type: ignore
+except Exception:  # pragma: no cover - optional dependency
+    redis = None
+
+
+CAPABILITY_TTL_SECONDS = int(os.getenv("AI_GRADING_CAPABILITY_TTL_SECONDS", "21600"))
+FAILURE_THRESHOLD = int(os.getenv("AI_GRADING_BREAKER_FAILURES", "5"))
+WINDOW_SECONDS = float(os.getenv("AI_GRADING_BREAKER_WINDOW_SECONDS", "60"))
+OPEN_SECONDS = float(os.getenv("AI_GRADING_BREAKER_OPEN_SECONDS", "30"))
+PROBE_SECONDS = float(os.getenv("AI_GRADING_BREAKER_PROBE_SECONDS", "60"))
+REDIS_URL = (
+    os.getenv("AI_GRADING_CAPABILITY_REDIS_URL")
+    or os.getenv("AI_GRADING_PREFIX_CACHE_REDIS_URL")
+    or os.getenv("REDIS_URL", "")
+)
+REDIS_CONNECT_TIMEOUT_SECONDS = float(
+    os.getenv("AI_GRADING_REDIS_CONNECT_TIMEOUT_SECONDS", "2")
+)
+STATE_PATH = os.getenv("AI_GRADING_CAPABILITY_STATE_FILE") or os.path.join(
+    tempfile.gettempdir(), "ai-grading-capabilities.json"
+)
+REDIS_KEY_PREFIX = "ai-grading:capability:"
+# Re-read a breaker at most this often per process while it is closed.
+MEMO_SECONDS = 2.0
+TRANSACTION_ATTEMPTS = 5
+
+_redis_clients: Dict[str, object] = {}
+_redis_lock = threading.Lock()
+_memo: Dict[str, tuple] = {}
+_memo_lock = threading.Lock()
+
+
+def scope_for(base_url: str, api_key: str) -> str:
+    # Features differ per endpoint and account; never store the key itself.
+    digest = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+    return f"{base_url.rstrip('/')}|{digest}"
+
+
+def redis_breaker_name(url: str) -> str:
+    return "redis:" + hashlib.sha256(url.encode("utf-8")).hexdigest()[:12]
+
+
+def connect_redis(url: str):
+    # A pinged client, or None when Redis is missing, unreachable or its
+    # breaker is open; failures are left to the breaker, never remembered.
+    if redis is None or not url:
+        return None
+    name = redis_breaker_name(url)
+    if not allow(name):
+        return None
+    try:
+        client = redis.Redis.from_url(
+            url,
+            decode_responses=True,
+            socket_connect_timeout=REDIS_CONNECT_TIMEOUT_SECONDS,
+        )
+        client.ping()
+    except Exception:
+        record_failure(name)
+        return None
+    record_success(name)
+    return client
+
+
+def redis_client(url: str):
+    # One client per URL for every module of the process. Only connected
+    # clients are kept; redis-py reconnects them on its own afterwards.
+    client = _redis_clients.get(url)
+    if client is not None:
+        return client
+    with _redis_lock:
+        client = _redis_clients.get(url)
+        if client is None:
+            client = connect_redis(url)
+            if client is not None:
+                _redis_clients[url] = client
+    return client
+
+
+def get_redis_client():
+    return redis_client(REDIS_URL)
+
+
+def expires_at(state: Dict) -> float:
+    # An open breaker stays half-open for another open period; after that
+    # it is forgotten (closed) even if no probe came along.
+    return max(
+        state.get("openUntil", 0) + state.get("openSeconds", 0),
+        state.get("probeUntil", 0),
+        state.get("since", 0) + WINDOW_SECONDS,
+    )
+
+
+def update_state_file(name: str, change: Callable[[Optional[Dict]], Optional[Dict]]):
+    # Apply change() to one breaker in the shared file under an exclusive
+    # lock; expired breakers are dropped on the way.
+    os.makedirs(os.path.dirname(os.path.abspath(STATE_PATH)), exist_ok=True)
+    with open(STATE_PATH, "a+", encoding="utf-8") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        raw = f.read()
+        try:
+            states = json.loads(raw) if raw.strip() else {}
+        except ValueError:
+            states = {}
+        if not isinstance(states, dict):
+            states = {}
+        now = time.time()
+        before = states.get(name)
+        if not isinstance(before, dict) or expires_at(before) <= now:
+            before = None
+        after = change(before)
+        if after == before:
+            return after
+        states = {
+            key: value
+            for key, value in states.items()
+            if key != name and isinstance(value, dict) and expires_at(value) > now
+        }
+        if after:
+            states[name] = after
+        f.seek(0)
+        f.truncate()
+        json.dump(states, f)
+    return after
+
+
+def update_redis(client, name: str, change: Callable[[Optional[Dict]], Optional[Dict]]):
+    key = f"{REDIS_KEY_PREFIX}{name}"
+    for _ in range(TRANSACTION_ATTEMPTS):
+        with client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                raw = pipe.get(key)
+                before = json.loads(raw) if raw else None
+                after = change(before)
+                if after == before:
+                    pipe.unwatch()
+                    return after
+                pipe.multi()
+                if after:
+                    ttl = max(1, int(expires_at(after) - time.time()) + 1)
+                    pipe.set(key, json.dumps(after), ex=ttl)
+                else:
+                    pipe.delete(key)
+                pipe.execute()
+                return after
+            except redis.WatchError:
+                continue
+    raise RuntimeError(f"Breaker {name} kept changing under concurrent updates.")
+
+
+def update(name: str, change: Callable[[Optional[Dict]], Optional[Dict]]) -> Optional[Dict]:
+    client = None if name.startswith("redis:") else get_redis_client()
+    after = None
+    done = False
+    if client:
+        try:
+            after = update_redis(client, name, change)
+            done = True
+        except Exception:
+            pass
+    if not done:
+        try:
+            after = update_state_file(name, change)
+        except OSError:
+            # No shared state at all: keep it for this process only.
+            with _memo_lock:
+                memo = _memo.get(name)
+            after = change(memo[0] if memo else None)
+    with _memo_lock:
+        _memo[name] = (after, time.monotonic())
+    return after
+
+
+def read(name: str) -> Optional[Dict]:
+    with _memo_lock:
+        memo = _memo.get(name)
+    if memo is not None and time.monotonic() - memo[1] < MEMO_SECONDS:
+        return memo[0]
+    return update(name, lambda state: state)
+
+
+def allow(name: str) -> bool:
+    now = time.time()
+    state = read(name)
+    if not state or not state.get("openUntil"):
+        return True
+    if state["openUntil"] > now or state.get("probeUntil", 0) > now:
+        return False
+    claimed = []
+
+    def claim(current: Optional[Dict]) -> Optional[Dict]:
+        # Half-open: the first caller to get here becomes the probe.
+        now = time.time()
+        if not current or not current.get("openUntil"):
+            claimed.append(True)
+            return current
+        if current["openUntil"] > now or current.get("probeUntil", 0) > now:
+            return current
+        claimed.append(True)
+        return dict(current, probeUntil=now + PROBE_SECONDS)
+
+    update(name, claim)
+    return bool(claimed)
+
+
+def record_success(name: str) -> None:
+    if read(name) is None:
+        return
+    update(name, lambda state: None)
+
+
+def record_failure(
+    name: str, threshold: int = FAILURE_THRESHOLD, open_seconds: float = OPEN_SECONDS
+) -> None:
+    def fail(current: Optional[Dict]) -> Dict:
+        now = time.time()
+        state = dict(current or {})
+        opened = {"openUntil": now + open_seconds, "openSeconds": open_seconds}
+        if state.get("openUntil"):
+            # Already open; a failed half-open probe reopens it.
+            return state if state["openUntil"] > now else opened
+        if state.get("since", 0) + WINDOW_SECONDS < now:
+            state = {"since": now, "failures": 0}
+        state["failures"] = state.get("failures", 0) + 1
+        return opened if state["failures"] >= max(1, threshold) else state
+
+    update(name, fail)
+
+
+def supports(feature: str, scope: str) -> bool:
+    # False while the feature is known to be unsupported; True (as the
+    # single probe) once that knowledge has expired.
+    return allow(f"{feature}:{scope}")
+
+
+def mark_supported(feature: str, scope: str) -> None:
+    record_success(f"{feature}:{scope}")
+
+
+def mark_unsupported(feature: str, scope: str) -> None:
+    record_failure(f"{feature}:{scope}", threshold=1, open_seconds=CAPABILITY_TTL_SECONDS)
@@ -1,18 +1,37 @@
 #!/usr/bin/env python3
 import argparse
-import base64
+import contextlib
 import hashlib
+import itertools
 import json
 import os
 import sys
-import urllib.error
-import urllib.request
-from typing import Dict, List, Optional
-
-try:
-    import redis  # type: ignore
-except Exception:  # pragma: no cover - optional dependency
-    redis = None
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import Callable, Dict, List, Optional, Tuple
+
+from http_transport import (
+    JsonBody,
+    TransportError,
+    compresses,
+    get_transport,
+    require_abortable,
+)
+import capabilities
+import hedging
+import image_fetch
+import image_hash
+import metrics
+import queue_consumer
+import rate_limit
+import result_cache
+import similarity
+import token_budget
+from image_prep import EncodedImage, file_sha256, prepare_image
 
 
 SYSTEM_PROMPT = """你是“作业AI批改引擎”。任务：基于题目快照（prompt/standardAnswer/rubric）、学生文字答案与最多4张图片，对“单个学生的一道题”生成结构化批改建议（供教师复核，不是最终成绩）。
@@ -231,6 +250,59 @@ CUSTOM_GUIDANCE_PROMPT_TEMPLATE = """
 - 与 rubric 冲突时以 rubric 为准，并在 reason 说明依据。
 """
 
+MULTI_QUESTION_PROMPT_SUFFIX = """
+
+========================
+十五、多题合并批改（覆盖上文“单个学生的一道题”与输出结构）
+========================
+- 本次输入包含同一学生的多道题：questions 数组中每项有 questionIndex、question（题目快照与 rubric）、studentAnswerText 等；图片为该学生整份作业共用，需自行按题号对应作答区域。
+- 每道题独立判分，只能使用该题自己的 rubric；不得把其他题的作答当作本题证据。
+- 顶层输出改为 results 数组，每道输入题恰好对应一项，不得遗漏或新增：
+{
+  "results": [
+    {
+      "questionIndex": 1,
+      "result": { ...与单题输出的 result 结构完全相同... },
+      "extracted": { "studentMarkdown": "仅在 returnStudentMarkdown=true 时输出，只转写本题作答" }
+    }
+  ]
+}
+- 每项 result.items 的 questionIndex 必须等于该项 questionIndex；若图片中找不到某题作答，该题按未作答保守给分并在 uncertaintyReasons 中说明。
+"""
+
+PACKED_ANSWERS_PROMPT = """【多份作答合并批改】
+本次 answers 数组包含同一道题的多名学生的文字作答，每项以 submissionVersionId 区分。
+- 每份作答独立判分，互不参考；不得因作答相似而互相影响分数。
+- 仅输出一个 JSON 对象，顶层为 results 数组，每份输入作答恰好对应一项，不得遗漏或新增：
+{"results":[{"submissionVersionId":"与输入一致","result":{...与单题输出的 result 结构完全相同...}}]}
+"""
+
+# Short keys and positional rubric items; grader.py expands the output back
+# to the regular shape, so the worker never sees the compact form.
+COMPACT_OUTPUT = os.getenv("AI_GRADING_COMPACT_OUTPUT", "false").lower() == "true"
+
+COMPACT_OUTPUT_PROMPT_SUFFIX = """
+
+========================
+十六、紧凑输出（覆盖上文输出示例中的字段名，判分规则与字段含义不变）
+========================
+- 改用短键输出，示例：
+{"r":{"c":"建议总评","f":0.82,"u":false,"w":[["LOW_CONFIDENCE","置信度低于阈值"]],"i":[[8,"核心思路正确，个别步骤不完整",0.2]],"t":8},"m":"仅在 returnStudentMarkdown=true 时输出"}
+- r 即 result：c=comment，f=confidence，u=isUncertain，w=uncertaintyReasons（每项为 [code, message]），i=items，t=totalScore。
+- i 按输入 rubric 的顺序逐项输出 [score, reason, uncertaintyScore]，项数与 rubric 相同；不要输出 questionIndex、rubricItemKey、maxScore。
+- m 即 extracted.studentMarkdown；returnStudentMarkdown=false 时不要输出 m。
+- 多份作答合并批改时，results 每项的 result 也使用上述 r 的结构。
+"""
+
+COMPACT_RESULT_KEYS = {
+    "c": "comment",
+    "f": "confidence",
+    "u": "isUncertain",
+    "w": "uncertaintyReasons",
+    "i": "items",
+    "t": "totalScore",
+}
+
 
 def normalize_grading_strictness(value: Optional[str]) -> str:
     if not value:
@@ -250,6 +322,93 @@ def normalize_question_type(value: Optional[str]) -> str:
     return "SHORT_ANSWER"
 
 
+# Detection suffixes in the order they are appended after custom guidance.
+DETECTION_PROMPT_SUFFIXES = (
+    ("plagiarismDetection", PLAGIARISM_PROMPT_SUFFIX),
+    ("jumpStepDetection", JUMP_STEP_PROMPT_SUFFIX),
+    ("stepConflictDetection", STEP_CONFLICT_PROMPT_SUFFIX),
+    ("requiredStepDetection", REQUIRED_STEP_PROMPT_SUFFIX),
+    ("handwritingRecognition", HANDWRITING_PROMPT_SUFFIX),
+)
+
+
+def build_prompt_registry() -> Dict[Tuple[str, str, Tuple[bool, ...]], Dict]:
+    # Precompute every fixed prompt variant (strictness x question type x
+    # detection toggles). Custom guidance is free text, so each variant keeps
+    # the part before it (head) and after it (tail), the single-question
+    # output format override, plus a content digest that versions the prefix
+    # cache automatically.
+    output_format = COMPACT_OUTPUT_PROMPT_SUFFIX if COMPACT_OUTPUT else ""
+    registry = {}
+    for strictness, strictness_rules in STRICTNESS_RULE_MAP.items():
+        strictness_head = SYSTEM_PROMPT + STRICTNESS_PROMPT_TEMPLATE.format(
+            strictness_rules=strictness_rules.strip()
+        )
+        for question_type, type_rules in QUESTION_TYPE_PROMPT_MAP.items():
+            head = strictness_head + QUESTION_TYPE_PROMPT_TEMPLATE.format(
+                type_rules=type_rules.strip()
+            )
+            for flags in itertools.product((False, True), repeat=len(DETECTION_PROMPT_SUFFIXES)):
+                tail = "".join(
+                    suffix
+                    for enabled, (_, suffix) in zip(flags, DETECTION_PROMPT_SUFFIXES)
+                    if enabled
+                )
+                digest = hashlib.sha256(
+                    "\0".join(
+                        [head, CUSTOM_GUIDANCE_PROMPT_TEMPLATE, tail, output_format]
+                    ).encode("utf-8")
+                ).hexdigest()[:16]
+                registry[(strictness, question_type, flags)] = {
+                    "head": head,
+                    "tail": tail,
+                    "output_format": output_format,
+                    "digest": digest,
+                }
+    return registry
+
+
+PROMPT_REGISTRY = build_prompt_registry()
+
+
+def get_prompt_variant(
+    grading_strictness: Optional[str],
+    question_type: Optional[str],
+    plagiarism_detection: bool = True,
+    jump_step_detection: bool = True,
+    step_conflict_detection: bool = True,
+    required_step_detection: bool = True,
+    handwriting_recognition: bool = False,
+) -> Dict:
+    flags = (
+        bool(plagiarism_detection),
+        bool(jump_step_detection),
+        bool(step_conflict_detection),
+        bool(required_step_detection),
+        bool(handwriting_recognition),
+    )
+    return PROMPT_REGISTRY[
+        (
+            normalize_grading_strictness(grading_strictness),
+            normalize_question_type(question_type),
+            flags,
+        )
+    ]
+
+
+def get_prompt_variant_for(question_payload: Dict, options_payload: Dict) -> Dict:
+    return get_prompt_variant(
+        options_payload.get("gradingStrictness"),
+        question_payload.get("questionType"),
+        options_payload.get("plagiarismDetection", True),
+        options_payload.get("jumpStepDetection", True),
+        options_payload.get("stepConflictDetection", True),
+        options_payload.get("requiredStepDetection", True),
+        options_payload.get("handwritingRecognition", False),
+    )
+
+
+@lru_cache(maxsize=512)
 def build_system_prompt(
     handwriting_recognition: bool,
     grading_strictness: str = "BALANCED",
@@ -260,48 +419,112 @@ def build_system_prompt(
     step_conflict_detection: bool = True,
     required_step_detection: bool = True,
 ) -> str:
-    normalized_strictness = normalize_grading_strictness(grading_strictness)
-    normalized_question_type = normalize_question_type(question_type)
-    prompt = SYSTEM_PROMPT + STRICTNESS_PROMPT_TEMPLATE.format(
-        strictness_rules=STRICTNESS_RULE_MAP[normalized_strictness].strip()
+    variant = get_prompt_variant(
+        grading_strictness,
+        question_type,
+        plagiarism_detection,
+        jump_step_detection,
+        step_conflict_detection,
+        required_step_detection,
+        handwriting_recognition,
+    )
+    trimmed_guidance = custom_guidance.strip()
+    if not trimmed_guidance:
+        return variant["head"] + variant["tail"] + variant["output_format"]
+    return (
+        variant["head"]
+        + CUSTOM_GUIDANCE_PROMPT_TEMPLATE.format(custom_guidance=trimmed_guidance)
+        + variant["tail"]
+        + variant["output_format"]
+    )
+
+
+@lru_cache(maxsize=128)
+def build_multi_system_prompt(
+    question_types: Tuple[str, ...],
+    handwriting_recognition: bool,
+    grading_strictness: str = "BALANCED",
+    custom_guidance: str = "",
+    plagiarism_detection: bool = True,
+    jump_step_detection: bool = True,
+    step_conflict_detection: bool = True,
+    required_step_detection: bool = True,
+) -> str:
+    # Same sections as build_system_prompt, with the type rules of every
+    # question type in the request and the multi-question output contract.
+    variant = get_prompt_variant(
+        grading_strictness,
+        None,
+        plagiarism_detection,
+        jump_step_detection,
+        step_conflict_detection,
+        required_step_detection,
+        handwriting_recognition,
     )
-    prompt += QUESTION_TYPE_PROMPT_TEMPLATE.format(
-        type_rules=QUESTION_TYPE_PROMPT_MAP[normalized_question_type].strip()
+    type_rules = "".join(
+        QUESTION_TYPE_PROMPT_MAP[normalize_question_type(question_type)]
+        for question_type in question_types
+    )
+    prompt = (
+        SYSTEM_PROMPT
+        + STRICTNESS_PROMPT_TEMPLATE.format(
+            strictness_rules=STRICTNESS_RULE_MAP[
+                normalize_grading_strictness(grading_strictness)
+            ].strip()
+        )
+        + QUESTION_TYPE_PROMPT_TEMPLATE.format(type_rules=type_rules.strip())
     )
     trimmed_guidance = custom_guidance.strip()
     if trimmed_guidance:
-        prompt += CUSTOM_GUIDANCE_PROMPT_TEMPLATE.format(
-            custom_guidance=trimmed_guidance
-        )
-    if plagiarism_detection:
-        prompt += PLAGIARISM_PROMPT_SUFFIX
-    if jump_step_detection:
-        prompt += JUMP_STEP_PROMPT_SUFFIX
-    if step_conflict_detection:
-        prompt += STEP_CONFLICT_PROMPT_SUFFIX
-    if required_step_detection:
-        prompt += REQUIRED_STEP_PROMPT_SUFFIX
-    if handwriting_recognition:
-        prompt += HANDWRITING_PROMPT_SUFFIX
-    return prompt
-
-
-SYSTEM_PROMPT_VERSION = "v6"
+        prompt += CUSTOM_GUIDANCE_PROMPT_TEMPLATE.format(custom_guidance=trimmed_guidance)
+    return prompt + variant["tail"] + MULTI_QUESTION_PROMPT_SUFFIX
+
+
 PREFIX_CACHE_ENABLED = (
     os.getenv("AI_GRADING_PREFIX_CACHE_ENABLED", "true").lower() != "false"
 )
 PREFIX_CACHE_TTL_SECONDS = int(
     os.getenv("AI_GRADING_PREFIX_CACHE_TTL_SECONDS", "604800")
 )
-CACHE_AVAILABLE = True
+STREAM_ENABLED = os.getenv("AI_GRADING_STREAM", "false").lower() == "true"
+# After the streamed JSON is closed, wait this long for response.completed
+# (response id and token usage) before dropping the connection.
+STREAM_DRAIN_SECONDS = 5.0
+STREAM_WATCH_POLL_SECONDS = 0.2
+# Cheaper first-tier model; answers it is unsure about go to the main model.
+CASCADE_MODEL = os.getenv("AI_GRADING_CASCADE_MODEL", "").strip()
+# Text-only answers of these types can share one model call in --batch mode.
+PACK_SIZE = int(os.getenv("AI_GRADING_PACK_SIZE", "1"))
+PACK_QUESTION_TYPES = {"SHORT_ANSWER", "FILL_BLANK"}
 REDIS_URL = os.getenv("AI_GRADING_PREFIX_CACHE_REDIS_URL") or os.getenv(
     "REDIS_URL", ""
 )
 REDIS_KEY_PREFIX = os.getenv(
     "AI_GRADING_PREFIX_CACHE_KEY_PREFIX", "ai-grading:prefix:"
 )
-REDIS_AVAILABLE = True
-_redis_client = None
+REDIS_LOCK_PREFIX = f"{REDIS_KEY_PREFIX}lock:"
+REDIS_STATS_PREFIX = f"{REDIS_KEY_PREFIX}stats:"
+# The provider drops a cached prefix response this long after creating it;
+# together with PREFIX_CACHE_TTL_SECONDS this caps the lifetime of an id.
+PREFIX_PROVIDER_TTL_SECONDS = int(os.getenv("AI_GRADING_PREFIX_PROVIDER_TTL_SECONDS", "259200"))
+# Ids not used for this long are evicted; every hit pushes the expiry out.
+PREFIX_IDLE_TTL_SECONDS = int(os.getenv("AI_GRADING_PREFIX_IDLE_TTL_SECONDS", "21600"))
+# Ids with at least MIN_HITS hits are re-warmed this long before their
+# lifetime ends, so busy questions never run into an expired prefix.
+PREFIX_REFRESH_BEFORE_SECONDS = int(
+    os.getenv("AI_GRADING_PREFIX_REFRESH_BEFORE_SECONDS", "3600")
+)
+PREFIX_REFRESH_MIN_HITS = int(os.getenv("AI_GRADING_PREFIX_REFRESH_MIN_HITS", "20"))
+PREFIX_STATS_TTL_SECONDS = 7 * 24 * 3600
+PREFIX_LOCAL_CACHE_SIZE = int(os.getenv("AI_GRADING_PREFIX_LOCAL_CACHE_SIZE", "256"))
+PREFIX_LOCAL_CACHE_TTL_SECONDS = float(
+    os.getenv("AI_GRADING_PREFIX_LOCAL_CACHE_TTL_SECONDS", "300")
+)
+PREFIX_WARMUP_LOCK_SECONDS = int(os.getenv("AI_GRADING_PREFIX_WARMUP_LOCK_SECONDS", "60"))
+PREFIX_WARMUP_WAIT_SECONDS = float(
+    os.getenv("AI_GRADING_PREFIX_WARMUP_WAIT_SECONDS", "30")
+)
+PREFIX_WARMUP_POLL_SECONDS = 0.2
 
 
 def normalize_base_url(base_url: str) -> str:
@@ -309,13 +532,17 @@ def normalize_base_url(base_url: str) -> str:
 
 
 class ApiError(RuntimeError):
-    def __init__(self, status: int, body: str):
+    def __init__(self, status: int, body: str, retry_after: Optional[float] = None):
         super().__init__(f"HTTP {status} error: {body}")
         self.status = status
         self.body = body
+        self.retry_after = retry_after
 
 
 def load_json_payload(path: str) -> Dict:
+    # "-" reads the payload from stdin, so callers need no temp file.
+    if path == "-":
+        return json.load(sys.stdin)
     with open(path, "r", encoding="utf-8") as f:
         return json.load(f)
 
@@ -326,18 +553,7 @@ def load_json_text(path: str) -> str:
 
 
 def get_redis_client():
-    global _redis_client, REDIS_AVAILABLE
-    if not REDIS_AVAILABLE or not REDIS_URL or redis is None:
-        return None
-    if _redis_client is None:
-        try:
-            _redis_client = redis.Redis.from_url(
-                REDIS_URL, decode_responses=True
-            )
-        except Exception:
-            REDIS_AVAILABLE = False
-            return None
-    return _redis_client
+    return capabilities.redis_client(REDIS_URL)
 
 
 def build_prefix_cache_key(
@@ -345,7 +561,9 @@ def build_prefix_cache_key(
 ) -> str:
     payload = {
         "model": model,
-        "system_prompt_version": SYSTEM_PROMPT_VERSION,
+        "system_prompt": get_prompt_variant_for(question_payload, options_payload)[
+            "digest"
+        ],
         "question": question_payload,
         "options": options_payload,
     }
@@ -353,34 +571,197 @@ def build_prefix_cache_key(
     return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
 
+class PrefixIdLru:
+    # Small TTL-bounded LRU of cache key -> prefix response id, so repeat
+    # jobs in serve/batch mode still share ids while Redis is unavailable.
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._items: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        if self.max_size <= 0:
+            return None
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[key] = (value, time.monotonic() + self.ttl_seconds)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            self._items.pop(key, None)
+
+
+_local_prefix_ids = PrefixIdLru(
+    PREFIX_LOCAL_CACHE_SIZE, PREFIX_LOCAL_CACHE_TTL_SECONDS
+)
+
+
+def prefix_lifetime_seconds() -> int:
+    # 0 when ids never expire.
+    limits = [
+        limit for limit in (PREFIX_CACHE_TTL_SECONDS, PREFIX_PROVIDER_TTL_SECONDS) if limit > 0
+    ]
+    return min(limits) if limits else 0
+
+
 def get_cached_prefix_id(cache_key: str) -> Optional[str]:
+    # Peek at the id without counting a hit. Redis decides whether it still
+    # exists; the local LRU only answers while Redis is unavailable.
     client = get_redis_client()
-    if not client:
-        return None
-    try:
-        value = client.get(f"{REDIS_KEY_PREFIX}{cache_key}")
-        if isinstance(value, str) and value:
-            return value
-    except Exception:
-        return None
-    return None
+    if client:
+        try:
+            value = client.get(f"{REDIS_KEY_PREFIX}{cache_key}")
+        except Exception:
+            value = None
+        else:
+            if isinstance(value, str) and value:
+                _local_prefix_ids.set(cache_key, value)
+                return value
+            _local_prefix_ids.discard(cache_key)
+            return None
+    return _local_prefix_ids.get(cache_key)
+
+
+TOUCH_PREFIX_SCRIPT = """
+local id = redis.call("get", KEYS[1])
+if not id then
+    return false
+end
+local now = tonumber(ARGV[1])
+local created = tonumber(redis.call("hget", KEYS[2], "createdAt"))
+if not created then
+    created = now
+    redis.call("hset", KEYS[2], "createdAt", ARGV[1])
+end
+local ttl = tonumber(ARGV[2])
+local lifetime = tonumber(ARGV[3])
+if lifetime > 0 then
+    local remaining = created + lifetime - now
+    if remaining <= 0 then
+        redis.call("del", KEYS[1])
+        return false
+    end
+    if ttl <= 0 or remaining < ttl then
+        ttl = remaining
+    end
+end
+if ttl > 0 then
+    redis.call("expire", KEYS[1], math.ceil(ttl))
+end
+local hits = redis.call("hincrby", KEYS[2], "idHits", 1)
+redis.call("hincrby", KEYS[2], "hits", 1)
+redis.call("hset", KEYS[2], "lastHitAt", ARGV[1])
+for i = 5, #ARGV, 2 do
+    redis.call("hsetnx", KEYS[2], ARGV[i], ARGV[i + 1])
+end
+redis.call("expire", KEYS[2], ARGV[4])
+return {id, tostring(created), hits}
+"""
+
+
+def touch_prefix_id(cache_key: str, labels: Optional[Dict] = None) -> Optional[Dict]:
+    # Look up the id for a job that is about to use it: count the hit, slide
+    # its expiry by the idle TTL (never past its lifetime) and return
+    # {"id", "createdAt", "idHits"}. An id past its lifetime is dropped here
+    # instead of failing the graded request. Labels the stats hash does not
+    # have yet (an id warmed without them) are filled in. Without Redis only
+    # "id" is known.
+    client = get_redis_client()
+    if client:
+        try:
+            found = client.eval(
+                TOUCH_PREFIX_SCRIPT,
+                2,
+                f"{REDIS_KEY_PREFIX}{cache_key}",
+                f"{REDIS_STATS_PREFIX}{cache_key}",
+                repr(time.time()),
+                PREFIX_IDLE_TTL_SECONDS,
+                prefix_lifetime_seconds(),
+                PREFIX_STATS_TTL_SECONDS,
+                *itertools.chain.from_iterable(prefix_label_fields(labels).items()),
+            )
+        except Exception:
+            found = None
+        else:
+            if not found:
+                _local_prefix_ids.discard(cache_key)
+                return None
+            _local_prefix_ids.set(cache_key, found[0])
+            return {"id": found[0], "createdAt": float(found[1]), "idHits": int(found[2])}
+    local = _local_prefix_ids.get(cache_key)
+    return {"id": local} if local else None
 
 
-def set_cached_prefix_id(cache_key: str, response_id: str) -> None:
+def set_cached_prefix_id(
+    cache_key: str,
+    response_id: str,
+    *,
+    labels: Optional[Dict] = None,
+    refresh: bool = False,
+) -> None:
+    # Store a new id (fresh warmup or refresh) and restart its hit count.
+    _local_prefix_ids.set(cache_key, response_id)
     client = get_redis_client()
     if not client:
         return
+    ttls = [ttl for ttl in (PREFIX_IDLE_TTL_SECONDS, prefix_lifetime_seconds()) if ttl > 0]
+    stats_key = f"{REDIS_STATS_PREFIX}{cache_key}"
+    fields = {"createdAt": repr(time.time()), "idHits": 0}
+    fields.update(prefix_label_fields(labels))
     try:
-        client.set(
+        pipe = client.pipeline()
+        pipe.set(
             f"{REDIS_KEY_PREFIX}{cache_key}",
             response_id,
-            ex=PREFIX_CACHE_TTL_SECONDS if PREFIX_CACHE_TTL_SECONDS > 0 else None,
+            ex=min(ttls) if ttls else None,
         )
+        pipe.hset(stats_key, mapping=fields)
+        pipe.hincrby(stats_key, "refreshes" if refresh else "misses", 1)
+        pipe.expire(stats_key, PREFIX_STATS_TTL_SECONDS)
+        pipe.execute()
+    except Exception:
+        return
+
+
+def prefix_label_fields(labels: Optional[Dict]) -> Dict[str, str]:
+    return {key: str(value) for key, value in (labels or {}).items() if value is not None}
+
+
+def record_prefix_fallback(cache_key: str) -> None:
+    # The provider rejected a cached id: count it and forget the id.
+    clear_cached_prefix_id(cache_key)
+    metrics.count("cache_fallback")
+    client = get_redis_client()
+    if not client:
+        return
+    try:
+        pipe = client.pipeline()
+        pipe.hincrby(f"{REDIS_STATS_PREFIX}{cache_key}", "fallbacks", 1)
+        pipe.expire(f"{REDIS_STATS_PREFIX}{cache_key}", PREFIX_STATS_TTL_SECONDS)
+        pipe.execute()
     except Exception:
         return
 
 
 def clear_cached_prefix_id(cache_key: str) -> None:
+    _local_prefix_ids.discard(cache_key)
     client = get_redis_client()
     if not client:
         return
@@ -390,38 +771,106 @@ def clear_cached_prefix_id(cache_key: str) -> None:
         return
 
 
-def guess_mime(path: str) -> str:
-    lower = path.lower()
-    if lower.endswith(".png"):
-        return "image/png"
-    if lower.endswith(".jpg") or lower.endswith(".jpeg"):
-        return "image/jpeg"
-    if lower.endswith(".webp"):
-        return "image/webp"
-    return "application/octet-stream"
+# cache_key -> [lock, users]: threads of one serve/batch process warming the
+# same prefix queue up instead of racing; other prefixes are not held up.
+_warmup_thread_locks: Dict[str, List] = {}
+_warmup_thread_locks_guard = threading.Lock()
+
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+@contextlib.contextmanager
+def warmup_thread_lock(cache_key: str):
+    with _warmup_thread_locks_guard:
+        entry = _warmup_thread_locks.setdefault(cache_key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _warmup_thread_locks_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del _warmup_thread_locks[cache_key]
+
+
+def try_acquire_warmup_lock(cache_key: str) -> Tuple[bool, Optional[str]]:
+    # Returns (acquired, token). Without Redis every caller is the leader.
+    client = get_redis_client()
+    if not client:
+        return True, None
+    token = uuid.uuid4().hex
+    try:
+        acquired = client.set(
+            f"{REDIS_LOCK_PREFIX}{cache_key}",
+            token,
+            nx=True,
+            ex=PREFIX_WARMUP_LOCK_SECONDS,
+        )
+    except Exception:
+        return True, None
+    return (True, token) if acquired else (False, None)
+
+
+def release_warmup_lock(cache_key: str, token: Optional[str]) -> None:
+    client = get_redis_client()
+    if not client or not token:
+        return
+    try:
+        client.eval(RELEASE_LOCK_SCRIPT, 1, f"{REDIS_LOCK_PREFIX}{cache_key}", token)
+    except Exception:
+        return
+
+
+def wait_for_prefix_id(cache_key: str, labels: Optional[Dict] = None) -> Optional[str]:
+    # Another process is warming this prefix; poll for its id until the lock
+    # disappears (the leader finished or failed) or the wait budget runs out.
+    client = get_redis_client()
+    if not client:
+        return None
+    deadline = time.monotonic() + PREFIX_WARMUP_WAIT_SECONDS
+    while time.monotonic() < deadline:
+        time.sleep(PREFIX_WARMUP_POLL_SECONDS)
+        if get_cached_prefix_id(cache_key):
+            break
+        try:
+            if not client.exists(f"{REDIS_LOCK_PREFIX}{cache_key}"):
+                break
+        except Exception:
+            return None
+    else:
+        return None
+    # The waiting job uses the id too: count the hit and slide its expiry.
+    entry = touch_prefix_id(cache_key, labels)
+    return entry["id"] if entry else None
 
 
-def encode_image_data_url(path: str) -> str:
-    # Convert local image into a data URL that ARK accepts.
-    with open(path, "rb") as f:
-        raw = f.read()
-    mime = guess_mime(path)
-    b64 = base64.b64encode(raw).decode("ascii")
-    return f"data:{mime};base64,{b64}"
+def image_part(image: EncodedImage, detail: Optional[str] = None) -> Dict:
+    part = {"type": "input_image", "image_url": image}
+    if detail:
+        part["detail"] = detail
+    return part
 
 
 def build_messages(
-    json_text: str, image_data_urls: List[str], system_prompt: str
+    json_text: str,
+    images: List[EncodedImage],
+    system_prompt: str,
+    image_detail: Optional[str] = None,
 ) -> List[Dict]:
-    # Build multi-modal input for the Responses API.
+    # Build multi-modal input for the Responses API. Images are referenced,
+    # not copied; the transport streams them into the request body.
     user_text = "json:\n" + json_text
     system_message = {
         "role": "system",
         "content": [{"type": "input_text", "text": system_prompt}],
     }
-    user_content = []
-    for image_url in image_data_urls:
-        user_content.append({"type": "input_image", "image_url": image_url})
+    user_content = [image_part(image, image_detail) for image in images]
     user_content.append({"type": "input_text", "text": user_text})
     return [
         system_message,
@@ -489,37 +938,403 @@ def build_prefix_messages(
 
 
 def build_suffix_messages(
-    student_payload: Dict, image_data_urls: List[str]
+    student_payload: Dict, images: List[EncodedImage], image_detail: Optional[str] = None
 ) -> List[Dict]:
     user_text = "s:\n" + json.dumps(student_payload, ensure_ascii=False)
     user_content = [{"type": "input_text", "text": user_text}]
-    for image_url in image_data_urls:
-        user_content.append({"type": "input_image", "image_url": image_url})
+    user_content.extend(image_part(image, image_detail) for image in images)
     return [{"role": "user", "content": user_content}]
 
 
+def record_endpoint_health(breaker: Optional[str], healthy: bool) -> None:
+    if breaker:
+        if healthy:
+            capabilities.record_success(breaker)
+        else:
+            capabilities.record_failure(breaker)
+
+
+def send_with_retries(
+    send: Callable[[], object],
+    payload: Dict,
+    cancel_event: Optional[threading.Event] = None,
+    breaker: Optional[str] = None,
+):
+    # Take from the shared rate limit before every attempt and retry 429/5xx
+    # and network errors with jittered exponential backoff, honoring
+    # Retry-After, instead of failing the whole job back to the queue.
+    # While the endpoint's shared circuit breaker is open, fail fast instead.
+    if breaker and not capabilities.allow(breaker):
+        metrics.count("breaker_rejections")
+        raise ApiError(503, f"Circuit breaker {breaker} is open after repeated failures.")
+    attempt = 0
+    while True:
+        try:
+            with metrics.phase("rate_limit_wait"):
+                rate_limit.acquire(payload, cancel_event)
+        except rate_limit.RateLimitTimeout as exc:
+            raise ApiError(429, str(exc)) from exc
+        if cancel_event is not None and cancel_event.is_set():
+            raise GradingCancelled("Request cancelled.")
+        try:
+            result = send()
+        except ApiError as exc:
+            record_endpoint_health(breaker, exc.status < 500)
+            if (
+                exc.status not in rate_limit.RETRY_STATUSES
+                or attempt + 1 >= rate_limit.RETRY_MAX_ATTEMPTS
+            ):
+                raise
+            delay = rate_limit.backoff_delay(attempt, exc.retry_after)
+        except TransportError as exc:
+            if cancel_event is not None and cancel_event.is_set():
+                # The transport aborted the request; not the endpoint's fault.
+                raise GradingCancelled("Request cancelled.") from exc
+            record_endpoint_health(breaker, False)
+            if attempt + 1 >= rate_limit.RETRY_MAX_ATTEMPTS:
+                raise RuntimeError(f"Request failed: {exc}") from exc
+            delay = rate_limit.backoff_delay(attempt)
+        else:
+            record_endpoint_health(breaker, True)
+            return result
+        attempt += 1
+        metrics.count("retries")
+        if cancel_event is not None:
+            if cancel_event.wait(delay):
+                raise GradingCancelled("Request cancelled.")
+        else:
+            time.sleep(delay)
+
+
+def raise_for_status(status: int, body: bytes, headers: Dict[str, str]) -> None:
+    if status >= 400:
+        raise ApiError(
+            status,
+            body.decode("utf-8", errors="replace"),
+            rate_limit.parse_retry_after(headers.get("retry-after")),
+        )
+
+
+def endpoint_breaker(base_url: str) -> str:
+    return f"endpoint:{normalize_base_url(base_url)}"
+
+
+def use_gzip(scope: str, data: JsonBody, headers: Dict[str, str]) -> bool:
+    # Whether this request body goes out gzipped. Endpoints known to reject
+    # gzip get an explicit Content-Encoding: identity instead.
+    if headers.get("Content-Encoding") == "identity" or not compresses(len(data)):
+        return False
+    if capabilities.supports("gzip", scope):
+        return True
+    headers["Content-Encoding"] = "identity"
+    return False
+
+
+def is_gzip_rejection(status: int, body: bytes) -> bool:
+    text = body[:2000].decode("utf-8", errors="replace").lower()
+    return status == 415 or (status == 400 and ("gzip" in text or "encoding" in text))
+
+
+def is_stream_rejection(exc: ApiError) -> bool:
+    return exc.status in (400, 404, 405, 501) and "stream" in exc.body.lower()
+
+
 def request_chat_completion(
-    *, base_url: str, api_key: str, payload: Dict
+    *,
+    base_url: str,
+    api_key: str,
+    payload: Dict,
+    cancel_event: Optional[threading.Event] = None,
 ) -> Dict:
     # Call ARK Responses endpoint with a single request payload.
     url = f"{base_url}/responses"
-    data = json.dumps(payload).encode("utf-8")
+    data = JsonBody(payload)
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {api_key}",
     }
-    req = urllib.request.Request(url, data=data, headers=headers, method="POST")
-    try:
-        with urllib.request.urlopen(req, timeout=120) as resp:
-            body = resp.read()
-    except urllib.error.HTTPError as exc:
-        err_body = exc.read().decode("utf-8", errors="replace")
-        raise ApiError(exc.code, err_body) from exc
-    except urllib.error.URLError as exc:
-        raise RuntimeError(f"Request failed: {exc}") from exc
+
+    scope = capabilities.scope_for(base_url, api_key)
+
+    def send() -> bytes:
+        metrics.count("request_bytes", len(data))
+        while True:
+            gzipped = use_gzip(scope, data, headers)
+            status, body, response_headers = get_transport(url).post(
+                url, data, headers, cancel_event
+            )
+            if gzipped and is_gzip_rejection(status, body):
+                # Remember the rejection and resend the same body uncompressed.
+                capabilities.mark_unsupported("gzip", scope)
+                headers["Content-Encoding"] = "identity"
+                continue
+            if gzipped and status < 400:
+                capabilities.mark_supported("gzip", scope)
+            raise_for_status(status, body, response_headers)
+            return body
+
+    body = send_with_retries(send, payload, cancel_event, endpoint_breaker(base_url))
     return json.loads(body.decode("utf-8"))
 
 
+class GradingCancelled(RuntimeError):
+    pass
+
+
+class JsonObjectTracker:
+    # Follows brace depth of the first top-level JSON object in streamed
+    # text so the stream can be dropped as soon as that object is closed.
+    def __init__(self):
+        self.started = False
+        self.closed = False
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text: str) -> bool:
+        for ch in text:
+            if self.closed:
+                break
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"' and self.started:
+                self.in_string = True
+            elif ch == "{":
+                self.started = True
+                self.depth += 1
+            elif ch == "}" and self.started:
+                self.depth -= 1
+                self.closed = self.depth == 0
+        return self.closed
+
+
+def emit_progress(progress: Optional[Callable[[str], None]], event: str) -> None:
+    if progress is not None:
+        progress(event)
+
+
+def request_chat_completion_stream(
+    *,
+    base_url: str,
+    api_key: str,
+    payload: Dict,
+    progress: Optional[Callable[[str], None]] = None,
+    cancel_event: Optional[threading.Event] = None,
+) -> Dict:
+    # Same call as request_chat_completion but over SSE; output_text deltas
+    # are assembled as they arrive. Once the JSON is closed the answer is
+    # final, but reading goes on (briefly) for the id and usage sent with
+    # response.completed.
+    url = f"{base_url}/responses"
+    data = JsonBody(dict(payload, stream=True))
+    headers = {
+        "Content-Type": "application/json",
+        "Accept": "text/event-stream",
+        "Authorization": f"Bearer {api_key}",
+    }
+
+    scope = capabilities.scope_for(base_url, api_key)
+
+    def open_stream():
+        metrics.count("request_bytes", len(data))
+        while True:
+            gzipped = use_gzip(scope, data, headers)
+            opened = get_transport(url).open_stream(url, data, headers, abort)
+            if opened.status < 400:
+                if gzipped:
+                    capabilities.mark_supported("gzip", scope)
+                return opened
+            try:
+                body = opened.read()
+            finally:
+                opened.close()
+            if gzipped and is_gzip_rejection(opened.status, body):
+                capabilities.mark_unsupported("gzip", scope)
+                headers["Content-Encoding"] = "identity"
+                continue
+            raise_for_status(opened.status, body, opened.headers)
+
+    # The transport drops the connection when this is set: on cancellation,
+    # or when response.completed does not follow the closed JSON in time.
+    abort = threading.Event()
+    finished = threading.Event()
+    drain_until = 0.0
+
+    def watch() -> None:
+        while not finished.wait(STREAM_WATCH_POLL_SECONDS):
+            if (cancel_event is not None and cancel_event.is_set()) or (
+                drain_until and time.monotonic() > drain_until
+            ):
+                abort.set()
+                return
+
+    threading.Thread(target=watch, name="stream-watch", daemon=True).start()
+    started = time.perf_counter()
+    try:
+        stream = send_with_retries(
+            open_stream, payload, cancel_event, endpoint_breaker(base_url)
+        )
+    except BaseException:
+        finished.set()
+        raise
+    chunks: List[str] = []
+    completed: Dict = {}
+    try:
+        tracker = JsonObjectTracker()
+        data_lines: List[str] = []
+        for line in stream.iter_lines():
+            if cancel_event is not None and cancel_event.is_set():
+                raise GradingCancelled("Request cancelled.")
+            if line.startswith("data:"):
+                data_lines.append(line[5:].lstrip())
+                continue
+            if line or not data_lines:
+                continue
+            raw = "\n".join(data_lines)
+            data_lines = []
+            if raw == "[DONE]":
+                break
+            event = json.loads(raw)
+            event_type = event.get("type")
+            if event_type in ("response.completed", "response.incomplete"):
+                completed = event.get("response") or {}
+                break
+            if event_type in ("error", "response.failed", "response.error"):
+                raise ApiError(502, raw)
+            if drain_until:
+                continue
+            delta = ""
+            if event_type == "response.output_text.delta":
+                delta = event.get("delta") or ""
+            elif isinstance(event.get("choices"), list) and event["choices"]:
+                delta = (event["choices"][0].get("delta") or {}).get("content") or ""
+            if not delta:
+                continue
+            if not chunks:
+                metrics.record_phase("first_token", time.perf_counter() - started)
+                emit_progress(progress, "first-token")
+            chunks.append(delta)
+            if tracker.feed(delta):
+                drain_until = time.monotonic() + STREAM_DRAIN_SECONDS
+    except TransportError as exc:
+        if cancel_event is not None and cancel_event.is_set():
+            raise GradingCancelled("Request cancelled.") from exc
+        if not drain_until:
+            raise RuntimeError(f"Request failed: {exc}") from exc
+    finally:
+        finished.set()
+        stream.close()
+    if cancel_event is not None and cancel_event.is_set():
+        raise GradingCancelled("Request cancelled.")
+    if drain_until and not completed:
+        # The answer is complete; only its id and token usage are unknown.
+        metrics.count("stream_usage_missing")
+    if not chunks:
+        return completed
+    return {
+        "id": completed.get("id"),
+        "status": completed.get("status"),
+        "incomplete_details": completed.get("incomplete_details"),
+        "output_text": "".join(chunks),
+        "usage": completed.get("usage"),
+    }
+
+
+def request_model_output(
+    *,
+    base_url: str,
+    api_key: str,
+    payload: Dict,
+    stream: bool = False,
+    progress: Optional[Callable[[str], None]] = None,
+    cancel_event: Optional[threading.Event] = None,
+) -> Dict:
+    if cancel_event is not None and cancel_event.is_set():
+        raise GradingCancelled("Request cancelled.")
+    emit_progress(progress, "request-sent")
+    scope = capabilities.scope_for(base_url, api_key)
+    stream = stream and capabilities.supports("stream", scope)
+    # A hedged duplicate reports the same progress events; forward each once.
+    forwarded = set()
+    forwarded_lock = threading.Lock()
+
+    def attempt(
+        attempt_cancel: Optional[threading.Event], first_output: hedging.AttemptProgress
+    ) -> Dict:
+        if not stream:
+            return request_chat_completion(
+                base_url=base_url, api_key=api_key, payload=payload, cancel_event=attempt_cancel
+            )
+
+        def attempt_progress(event: str) -> None:
+            if event == "first-token":
+                first_output.set()
+            with forwarded_lock:
+                if event in forwarded:
+                    return
+                forwarded.add(event)
+            emit_progress(progress, event)
+
+        try:
+            response = request_chat_completion_stream(
+                base_url=base_url,
+                api_key=api_key,
+                payload=payload,
+                progress=attempt_progress,
+                cancel_event=attempt_cancel,
+            )
+        except ApiError as exc:
+            if not is_stream_rejection(exc):
+                raise
+            capabilities.mark_unsupported("stream", scope)
+            # Nothing streams now, so there is no first token to wait for;
+            # the job deadline covers the plain request.
+            attempt_progress("first-token")
+            return request_chat_completion(
+                base_url=base_url, api_key=api_key, payload=payload, cancel_event=attempt_cancel
+            )
+        capabilities.mark_supported("stream", scope)
+        return response
+
+    with metrics.phase("model_call"):
+        response = hedging.run(
+            attempt,
+            kind="first_token" if stream else "response",
+            cancel_event=cancel_event,
+            # A losing plain request can only be stopped by a transport that
+            # aborts its socket; elsewhere it would run (and bill) to the end.
+            hedge=stream or get_transport(f"{base_url}/responses").abortable,
+        )
+    if payload.get("max_output_tokens") and is_truncated(response):
+        # A cut-off answer cannot be parsed and a job retry would hit the
+        # same cap: ask once more without it.
+        metrics.count("output_truncated")
+        print(
+            f"Model output hit max_output_tokens={payload['max_output_tokens']}; retrying without it.",
+            file=sys.stderr,
+        )
+        return request_model_output(
+            base_url=base_url,
+            api_key=api_key,
+            payload={key: value for key, value in payload.items() if key != "max_output_tokens"},
+            stream=stream,
+            progress=progress,
+            cancel_event=cancel_event,
+        )
+    return response
+
+
+def is_truncated(response: Dict) -> bool:
+    details = response.get("incomplete_details")
+    reason = details.get("reason") if isinstance(details, dict) else None
+    return response.get("status") == "incomplete" or reason == "max_output_tokens"
+
+
 def should_fallback_cache_error(body: str) -> bool:
     text = (body or "").lower()
     if "cached response" in text:
@@ -542,14 +1357,100 @@ def ensure_prefix_response_id(
     question_payload: Dict,
     options_payload: Dict,
     system_prompt: str,
+    labels: Optional[Dict] = None,
 ) -> Optional[str]:
-    global CACHE_AVAILABLE
-    if not PREFIX_CACHE_ENABLED or not CACHE_AVAILABLE:
+    if not PREFIX_CACHE_ENABLED or not capabilities.supports(
+        "prefix_cache", capabilities.scope_for(base_url, api_key)
+    ):
+        metrics.label("prefix_cache", "disabled")
         return None
-    cached = get_cached_prefix_id(cache_key)
+    warmup = partial(
+        create_prefix_response_id,
+        cache_key=cache_key,
+        base_url=base_url,
+        api_key=api_key,
+        model=model,
+        question_payload=question_payload,
+        options_payload=options_payload,
+        system_prompt=system_prompt,
+        labels=labels,
+    )
+    entry = touch_prefix_id(cache_key, labels)
+    if entry:
+        metrics.label("prefix_cache", "hit")
+        if prefix_refresh_due(entry):
+            start_prefix_refresh(cache_key, warmup)
+        return entry["id"]
+
+    # Single flight: one thread per process and one process per Redis warms
+    # a given prefix; everyone else waits for the id it publishes.
+    with warmup_thread_lock(cache_key):
+        entry = touch_prefix_id(cache_key, labels)
+        if entry:
+            metrics.label("prefix_cache", "hit")
+            return entry["id"]
+        acquired, token = try_acquire_warmup_lock(cache_key)
+        if acquired:
+            try:
+                return warmup()
+            finally:
+                release_warmup_lock(cache_key, token)
+    # Another process is warming it; the poll runs outside the thread lock.
+    cached = wait_for_prefix_id(cache_key, labels)
     if cached:
+        metrics.label("prefix_cache", "hit")
         return cached
+    # Its warmup failed or is still running: grade this job without a prefix
+    # rather than warming a second copy next to it.
+    metrics.label("prefix_cache", "skipped")
+    return None
+
+
+def prefix_refresh_due(entry: Dict) -> bool:
+    # Hot ids close to the end of their lifetime.
+    lifetime = prefix_lifetime_seconds()
+    if lifetime <= 0 or PREFIX_REFRESH_MIN_HITS <= 0 or "createdAt" not in entry:
+        return False
+    age = time.time() - entry["createdAt"]
+    return (
+        entry["idHits"] >= PREFIX_REFRESH_MIN_HITS
+        and age >= lifetime - PREFIX_REFRESH_BEFORE_SECONDS
+    )
+
+
+def start_prefix_refresh(cache_key: str, warmup: Callable[..., Optional[str]]) -> None:
+    # Re-warm in the background while jobs keep using the current id, which
+    # is still valid. The warmup lock makes one process do it; the thread is
+    # not a daemon, so a one-shot grader finishes the refresh before exiting.
+    acquired, token = try_acquire_warmup_lock(cache_key)
+    if not acquired or token is None:
+        return
+    metrics.count("prefix_refreshes")
+
+    def refresh() -> None:
+        try:
+            warmup(refresh=True)
+        except Exception as exc:
+            print(f"Prefix refresh failed: {exc}", file=sys.stderr)
+        finally:
+            release_warmup_lock(cache_key, token)
+
+    threading.Thread(target=refresh, name="prefix-refresh").start()
 
+
+def create_prefix_response_id(
+    *,
+    cache_key: str,
+    base_url: str,
+    api_key: str,
+    model: str,
+    question_payload: Dict,
+    options_payload: Dict,
+    system_prompt: str,
+    labels: Optional[Dict] = None,
+    refresh: bool = False,
+) -> Optional[str]:
+    scope = capabilities.scope_for(base_url, api_key)
     prefix_messages = build_prefix_messages(
         question_payload, options_payload, system_prompt
     )
@@ -565,7 +1466,8 @@ def ensure_prefix_response_id(
         )
     except ApiError as exc:
         if exc.status == 403 and "accessdenied.cacheservice" in exc.body.lower():
-            CACHE_AVAILABLE = False
+            # Remembered for every grader process, so later jobs skip the warmup.
+            capabilities.mark_unsupported("prefix_cache", scope)
             print(
                 "Cache service not enabled; fallback to no-cache.",
                 file=sys.stderr,
@@ -573,9 +1475,12 @@ def ensure_prefix_response_id(
             return None
         raise
 
+    capabilities.mark_supported("prefix_cache", scope)
     response_id = response.get("id")
+    if not refresh:
+        metrics.label("prefix_cache", "miss")
     if isinstance(response_id, str) and response_id:
-        set_cached_prefix_id(cache_key, response_id)
+        set_cached_prefix_id(cache_key, response_id, labels=labels, refresh=refresh)
         return response_id
     return None
 
@@ -622,72 +1527,42 @@ def validate_api_key(api_key: str) -> Optional[str]:
     return None
 
 
-def main() -> int:
-    parser = argparse.ArgumentParser(
-        description="Send a JSON rubric + handwritten solution image to Doubao (ARK)."
+class GraderInputError(ValueError):
+    pass
+
+
+def resolve_api_key() -> str:
+    return os.getenv("ARK_API_KEY") or os.getenv("DEEPSEEK_API_KEY", "")
+
+
+def resolve_base_url(override: Optional[str] = None) -> str:
+    return normalize_base_url(
+        override
+        or os.getenv("ARK_BASE_URL", "https://ark.cn-beijing.volces.com/api/v3")
+        or os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com/v1")
     )
-    parser.add_argument("--json", required=True, help="Path to the JSON input file.")
-    parser.add_argument(
-        "--image",
-        action="append",
-        default=[],
-        help="Path to a handwritten solution image (repeat up to 4).",
-    )
-    parser.add_argument("--model", help="Model name override.")
-    parser.add_argument("--base-url", help="API base URL override.")
-    parser.add_argument("--temperature", type=float, default=0.2)
-    parser.add_argument("--max-tokens", type=int, help="Optional max_tokens.")
-    parser.add_argument("--out", help="Optional output file path.")
-    args = parser.parse_args()
 
-    api_key = os.getenv("ARK_API_KEY") or os.getenv("DEEPSEEK_API_KEY", "")
-    key_error = validate_api_key(api_key)
-    if key_error:
-        print(key_error, file=sys.stderr)
-        return 2
 
-    base_url = normalize_base_url(
-        args.base_url
-        or os.getenv("ARK_BASE_URL", "https://ark.cn-beijing.volces.com/api/v3")
-        or os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com/v1")
-    )
-    model = args.model or os.getenv("ARK_MODEL", "doubao-seed-2-0-mini-260215")
+def resolve_model(override: Optional[str] = None) -> str:
+    return override or os.getenv("ARK_MODEL", "doubao-seed-2-0-mini-260215")
 
-    json_payload = load_json_payload(args.json)
-    if not isinstance(json_payload, dict):
-        json_payload = {}
-    json_text = json.dumps(json_payload, ensure_ascii=False, separators=(",", ":"))
+
+def build_grading_context(json_payload: Dict, model: str) -> Dict:
+    # Everything that depends only on the question and options, so it can be
+    # built once and shared by every student answering the same question.
     question_payload = extract_question_payload(json_payload)
     options_payload = extract_options_payload(json_payload)
-    student_payload = extract_student_payload(json_payload, question_payload)
-    handwriting_recognition = bool(options_payload.get("handwritingRecognition"))
-    plagiarism_detection = bool(options_payload.get("plagiarismDetection", True))
-    jump_step_detection = bool(options_payload.get("jumpStepDetection", True))
-    step_conflict_detection = bool(options_payload.get("stepConflictDetection", True))
-    required_step_detection = bool(options_payload.get("requiredStepDetection", True))
-    grading_strictness = str(options_payload.get("gradingStrictness") or "BALANCED")
-    custom_guidance = str(options_payload.get("customGuidance") or "")
-    question_type = str(question_payload.get("questionType") or "SHORT_ANSWER")
     system_prompt = build_system_prompt(
-        handwriting_recognition,
-        grading_strictness,
-        custom_guidance,
-        question_type,
-        plagiarism_detection,
-        jump_step_detection,
-        step_conflict_detection,
-        required_step_detection,
+        bool(options_payload.get("handwritingRecognition")),
+        str(options_payload.get("gradingStrictness") or "BALANCED"),
+        str(options_payload.get("customGuidance") or ""),
+        str(question_payload.get("questionType") or "SHORT_ANSWER"),
+        bool(options_payload.get("plagiarismDetection", True)),
+        bool(options_payload.get("jumpStepDetection", True)),
+        bool(options_payload.get("stepConflictDetection", True)),
+        bool(options_payload.get("requiredStepDetection", True)),
     )
-
-    image_paths = args.image or []
-    if len(image_paths) > 4:
-        print("Too many images; provide up to 4.", file=sys.stderr)
-        return 2
-    image_data_urls = [encode_image_data_url(path) for path in image_paths]
-    full_messages = build_messages(json_text, image_data_urls, system_prompt)
-
     cache_key = None
-    prefix_response_id = None
     has_question_content = any(
         [
             question_payload.get("prompt"),
@@ -701,59 +1576,1749 @@ def main() -> int:
             question_payload=question_payload,
             options_payload=options_payload,
         )
-        try:
-            prefix_response_id = ensure_prefix_response_id(
-                cache_key=cache_key,
+    return {
+        "model": model,
+        "question": question_payload,
+        "options": options_payload,
+        "system_prompt": system_prompt,
+        "cache_key": cache_key,
+        # Identifies the question in the prefix cache statistics.
+        "prefix_labels": {
+            "assignmentSnapshotId": json_payload.get("assignmentSnapshotId"),
+            "questionId": (json_payload.get("question") or {}).get("questionId"),
+            "questionIndex": question_payload.get("questionIndex"),
+            "model": model,
+        },
+    }
+
+
+def warm_prefix(context: Dict, *, base_url: str, api_key: str) -> Optional[str]:
+    if not context.get("cache_key"):
+        metrics.label("prefix_cache", "disabled")
+        return None
+    try:
+        with metrics.phase("prefix_warmup"):
+            return ensure_prefix_response_id(
+                cache_key=context["cache_key"],
                 base_url=base_url,
                 api_key=api_key,
-                model=model,
-                question_payload=question_payload,
-                options_payload=options_payload,
-                system_prompt=system_prompt,
+                model=context["model"],
+                question_payload=context["question"],
+                options_payload=context["options"],
+                system_prompt=context["system_prompt"],
+                labels=context.get("prefix_labels"),
             )
-        except ApiError as exc:
-            raise RuntimeError(f"Prefix cache warmup failed: {exc.body}") from exc
+    except ApiError as exc:
+        raise RuntimeError(f"Prefix cache warmup failed: {exc.body}") from exc
+
+
+def build_result_cache_key(
+    context: Dict,
+    *,
+    json_payload: Dict,
+    image_paths: List[str],
+    temperature: float,
+    max_tokens: Optional[int],
+) -> Optional[str]:
+    if not result_cache.enabled():
+        return None
+    return result_cache.build_result_key(
+        model=context["model"],
+        temperature=temperature,
+        max_tokens=max_tokens,
+        system_prompt_digest=get_prompt_variant_for(
+            context["question"], context["options"]
+        )["digest"],
+        json_payload=json_payload,
+        image_digests=[file_sha256(path) for path in image_paths or []],
+    )
+
+
+def lookup_cached_result(
+    result_key: Optional[str], progress: Optional[Callable[[str], None]] = None
+) -> Optional[str]:
+    if not result_key:
+        return None
+    content = result_cache.get(result_key)
+    metrics.label("result_cache", "miss" if content is None else "hit")
+    if content is not None:
+        emit_progress(progress, "cache-hit")
+        emit_progress(progress, "done")
+    return content
+
+
+def fit_token_budget(context: Dict, json_payload: Dict, image_paths: List[str]) -> Dict:
+    # Estimate one student's request and degrade it to AI_GRADING_TOKEN_BUDGET;
+    # the returned json_payload carries the (possibly trimmed) answer.
+    student_payload = extract_student_payload(json_payload, context["question"])
+    answer = str(student_payload["studentAnswerText"])
+    plan = token_budget.fit(
+        prefix_text=context["system_prompt"]
+        + json.dumps(
+            {"question": context["question"], "options": context["options"]},
+            ensure_ascii=False,
+        ),
+        suffix_text=json.dumps(student_payload, ensure_ascii=False),
+        answers=[answer] if answer else [],
+        image_paths=image_paths,
+    )
+    if answer and plan["answers"][0] != answer:
+        json_payload = dict(json_payload, studentAnswerText=plan["answers"][0])
+    plan["json_payload"] = json_payload
+    return plan
+
+
+def enforce_token_budget(plan: Dict) -> None:
+    estimate = plan["estimate"]
+    metrics.count("estimated_input_tokens", estimate["inputTokens"])
+    for step in estimate["steps"]:
+        metrics.count(f"budget_{step}")
+    if estimate["overBudget"]:
+        raise GraderInputError(
+            f"Request needs about {estimate['inputTokens']} input tokens, over the "
+            f"token budget of {estimate['budget']}."
+        )
+
+
+def output_token_limit(
+    question: Dict,
+    options: Dict,
+    *,
+    images: int = 0,
+    answer_text: str = "",
+    compact: bool = COMPACT_OUTPUT,
+) -> int:
+    # Derived max_output_tokens for one answer (0 when disabled).
+    rubric = question.get("rubric") or []
+    return token_budget.output_tokens(
+        len(rubric) if isinstance(rubric, list) else 0,
+        student_markdown=bool(options.get("returnStudentMarkdown")),
+        compact=compact,
+        images=images,
+        answer_text=str(answer_text or ""),
+    )
+
+
+def grade_student(
+    context: Dict,
+    *,
+    json_payload: Dict,
+    image_paths: List[str],
+    base_url: str,
+    api_key: str,
+    temperature: float,
+    max_tokens: Optional[int],
+    prefix_response_id: Optional[str],
+    stream: bool = False,
+    progress: Optional[Callable[[str], None]] = None,
+    cancel_event: Optional[threading.Event] = None,
+    result_key: Optional[str] = None,
+) -> str:
+    model = context["model"]
+    cache_key = context.get("cache_key")
+    plan = fit_token_budget(context, json_payload, image_paths or [])
+    enforce_token_budget(plan)
+    json_payload = plan["json_payload"]
+    image_paths = plan["image_paths"]
+    image_detail = plan["image_detail"]
+    max_tokens = max_tokens or output_token_limit(
+        context["question"],
+        context["options"],
+        images=len(image_paths),
+        answer_text=json_payload.get("studentAnswerText") or "",
+    )
+    student_payload = extract_student_payload(json_payload, context["question"])
+
+    with metrics.phase("image_encode"):
+        images = [prepare_image(path) for path in image_paths or []]
+    metrics.count("images", len(images))
+    metrics.count("image_bytes", sum(image.size for image in images))
+
+    def build_full_payload() -> Dict:
+        # Only needed without a prefix id or on cache fallback.
+        json_text = json.dumps(json_payload, ensure_ascii=False, separators=(",", ":"))
+        full_payload = {
+            "model": model,
+            "input": build_messages(
+                json_text, images, context["system_prompt"], image_detail
+            ),
+            "temperature": temperature,
+        }
+        if max_tokens:
+            full_payload["max_output_tokens"] = max_tokens
+        return full_payload
 
     if prefix_response_id:
-        suffix_messages = build_suffix_messages(student_payload, image_data_urls)
         payload = {
             "model": model,
-            "input": suffix_messages,
-            "temperature": args.temperature,
+            "input": build_suffix_messages(student_payload, images, image_detail),
+            "temperature": temperature,
             "previous_response_id": prefix_response_id,
         }
-        if CACHE_AVAILABLE:
-            payload["caching"] = {"type": "enabled"}
+        payload["caching"] = {"type": "enabled"}
+        if max_tokens:
+            payload["max_output_tokens"] = max_tokens
     else:
-        payload = {
-            "model": model,
-            "input": full_messages,
-            "temperature": args.temperature,
-        }
-
-    if args.max_tokens:
-        payload["max_output_tokens"] = args.max_tokens
+        payload = build_full_payload()
 
     try:
-        response = request_chat_completion(
-            base_url=base_url, api_key=api_key, payload=payload
+        response = request_model_output(
+            base_url=base_url,
+            api_key=api_key,
+            payload=payload,
+            stream=stream,
+            progress=progress,
+            cancel_event=cancel_event,
         )
     except ApiError as exc:
         if prefix_response_id and cache_key and should_fallback_cache_error(exc.body):
-            clear_cached_prefix_id(cache_key)
-            fallback_payload = {
-                "model": model,
-                "input": full_messages,
-                "temperature": args.temperature,
-            }
-            if args.max_tokens:
-                fallback_payload["max_output_tokens"] = args.max_tokens
-            response = request_chat_completion(
-                base_url=base_url, api_key=api_key, payload=fallback_payload
+            record_prefix_fallback(cache_key)
+            response = request_model_output(
+                base_url=base_url,
+                api_key=api_key,
+                payload=build_full_payload(),
+                stream=stream,
+                progress=progress,
+                cancel_event=cancel_event,
             )
         else:
             raise RuntimeError(f"Model call failed: {exc.body}") from exc
+    metrics.record_usage(response.get("usage"))
     content = extract_content(response)
+    if COMPACT_OUTPUT:
+        content = expand_compact_output(content, context["question"])
+    if result_key and result_cache.is_cacheable(content):
+        result_cache.put(result_key, content)
+    emit_progress(progress, "done")
+    return content
+
+
+def fetch_images(image_paths: List[str]) -> List[str]:
+    # Storage refs (s3://, http(s), local keys) become local files; remote
+    # ones are downloaded concurrently.
+    with metrics.phase("image_fetch"):
+        return image_fetch.resolve_images(image_paths)
+
+
+def grade_submission(
+    *,
+    json_payload: Dict,
+    image_paths: List[str],
+    base_url: str,
+    api_key: str,
+    model: str,
+    temperature: float = 0.2,
+    max_tokens: Optional[int] = None,
+    stream: bool = False,
+    progress: Optional[Callable[[str], None]] = None,
+    cancel_event: Optional[threading.Event] = None,
+    cascade_model: Optional[str] = None,
+) -> str:
+    # Grade one student answer and return the raw model output text.
+    if cascade_model is None:
+        cascade_model = CASCADE_MODEL
+    if not isinstance(json_payload, dict):
+        json_payload = {}
+    if len(image_paths or []) > 4:
+        raise GraderInputError("Too many images; provide up to 4.")
+    if is_multi_question_payload(json_payload):
+        return grade_multi_submission(
+            json_payload=json_payload,
+            image_paths=image_paths,
+            base_url=base_url,
+            api_key=api_key,
+            model=model,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=stream,
+            progress=progress,
+            cancel_event=cancel_event,
+        )
+    with metrics.run("grade"):
+        image_paths = fetch_images(image_paths)
+        context = build_grading_context(json_payload, model)
+        fast_context = None
+        if cascade_model and cascade_model != model:
+            fast_context = build_grading_context(json_payload, cascade_model)
+        result_key = build_result_cache_key(
+            dict(context, model=f"{cascade_model}>{model}") if fast_context else context,
+            json_payload=json_payload,
+            image_paths=image_paths,
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+        cached = lookup_cached_result(result_key, progress)
+        if cached is not None:
+            return cached
+        if fast_context:
+            return grade_cascade(
+                fast_context,
+                context,
+                json_payload=json_payload,
+                image_paths=image_paths,
+                base_url=base_url,
+                api_key=api_key,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=stream,
+                progress=progress,
+                cancel_event=cancel_event,
+                result_key=result_key,
+            )
+        prefix_response_id = warm_prefix(context, base_url=base_url, api_key=api_key)
+        emit_progress(progress, "prefix-ready")
+        return grade_student(
+            context,
+            json_payload=json_payload,
+            image_paths=image_paths,
+            base_url=base_url,
+            api_key=api_key,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            prefix_response_id=prefix_response_id,
+            stream=stream,
+            progress=progress,
+            cancel_event=cancel_event,
+            result_key=result_key,
+        )
+
+
+def dry_run_report(
+    *,
+    json_payload: Dict,
+    image_paths: List[str],
+    model: str,
+    temperature: float = 0.2,
+    max_tokens: Optional[int] = None,
+) -> Dict:
+    # What grade_submission would send, without calling the API: the token
+    # estimate after budgeting and the request body sizes in bytes.
+    if not isinstance(json_payload, dict):
+        json_payload = {}
+    if len(image_paths or []) > 4:
+        raise GraderInputError("Too many images; provide up to 4.")
+    image_paths = image_fetch.resolve_images(image_paths)
+    if is_multi_question_payload(json_payload):
+        payload, _entries, plan = build_multi_request(
+            json_payload=json_payload,
+            image_paths=image_paths,
+            model=model,
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+        payload_bytes = {"full": len(JsonBody(payload))}
+        output_tokens = payload.get("max_output_tokens")
+    else:
+        context = build_grading_context(json_payload, model)
+        plan = fit_token_budget(context, json_payload, image_paths)
+        images = [prepare_image(path) for path in plan["image_paths"]]
+        json_text = json.dumps(
+            plan["json_payload"], ensure_ascii=False, separators=(",", ":")
+        )
+        student_payload = extract_student_payload(plan["json_payload"], context["question"])
+        full_input = build_messages(
+            json_text, images, context["system_prompt"], plan["image_detail"]
+        )
+        suffix_input = build_suffix_messages(student_payload, images, plan["image_detail"])
+        payload_bytes = {
+            "full": len(JsonBody({"model": model, "input": full_input})),
+            "suffix": len(JsonBody({"model": model, "input": suffix_input})),
+        }
+        output_tokens = max_tokens or output_token_limit(
+            context["question"],
+            context["options"],
+            images=len(plan["image_paths"]),
+            answer_text=plan["json_payload"].get("studentAnswerText") or "",
+        )
+    return {
+        "model": model,
+        "estimate": dict(
+            plan["estimate"],
+            outputTokens=output_tokens or rate_limit.DEFAULT_OUTPUT_TOKENS,
+        ),
+        "images": len(plan["image_paths"]),
+        "imageDetail": plan["image_detail"],
+        "payloadBytes": payload_bytes,
+    }
+
+
+def cascade_escalation_reason(content: str, min_confidence: float) -> Optional[str]:
+    # Why a first-tier output is not good enough, or None to keep it.
+    parsed = parse_output_json(content)
+    result = parsed.get("result") if parsed else None
+    if not isinstance(result, dict) or not isinstance(result.get("items"), list):
+        return "invalid-output"
+    if result.get("isUncertain") is True:
+        return "uncertain"
+    confidence = result.get("confidence")
+    if isinstance(confidence, bool) or not isinstance(confidence, (int, float)):
+        return "invalid-output"
+    if confidence < min_confidence:
+        return "low-confidence"
+    return None
+
+
+def tag_cascade_output(
+    content: str, *, tier: str, model: str, reason: Optional[str] = None
+) -> str:
+    # Record the tier next to result/extracted; the worker ignores unknown keys.
+    parsed = parse_output_json(content)
+    if parsed is None:
+        return content
+    parsed["cascade"] = {"tier": tier, "model": model}
+    if reason:
+        parsed["cascade"]["escalatedBecause"] = reason
+    return json.dumps(parsed, ensure_ascii=False)
+
+
+def grade_cascade(
+    fast_context: Dict,
+    context: Dict,
+    *,
+    json_payload: Dict,
+    image_paths: List[str],
+    base_url: str,
+    api_key: str,
+    temperature: float,
+    max_tokens: Optional[int],
+    stream: bool = False,
+    progress: Optional[Callable[[str], None]] = None,
+    cancel_event: Optional[threading.Event] = None,
+    result_key: Optional[str] = None,
+) -> str:
+    # Grade with the fast model first and escalate to the main model only
+    # when the answer is uncertain, below minConfidence or not valid. Each
+    # tier warms and reuses its own prefix (the cache key includes the model).
+    def fast_progress(event: str) -> None:
+        # The main model may still run, so "done" waits for the final output.
+        if event != "done":
+            emit_progress(progress, event)
+
+    grade = partial(
+        grade_student,
+        json_payload=json_payload,
+        image_paths=image_paths,
+        base_url=base_url,
+        api_key=api_key,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        stream=stream,
+        cancel_event=cancel_event,
+    )
+    reason = None
+    try:
+        fast_prefix_id = warm_prefix(fast_context, base_url=base_url, api_key=api_key)
+        emit_progress(progress, "prefix-ready")
+        content = grade(
+            fast_context, prefix_response_id=fast_prefix_id, progress=fast_progress
+        )
+        reason = cascade_escalation_reason(
+            content, float(context["options"].get("minConfidence") or 0.75)
+        )
+    except GradingCancelled:
+        raise
+    except Exception as exc:
+        print(f"Cascade first tier failed, escalating: {exc}", file=sys.stderr)
+        reason = "fast-model-error"
+
+    if reason is None:
+        metrics.label("cascade_tier", "fast")
+        content = tag_cascade_output(content, tier="fast", model=fast_context["model"])
+        emit_progress(progress, "done")
+    else:
+        metrics.label("cascade_tier", "strong")
+        metrics.count("cascade_escalations")
+        prefix_response_id = warm_prefix(context, base_url=base_url, api_key=api_key)
+        content = tag_cascade_output(
+            grade(context, prefix_response_id=prefix_response_id, progress=progress),
+            tier="strong",
+            model=context["model"],
+            reason=reason,
+        )
+    if result_key and result_cache.is_cacheable(content):
+        result_cache.put(result_key, content)
+    return content
+
+
+def is_multi_question_payload(json_payload: Dict) -> bool:
+    return isinstance(json_payload.get("questions"), list)
+
+
+def extract_multi_question_entries(json_payload: Dict) -> List[Dict]:
+    # {"questions": [{"submissionVersionId", "studentAnswerText",
+    # "studentAnswerPayload", "answerFormat", "question": {...}}], "options"}
+    entries = []
+    seen = set()
+    for raw in json_payload.get("questions") or []:
+        if not isinstance(raw, dict):
+            raise GraderInputError("Each entry of questions must be an object.")
+        question_payload = extract_question_payload(raw)
+        question_index = question_payload.get("questionIndex")
+        if question_index is None or question_index in seen:
+            raise GraderInputError(
+                "Each entry of questions needs a distinct question.questionIndex."
+            )
+        seen.add(question_index)
+        entries.append(
+            {
+                "questionIndex": question_index,
+                "submissionVersionId": raw.get("submissionVersionId"),
+                "studentAnswerText": raw.get("studentAnswerText") or "",
+                "studentAnswerPayload": raw.get("studentAnswerPayload"),
+                "answerFormat": raw.get("answerFormat"),
+                "question": question_payload,
+            }
+        )
+    if not entries:
+        raise GraderInputError("questions must contain at least one question.")
+    return entries
+
+
+def parse_output_json(content: str) -> Optional[Dict]:
+    # Same leniency as the Node worker: the whole text, else the outermost {...}.
+    trimmed = content.strip()
+    candidates = [trimmed]
+    start, end = trimmed.find("{"), trimmed.rfind("}")
+    if start != -1 and end > start:
+        candidates.append(trimmed[start : end + 1])
+    for candidate in candidates:
+        try:
+            parsed = json.loads(candidate)
+        except ValueError:
+            continue
+        if isinstance(parsed, dict):
+            return parsed
+    return None
+
+
+def expand_compact_reason(reason) -> Dict:
+    if isinstance(reason, dict):
+        return reason
+    if isinstance(reason, (list, tuple)) and reason:
+        return {"code": reason[0], "message": reason[1] if len(reason) > 1 else ""}
+    return {"code": reason, "message": ""}
+
+
+def expand_compact_result(compact: Dict, question: Dict) -> Dict:
+    result = {}
+    for short, name in COMPACT_RESULT_KEYS.items():
+        if short in compact:
+            result[name] = compact[short]
+        elif name in compact:
+            result[name] = compact[name]
+    if isinstance(result.get("isUncertain"), int):
+        result["isUncertain"] = bool(result["isUncertain"])
+    if isinstance(result.get("uncertaintyReasons"), list):
+        result["uncertaintyReasons"] = [
+            expand_compact_reason(reason) for reason in result["uncertaintyReasons"]
+        ]
+    # Items are positional: the n-th entry grades the n-th rubric item.
+    rubric = [item for item in question.get("rubric") or [] if isinstance(item, dict)]
+    items = []
+    for rubric_item, values in zip(rubric, result.get("items") or []):
+        if isinstance(values, dict):
+            items.append(values)
+            continue
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        items.append(
+            {
+                "questionIndex": question.get("questionIndex"),
+                "rubricItemKey": rubric_item.get("rubricItemKey"),
+                "score": values[0] if values else 0,
+                "maxScore": rubric_item.get("maxScore"),
+                "reason": values[1] if len(values) > 1 else "",
+                "uncertaintyScore": values[2] if len(values) > 2 else 0,
+            }
+        )
+    result["items"] = items
+    if "totalScore" not in result:
+        scores = [item.get("score") for item in items]
+        if all(isinstance(score, (int, float)) for score in scores):
+            result["totalScore"] = sum(scores)
+    return result
+
+
+def expand_compact_entry(entry: Dict, question: Dict) -> Dict:
+    # {"r": {...}, "m": "..."} (or a compact object under "result") becomes
+    # {"result": {...}, "extracted": {"studentMarkdown": ...}}; other keys,
+    # such as a packed answer's submissionVersionId, are kept. Regular
+    # outputs are returned unchanged.
+    compact = entry.get("r") if isinstance(entry.get("r"), dict) else entry.get("result")
+    if not isinstance(compact, dict) or "items" in compact or "i" not in compact:
+        return entry
+    expanded = {
+        key: value
+        for key, value in entry.items()
+        if key not in ("r", "m", "result", "extracted")
+    }
+    expanded["result"] = expand_compact_result(compact, question)
+    markdown = entry.get("m")
+    if markdown is None and isinstance(entry.get("extracted"), dict):
+        markdown = entry["extracted"].get("studentMarkdown")
+    if markdown:
+        expanded["extracted"] = {"studentMarkdown": markdown}
+    return expanded
+
+
+def expand_compact_output(content: str, question: Dict) -> str:
+    parsed = parse_output_json(content)
+    if parsed is None:
+        return content
+    expanded = expand_compact_entry(parsed, question)
+    if expanded is parsed:
+        return content
+    metrics.count("compact_outputs")
+    return json.dumps(expanded, ensure_ascii=False)
+
+
+def is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def validate_question_result(entry: Dict, item: Dict) -> Optional[str]:
+    result = item.get("result")
+    if not isinstance(result, dict):
+        return "missing result"
+    extracted = item.get("extracted")
+    if extracted is not None and not isinstance(extracted, dict):
+        return "extracted must be an object"
+    items = result.get("items")
+    if not isinstance(items, list):
+        return "result.items must be an array"
+    # rubricItemKey -> maxScore; every key must be graded exactly once.
+    rubric_max = {
+        str(rubric.get("rubricItemKey")): rubric.get("maxScore")
+        for rubric in entry["question"].get("rubric") or []
+        if isinstance(rubric, dict)
+    }
+    seen = set()
+    for rubric_item in items:
+        if not isinstance(rubric_item, dict):
+            return "result.items entries must be objects"
+        item_index = rubric_item.get("questionIndex")
+        if item_index is not None and str(item_index) != str(entry["questionIndex"]):
+            return f"item belongs to questionIndex {item_index}"
+        key = str(rubric_item.get("rubricItemKey"))
+        if rubric_max and key not in rubric_max:
+            return f"unknown rubricItemKey {key}"
+        if key in seen:
+            return f"duplicate rubricItemKey {key}"
+        seen.add(key)
+        score = rubric_item.get("score")
+        if not is_number(score):
+            return f"score of {key} must be a number"
+        max_score = rubric_max[key] if rubric_max else rubric_item.get("maxScore")
+        if score < 0 or (is_number(max_score) and score > max_score):
+            return f"score {score} of {key} is outside 0..{max_score}"
+    missing = sorted(set(rubric_max) - seen)
+    if missing:
+        return f"missing rubricItemKey {', '.join(missing)}"
+    return None
+
+
+def split_multi_question_output(content: str, entries: List[Dict]) -> str:
+    # Turn {"results": [{"questionIndex", "result", "extracted"}]} into one
+    # single-question output per entry, so each job parses its own content
+    # exactly like a single-question run. Missing or invalid questions are
+    # reported per entry instead of failing the whole submission.
+    parsed = parse_output_json(content)
+    results = parsed.get("results") if parsed else None
+    if not isinstance(results, list):
+        raise RuntimeError("Multi-question output has no results array.")
+    by_index: Dict[str, Dict] = {}
+    for item in results:
+        if isinstance(item, dict) and item.get("questionIndex") is not None:
+            by_index.setdefault(str(item["questionIndex"]), item)
+    split = []
+    for entry in entries:
+        record = {
+            "questionIndex": entry["questionIndex"],
+            "submissionVersionId": entry["submissionVersionId"],
+        }
+        item = by_index.get(str(entry["questionIndex"]))
+        error = "missing from model output" if item is None else validate_question_result(
+            entry, item
+        )
+        if error:
+            record.update({"ok": False, "error": f"Question {entry['questionIndex']}: {error}"})
+        else:
+            single = {"result": item["result"]}
+            if item.get("extracted"):
+                single["extracted"] = item["extracted"]
+            record.update({"ok": True, "content": json.dumps(single, ensure_ascii=False)})
+        split.append(record)
+    metrics.count("multi_question_failed", sum(1 for record in split if not record["ok"]))
+    return json.dumps({"results": split}, ensure_ascii=False)
+
+
+def build_multi_request(
+    *,
+    json_payload: Dict,
+    image_paths: List[str],
+    model: str,
+    temperature: float,
+    max_tokens: Optional[int],
+) -> Tuple[Dict, List[Dict], Dict]:
+    # The single request for every question of a submission, its entries and
+    # the token budget plan.
+    entries = extract_multi_question_entries(json_payload)
+    options_payload = extract_options_payload(json_payload)
+    system_prompt = build_multi_system_prompt(
+        tuple(
+            sorted(
+                {
+                    normalize_question_type(entry["question"].get("questionType"))
+                    for entry in entries
+                }
+            )
+        ),
+        bool(options_payload.get("handwritingRecognition")),
+        str(options_payload.get("gradingStrictness") or "BALANCED"),
+        str(options_payload.get("customGuidance") or ""),
+        bool(options_payload.get("plagiarismDetection", True)),
+        bool(options_payload.get("jumpStepDetection", True)),
+        bool(options_payload.get("stepConflictDetection", True)),
+        bool(options_payload.get("requiredStepDetection", True)),
+    )
+    metrics.count("questions", len(entries))
+    metrics.label("prefix_cache", "disabled")
+
+    plan = token_budget.fit(
+        prefix_text=system_prompt,
+        suffix_text=json.dumps(
+            {"questions": entries, "options": options_payload}, ensure_ascii=False
+        ),
+        answers=[str(entry["studentAnswerText"]) for entry in entries],
+        image_paths=image_paths,
+    )
+    for entry, answer in zip(entries, plan["answers"]):
+        entry["studentAnswerText"] = answer
+    image_paths = plan["image_paths"]
+
+    with metrics.phase("image_encode"):
+        images = [prepare_image(path) for path in image_paths or []]
+    metrics.count("images", len(images))
+    metrics.count("image_bytes", sum(image.size for image in images))
+
+    json_text = json.dumps(
+        {"questions": entries, "options": options_payload},
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    payload = {
+        "model": model,
+        "input": build_messages(json_text, images, system_prompt, plan["image_detail"]),
+        "temperature": temperature,
+    }
+    # The multi-question contract keeps the regular keys.
+    max_tokens = max_tokens or sum(
+        output_token_limit(
+            entry["question"],
+            options_payload,
+            images=len(image_paths),
+            answer_text=entry["studentAnswerText"],
+            compact=False,
+        )
+        for entry in entries
+    )
+    if max_tokens:
+        payload["max_output_tokens"] = max_tokens
+    return payload, entries, plan
+
+
+def grade_multi_submission(
+    *,
+    json_payload: Dict,
+    image_paths: List[str],
+    base_url: str,
+    api_key: str,
+    model: str,
+    temperature: float = 0.2,
+    max_tokens: Optional[int] = None,
+    stream: bool = False,
+    progress: Optional[Callable[[str], None]] = None,
+    cancel_event: Optional[threading.Event] = None,
+) -> str:
+    # Grade every question of one student's submission in a single request:
+    # the shared photos and the system prompt are sent once instead of once
+    # per question. Returns {"results": [{"questionIndex", "ok", "content" |
+    # "error"}]} where each content is a regular single-question output.
+    with metrics.run("grade_multi"):
+        image_paths = fetch_images(image_paths)
+        payload, entries, plan = build_multi_request(
+            json_payload=json_payload,
+            image_paths=image_paths,
+            model=model,
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+        enforce_token_budget(plan)
+        try:
+            response = request_model_output(
+                base_url=base_url,
+                api_key=api_key,
+                payload=payload,
+                stream=stream,
+                progress=progress,
+                cancel_event=cancel_event,
+            )
+        except ApiError as exc:
+            raise RuntimeError(f"Model call failed: {exc.body}") from exc
+        metrics.record_usage(response.get("usage"))
+        content = split_multi_question_output(extract_content(response), entries)
+        emit_progress(progress, "done")
+        return content
+
+
+def is_packable(context: Dict, item: Dict) -> bool:
+    # Short text answers only: no images, and a submissionVersionId to map
+    # the packed result back.
+    question_type = normalize_question_type(context["question"].get("questionType"))
+    return (
+        question_type in PACK_QUESTION_TYPES
+        and not item["images"]
+        and bool(item["payload"].get("submissionVersionId"))
+    )
+
+
+def grade_packed(
+    context: Dict,
+    *,
+    items: List[Dict],
+    base_url: str,
+    api_key: str,
+    temperature: float,
+    max_tokens: Optional[int],
+    prefix_response_id: Optional[str],
+    stream: bool = False,
+) -> Dict[str, str]:
+    # Grade several text-only answers to the same question in one call: the
+    # answers go into one suffix after the shared question prefix. Returns
+    # the valid single-question outputs by submissionVersionId; answers that
+    # are missing or fail validation are left for the caller to grade alone.
+    model = context["model"]
+    cache_key = context.get("cache_key")
+    answers = [
+        extract_student_payload(item["payload"], context["question"]) for item in items
+    ]
+    output_limit = max_tokens * len(items) if max_tokens else sum(
+        output_token_limit(
+            context["question"],
+            context["options"],
+            answer_text=item["payload"].get("studentAnswerText") or "",
+        )
+        for item in items
+    )
+
+    def build_full_payload() -> Dict:
+        json_text = json.dumps(
+            {
+                "question": context["question"],
+                "options": context["options"],
+                "answers": answers,
+            },
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+        full_payload = {
+            "model": model,
+            "input": build_messages(
+                json_text, [], context["system_prompt"] + "\n\n" + PACKED_ANSWERS_PROMPT
+            ),
+            "temperature": temperature,
+        }
+        if output_limit:
+            full_payload["max_output_tokens"] = output_limit
+        return full_payload
+
+    if prefix_response_id:
+        user_text = PACKED_ANSWERS_PROMPT + "\ns:\n" + json.dumps(
+            {"answers": answers}, ensure_ascii=False
+        )
+        payload = {
+            "model": model,
+            "input": [
+                {"role": "user", "content": [{"type": "input_text", "text": user_text}]}
+            ],
+            "temperature": temperature,
+            "previous_response_id": prefix_response_id,
+        }
+        payload["caching"] = {"type": "enabled"}
+        if output_limit:
+            payload["max_output_tokens"] = output_limit
+    else:
+        payload = build_full_payload()
+
+    try:
+        response = request_model_output(
+            base_url=base_url, api_key=api_key, payload=payload, stream=stream
+        )
+    except ApiError as exc:
+        if not (prefix_response_id and cache_key and should_fallback_cache_error(exc.body)):
+            raise RuntimeError(f"Model call failed: {exc.body}") from exc
+        record_prefix_fallback(cache_key)
+        response = request_model_output(
+            base_url=base_url, api_key=api_key, payload=build_full_payload(), stream=stream
+        )
+    metrics.record_usage(response.get("usage"))
+
+    parsed = parse_output_json(extract_content(response))
+    results = parsed.get("results") if parsed else None
+    by_id: Dict[str, Dict] = {}
+    for result in results if isinstance(results, list) else []:
+        if isinstance(result, dict) and result.get("submissionVersionId"):
+            by_id.setdefault(str(result["submissionVersionId"]), result)
+    entry = {
+        "questionIndex": context["question"].get("questionIndex"),
+        "question": context["question"],
+    }
+    contents = {}
+    for item in items:
+        submission_version_id = str(item["payload"]["submissionVersionId"])
+        result = by_id.get(submission_version_id)
+        if result is not None and COMPACT_OUTPUT:
+            result = expand_compact_entry(result, context["question"])
+        if result is None or validate_question_result(entry, result):
+            continue
+        single = {"result": result["result"]}
+        if result.get("extracted"):
+            single["extracted"] = result["extracted"]
+        content = json.dumps(single, ensure_ascii=False)
+        if item.get("result_key") and result_cache.is_cacheable(content):
+            result_cache.put(item["result_key"], content)
+        contents[submission_version_id] = content
+    metrics.count("packed_answers", len(items))
+    metrics.count("pack_fallbacks", len(items) - len(contents))
+    return contents
+
+
+def load_batch_manifest(path: str) -> List[Dict]:
+    # One job per line: {"json": path} or {"payload": {...}}, plus "images".
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            item = {"line": line_no, "error": None, "payload": {}, "images": []}
+            try:
+                entry = json.loads(line)
+                if not isinstance(entry, dict):
+                    raise ValueError("manifest entry must be an object")
+                payload = entry.get("payload")
+                if payload is None and entry.get("json"):
+                    payload = load_json_payload(str(entry["json"]))
+                item["payload"] = payload if isinstance(payload, dict) else {}
+                item["images"] = [str(image) for image in entry.get("images") or []]
+                if len(item["images"]) > 4:
+                    raise GraderInputError("Too many images; provide up to 4.")
+            except Exception as exc:
+                item["error"] = f"Invalid manifest line {line_no}: {exc}"
+            item["submissionVersionId"] = item["payload"].get("submissionVersionId")
+            items.append(item)
+    return items
+
+
+def run_batch(
+    *,
+    manifest_path: str,
+    out_path: Optional[str],
+    base_url: str,
+    api_key: str,
+    model: str,
+    temperature: float,
+    max_tokens: Optional[int],
+    concurrency: int,
+    stream: bool = False,
+    pack_size: int = PACK_SIZE,
+) -> int:
+    # Grade a whole manifest: one system prompt and one prefix warmup per
+    # distinct question, then every student suffix through a bounded pool.
+    # With pack_size > 1, short text answers are graded pack_size per call.
+    items = load_batch_manifest(manifest_path)
+    out = open(out_path, "w", encoding="utf-8") if out_path else sys.stdout
+    write_lock = threading.Lock()
+    failures = 0
+
+    def write_result(
+        item: Dict, content: Optional[str], error: Optional[str], cached: bool = False
+    ) -> None:
+        nonlocal failures
+        record = {"submissionVersionId": item.get("submissionVersionId")}
+        if error is None:
+            record.update({"ok": True, "content": content, "cached": cached})
+        else:
+            record.update({"ok": False, "line": item["line"], "error": error})
+        with write_lock:
+            if error is not None:
+                failures += 1
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+
+    groups: Dict[str, List[Dict]] = {}
+    multi_items: List[Dict] = []
+    for item in items:
+        if item["error"]:
+            write_result(item, None, item["error"])
+            continue
+        if is_multi_question_payload(item["payload"]):
+            multi_items.append(item)
+            continue
+        group_key = json.dumps(
+            [
+                extract_question_payload(item["payload"]),
+                extract_options_payload(item["payload"]),
+            ],
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+        groups.setdefault(group_key, []).append(item)
+
+    jobs = [
+        (build_grading_context(group[0]["payload"], model), group)
+        for group in groups.values()
+    ]
+
+    def resolve(item: Dict) -> bool:
+        # Storage refs become local files, as in grade_submission, before
+        # the result cache key hashes them.
+        try:
+            item["images"] = fetch_images(item["images"])
+        except Exception as exc:
+            write_result(item, None, str(exc))
+            return False
+        return True
+
+    def lookup(context: Dict, item: Dict) -> bool:
+        # Resolve the result cache first so fully cached questions skip warmup.
+        try:
+            item["result_key"] = build_result_cache_key(
+                context,
+                json_payload=item["payload"],
+                image_paths=item["images"],
+                temperature=temperature,
+                max_tokens=max_tokens,
+            )
+        except OSError as exc:
+            write_result(item, None, str(exc))
+            return True
+        cached = lookup_cached_result(item["result_key"])
+        if cached is None:
+            return False
+        write_result(item, cached, None, cached=True)
+        return True
+
+    def warm_group(context: Dict):
+        try:
+            with metrics.run("warm"):
+                return warm_prefix(context, base_url=base_url, api_key=api_key), None
+        except Exception as exc:
+            return None, str(exc)
+
+    def grade(context: Dict, prefix_response_id: Optional[str], item: Dict) -> None:
+        try:
+            with metrics.run("batch"):
+                content = grade_student(
+                    context,
+                    json_payload=item["payload"],
+                    image_paths=item["images"],
+                    base_url=base_url,
+                    api_key=api_key,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    prefix_response_id=prefix_response_id,
+                    stream=stream,
+                    result_key=item.get("result_key"),
+                )
+        except Exception as exc:
+            write_result(item, None, str(exc))
+            return
+        write_result(item, content, None)
+
+    def grade_pack(
+        context: Dict, prefix_response_id: Optional[str], pack: List[Dict]
+    ) -> None:
+        contents: Dict[str, str] = {}
+        try:
+            with metrics.run("batch_pack"):
+                contents = grade_packed(
+                    context,
+                    items=pack,
+                    base_url=base_url,
+                    api_key=api_key,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    prefix_response_id=prefix_response_id,
+                    stream=stream,
+                )
+        except Exception as exc:
+            print(f"Packed grading failed, grading one by one: {exc}", file=sys.stderr)
+        for item in pack:
+            content = contents.get(str(item["payload"]["submissionVersionId"]))
+            if content is None:
+                grade(context, prefix_response_id, item)
+            else:
+                write_result(item, content, None)
+
+    def grade_multi(item: Dict) -> None:
+        try:
+            content = grade_multi_submission(
+                json_payload=item["payload"],
+                image_paths=item["images"],
+                base_url=base_url,
+                api_key=api_key,
+                model=model,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=stream,
+            )
+        except Exception as exc:
+            write_result(item, None, str(exc))
+            return
+        write_result(item, content, None)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            fetched = []
+            for context, group in jobs:
+                resolved = list(executor.map(resolve, group))
+                remaining = [item for item, ok in zip(group, resolved) if ok]
+                if remaining:
+                    fetched.append((context, remaining))
+            jobs = fetched
+            if result_cache.enabled():
+                uncached = []
+                for context, group in jobs:
+                    hits = list(executor.map(partial(lookup, context), group))
+                    remaining = [item for item, hit in zip(group, hits) if not hit]
+                    if remaining:
+                        uncached.append((context, remaining))
+                jobs = uncached
+            warmed = list(executor.map(warm_group, [context for context, _group in jobs]))
+            futures = [executor.submit(grade_multi, item) for item in multi_items]
+            for (context, group), (prefix_response_id, warm_error) in zip(jobs, warmed):
+                packable = []
+                for item in group:
+                    if warm_error:
+                        write_result(item, None, warm_error)
+                        continue
+                    if pack_size > 1 and is_packable(context, item):
+                        packable.append(item)
+                        continue
+                    futures.append(
+                        executor.submit(grade, context, prefix_response_id, item)
+                    )
+                # Duplicate ids cannot be told apart in a packed reply.
+                seen = set()
+                pack: List[Dict] = []
+                for item in packable:
+                    submission_version_id = str(item["payload"]["submissionVersionId"])
+                    if submission_version_id in seen:
+                        futures.append(
+                            executor.submit(grade, context, prefix_response_id, item)
+                        )
+                        continue
+                    seen.add(submission_version_id)
+                    pack.append(item)
+                for start in range(0, len(pack), pack_size):
+                    chunk = pack[start : start + pack_size]
+                    if len(chunk) == 1:
+                        futures.append(
+                            executor.submit(grade, context, prefix_response_id, chunk[0])
+                        )
+                        continue
+                    futures.append(
+                        executor.submit(grade_pack, context, prefix_response_id, chunk)
+                    )
+            for future in futures:
+                future.result()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(
+        f"Batch finished: {len(items)} jobs, {len(groups)} questions, {failures} failed.",
+        file=sys.stderr,
+    )
+    return 1 if failures else 0
+
+
+def extract_text(value) -> str:
+    # Same flattening as the Node worker's extractText for snapshot text blocks.
+    if not value:
+        return ""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, dict) and isinstance(value.get("text"), str):
+        return value["text"]
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def resolve_grading_mode(question: Dict) -> str:
+    policy = question.get("gradingPolicy")
+    if isinstance(policy, dict) and str(policy.get("mode") or "").upper() == "AUTO_RULE":
+        return "AUTO_RULE"
+    question_type = str(question.get("questionType") or "SHORT_ANSWER").upper()
+    if question_type in {"SINGLE_CHOICE", "MULTI_CHOICE", "JUDGE", "FILL_BLANK"}:
+        return "AUTO_RULE"
+    return "AI_RUBRIC"
+
+
+def build_snapshot_payloads(snapshot: Dict, options: Dict) -> List[Dict]:
+    # Build the grader input the worker would send for each AI_RUBRIC question
+    # of an AssignmentSnapshotEntity, minus the student part, so the prefix
+    # cache keys match the ones real jobs will look up.
+    questions = snapshot.get("questions")
+    payloads = []
+    for question in questions if isinstance(questions, list) else []:
+        if not isinstance(question, dict) or resolve_grading_mode(question) != "AI_RUBRIC":
+            continue
+        payloads.append(
+            {
+                "question": {
+                    "questionId": question.get("questionId"),
+                    "questionIndex": question.get("questionIndex"),
+                    "questionType": question.get("questionType") or "SHORT_ANSWER",
+                    "questionSchema": question.get("questionSchema"),
+                    "gradingPolicy": question.get("gradingPolicy"),
+                    "prompt": extract_text(question.get("prompt")),
+                    "standardAnswer": extract_text(question.get("standardAnswer")),
+                    "rubric": question.get("rubric") or [],
+                },
+                "options": {
+                    "returnStudentMarkdown": bool(options.get("returnStudentMarkdown"))
+                    or bool(options.get("plagiarismDetection"))
+                    or bool(options.get("handwritingRecognition")),
+                    "minConfidence": options.get("minConfidence", 0.75),
+                    "handwritingRecognition": options.get("handwritingRecognition", False),
+                    "plagiarismDetection": options.get("plagiarismDetection", True),
+                    "jumpStepDetection": options.get("jumpStepDetection", True),
+                    "stepConflictDetection": options.get("stepConflictDetection", True),
+                    "requiredStepDetection": options.get("requiredStepDetection", True),
+                    "gradingStrictness": options.get("gradingStrictness") or "BALANCED",
+                    "customGuidance": options.get("customGuidance") or "",
+                },
+            }
+        )
+    return payloads
+
+
+def run_warm(
+    *,
+    snapshot_path: str,
+    base_url: str,
+    api_key: str,
+    model: str,
+    concurrency: int,
+) -> int:
+    # Warm the prefix cache for every AI_RUBRIC question of a snapshot so the
+    # first submission after publish does not pay the warmup. The file is
+    # either the snapshot itself ({"questions": [...]}) or
+    # {"snapshot": {...}, "options": {...}} with the assignment's AI options.
+    document = load_json_payload(snapshot_path)
+    if not isinstance(document, dict):
+        raise GraderInputError("Snapshot file must contain a snapshot object.")
+    snapshot = document.get("snapshot") if "snapshot" in document else document
+    options = document.get("options") or {}
+    if not isinstance(snapshot, dict) or not isinstance(options, dict):
+        raise GraderInputError("Snapshot file must contain a snapshot object.")
+    payloads = build_snapshot_payloads(snapshot, options)
+    for json_payload in payloads:
+        # Labels the warmed ids in the prefix cache statistics.
+        json_payload["assignmentSnapshotId"] = document.get("snapshotId")
+
+    def warm_question(json_payload: Dict) -> Dict:
+        question = json_payload["question"]
+        report = {
+            "questionId": question.get("questionId"),
+            "questionIndex": question.get("questionIndex"),
+        }
+        context = build_grading_context(json_payload, model)
+        cache_key = context.get("cache_key")
+        if not cache_key:
+            report["status"] = "skipped"
+            return report
+        if get_cached_prefix_id(cache_key):
+            report["status"] = "hit"
+            return report
+        try:
+            with metrics.run("warm"):
+                response_id = warm_prefix(context, base_url=base_url, api_key=api_key)
+        except Exception as exc:
+            report.update({"status": "failed", "error": str(exc)})
+            return report
+        report["status"] = "warmed" if response_id else "skipped"
+        return report
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        reports = list(executor.map(warm_question, payloads))
+    summary = {
+        status: sum(1 for report in reports if report["status"] == status)
+        for status in ("warmed", "hit", "failed", "skipped")
+    }
+    print(json.dumps({"questions": reports, **summary}, ensure_ascii=False))
+    return 1 if summary["failed"] else 0
+
+
+def warm(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="grader.py warm",
+        description="Warm the prefix cache for every AI_RUBRIC question of a snapshot.",
+    )
+    parser.add_argument(
+        "--snapshot",
+        required=True,
+        help="Path to an assignment snapshot JSON file.",
+    )
+    parser.add_argument("--model", help="Model name override.")
+    parser.add_argument("--base-url", help="API base URL override.")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=int(os.getenv("AI_GRADING_WARM_CONCURRENCY", "8")),
+        help="Questions warmed at the same time.",
+    )
+    args = parser.parse_args(argv)
+
+    api_key = resolve_api_key()
+    key_error = validate_api_key(api_key)
+    if key_error:
+        print(key_error, file=sys.stderr)
+        return 2
+    try:
+        return run_warm(
+            snapshot_path=args.snapshot,
+            base_url=resolve_base_url(args.base_url),
+            api_key=api_key,
+            model=resolve_model(args.model),
+            concurrency=args.concurrency,
+        )
+    except GraderInputError as exc:
+        print(str(exc), file=sys.stderr)
+        return 2
+
+
+def prefix_stats_report(client, assignment_snapshot_id: Optional[str] = None) -> Dict:
+    # Hit / miss / fallback counts per cached prefix (one per question,
+    # options and model), busiest first.
+    now = time.time()
+    prefixes = []
+    for stats_key in client.scan_iter(match=f"{REDIS_STATS_PREFIX}*", count=500):
+        stats = client.hgetall(stats_key)
+        if assignment_snapshot_id and stats.get("assignmentSnapshotId") != assignment_snapshot_id:
+            continue
+        cache_key = stats_key[len(REDIS_STATS_PREFIX) :]
+        ttl = client.ttl(f"{REDIS_KEY_PREFIX}{cache_key}")
+        counts = {
+            name: int(stats.get(name) or 0)
+            for name in ("hits", "misses", "fallbacks", "refreshes")
+        }
+        lookups = counts["hits"] + counts["misses"]
+        report = {
+            "cacheKey": cache_key,
+            "assignmentSnapshotId": stats.get("assignmentSnapshotId"),
+            "questionId": stats.get("questionId"),
+            "questionIndex": stats.get("questionIndex"),
+            "model": stats.get("model"),
+            **counts,
+            "hitRate": round(counts["hits"] / lookups, 4) if lookups else None,
+            "cached": ttl != -2,
+            "idHits": int(stats.get("idHits") or 0),
+            "idAgeSeconds": None,
+            "idTtlSeconds": ttl if ttl >= 0 else None,
+        }
+        if report["cached"] and stats.get("createdAt"):
+            report["idAgeSeconds"] = int(now - float(stats["createdAt"]))
+        prefixes.append(report)
+    prefixes.sort(key=lambda report: report["hits"] + report["misses"], reverse=True)
+    totals = {
+        name: sum(report[name] for report in prefixes)
+        for name in ("hits", "misses", "fallbacks", "refreshes")
+    }
+    return {"prefixes": prefixes, **totals}
+
+
+def prefix_stats(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="grader.py prefix-stats",
+        description="Print prefix cache hit/miss/fallback statistics per question.",
+    )
+    parser.add_argument(
+        "--assignment-snapshot-id", help="Only prefixes warmed for this snapshot."
+    )
+    args = parser.parse_args(argv)
+    client = get_redis_client()
+    if not client:
+        print(
+            "prefix-stats needs Redis (AI_GRADING_PREFIX_CACHE_REDIS_URL or REDIS_URL).",
+            file=sys.stderr,
+        )
+        return 2
+    print(
+        json.dumps(
+            prefix_stats_report(client, args.assignment_snapshot_id), ensure_ascii=False
+        )
+    )
+    return 0
+
+
+PLAGIARISM_INDEX_OPS = {
+    "similarity-add",
+    "similarity-query",
+    "image-hash-add",
+    "image-hash-query",
+}
+
+
+def handle_grade_request(
+    request: Dict,
+    *,
+    reply: Callable[[Dict], None],
+    cancel_event: threading.Event,
+    base_url: str,
+    api_key: str,
+    default_model: str,
+) -> None:
+    # One grading request of serve/consume mode: progress events as
+    # {"id", "event"}, then {"id", "ok", "content" | "error"}.
+    request_id = request.get("id")
+    events: List[str] = []
+
+    def progress(event: str) -> None:
+        events.append(event)
+        reply({"id": request_id, "event": event})
+
+    try:
+        json_payload = request.get("payload")
+        if json_payload is None and request.get("json"):
+            json_payload = load_json_payload(str(request["json"]))
+        temperature = request.get("temperature")
+        content = grade_submission(
+            json_payload=json_payload or {},
+            image_paths=[str(path) for path in request.get("images") or []],
+            base_url=base_url,
+            api_key=api_key,
+            model=request.get("model") or default_model,
+            temperature=0.2 if temperature is None else float(temperature),
+            max_tokens=request.get("maxTokens"),
+            stream=bool(request.get("stream", STREAM_ENABLED)),
+            progress=progress,
+            cancel_event=cancel_event,
+            cascade_model=request.get("cascadeModel"),
+        )
+        reply(
+            {
+                "id": request_id,
+                "ok": True,
+                "content": content,
+                "cached": "cache-hit" in events,
+            }
+        )
+    except ApiError as exc:
+        reply({"id": request_id, "ok": False, "status": exc.status, "error": str(exc)})
+    except Exception as exc:
+        reply({"id": request_id, "ok": False, "error": str(exc)})
+
+
+def handle_index_request(request: Dict, reply: Callable[[Dict], None]) -> None:
+    # Plagiarism index operations; the content is a JSON string.
+    request_id = request.get("id")
+    try:
+        assignment_id = str(request.get("assignmentId") or "")
+        question_id = str(request.get("questionId") or "")
+        if not assignment_id or not question_id:
+            raise GraderInputError("assignmentId and questionId are required.")
+        op = str(request.get("op"))
+        index = image_hash if op.startswith("image-hash-") else similarity
+        if op.endswith("-add"):
+            result = index.add(assignment_id, question_id, list(request.get("entries") or []))
+        else:
+            result = index.query(
+                assignment_id,
+                question_id,
+                request.get("entry") or {},
+                threshold=float(request.get("threshold", 0.88)),
+                limit=int(request.get("limit") or 20),
+                insert=bool(request.get("insert", True)),
+            )
+        reply({"id": request_id, "ok": True, "content": json.dumps(result, ensure_ascii=False)})
+    except Exception as exc:
+        reply({"id": request_id, "ok": False, "error": str(exc)})
+
+
+def serve(argv: List[str]) -> int:
+    # Long-lived mode: one JSON request per stdin line, one JSON reply per
+    # stdout line. Requests run concurrently and replies carry the request id,
+    # so they may come back out of order. Progress events are written as
+    # {"id", "event"} lines and {"op": "cancel", "id"} aborts a request.
+    # {"op": "similarity-add" | "similarity-query"} requests use the text
+    # plagiarism index (similarity.py) and "image-hash-add" | "image-hash-query"
+    # the photo index (image_hash.py); their content is a JSON string.
+    parser = argparse.ArgumentParser(
+        prog="grader.py serve",
+        description="Grade many jobs in one process over JSON lines on stdin/stdout.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=int(os.getenv("AI_GRADING_SERVE_CONCURRENCY", "4")),
+        help="Maximum number of jobs graded at the same time.",
+    )
+    args = parser.parse_args(argv)
+
+    api_key = resolve_api_key()
+    key_error = validate_api_key(api_key)
+    if key_error:
+        print(key_error, file=sys.stderr)
+        return 2
+    base_url = resolve_base_url()
+    default_model = resolve_model()
+    concurrency = max(1, args.concurrency)
+    write_lock = threading.Lock()
+
+    def write_message(message: Dict) -> None:
+        line = json.dumps(message, ensure_ascii=False)
+        with write_lock:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+
+    cancel_events: Dict[str, threading.Event] = {}
+
+    def handle(request: Dict, cancel_event: threading.Event) -> None:
+        try:
+            handle_grade_request(
+                request,
+                reply=write_message,
+                cancel_event=cancel_event,
+                base_url=base_url,
+                api_key=api_key,
+                default_model=default_model,
+            )
+        finally:
+            cancel_events.pop(str(request.get("id")), None)
+
+    write_message({"event": "ready", "pid": os.getpid(), "concurrency": concurrency})
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for line in sys.stdin:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                write_message({"id": None, "ok": False, "error": "Invalid JSON request."})
+                continue
+            if not isinstance(request, dict):
+                write_message({"id": None, "ok": False, "error": "Request must be an object."})
+                continue
+            if request.get("op") == "cancel":
+                cancel_event = cancel_events.get(str(request.get("id")))
+                if cancel_event is not None:
+                    cancel_event.set()
+                continue
+            if request.get("op") in PLAGIARISM_INDEX_OPS:
+                executor.submit(handle_index_request, request, write_message)
+                continue
+            cancel_event = threading.Event()
+            cancel_events[str(request.get("id"))] = cancel_event
+            executor.submit(handle, request, cancel_event)
+    return 0
+
+
+def consume(argv: List[str]) -> int:
+    # Grade requests popped from a Redis list (queue_consumer.py) instead of
+    # stdin; replies have the same shape as in serve mode.
+    parser = argparse.ArgumentParser(
+        prog="grader.py consume",
+        description="Grade jobs popped from the Redis grader request queue.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=int(os.getenv("AI_GRADING_CONSUMER_CONCURRENCY", "8")),
+        help="Maximum number of jobs graded at the same time.",
+    )
+    args = parser.parse_args(argv)
+
+    api_key = resolve_api_key()
+    key_error = validate_api_key(api_key)
+    if key_error:
+        print(key_error, file=sys.stderr)
+        return 2
+    base_url = resolve_base_url()
+    default_model = resolve_model()
+
+    def handle(
+        request: Dict, reply: Callable[[Dict], None], cancel_event: threading.Event
+    ) -> None:
+        if request.get("op") in PLAGIARISM_INDEX_OPS:
+            handle_index_request(request, reply)
+            return
+        handle_grade_request(
+            request,
+            reply=reply,
+            cancel_event=cancel_event,
+            base_url=base_url,
+            api_key=api_key,
+            default_model=default_model,
+        )
+
+    return queue_consumer.run(handle, concurrency=args.concurrency)
+
+
+def main() -> int:
+    if hedging.ENABLED or (len(sys.argv) > 1 and sys.argv[1] in ("serve", "consume")):
+        # Hedging and job cancellation both stop requests mid-flight.
+        require_abortable()
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        return serve(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "consume":
+        return consume(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "warm":
+        return warm(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "prefix-stats":
+        return prefix_stats(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(
+        description="Send a JSON rubric + handwritten solution image to Doubao (ARK)."
+    )
+    parser.add_argument("--json", help="Path to the JSON input file, or - for stdin.")
+    parser.add_argument(
+        "--batch",
+        help="Path to a JSONL manifest; grade every line and write JSONL results.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=int(os.getenv("AI_GRADING_BATCH_CONCURRENCY", "8")),
+        help="Concurrent model requests in --batch mode.",
+    )
+    parser.add_argument(
+        "--image",
+        action="append",
+        default=[],
+        help="Handwritten solution image: a path or storage ref (repeat up to 4).",
+    )
+    parser.add_argument("--model", help="Model name override.")
+    parser.add_argument("--base-url", help="API base URL override.")
+    parser.add_argument("--temperature", type=float, default=0.2)
+    parser.add_argument(
+        "--cascade-model",
+        default=CASCADE_MODEL,
+        help="Grade with this faster model first; escalate uncertain answers to --model.",
+    )
+    parser.add_argument(
+        "--pack-size",
+        type=int,
+        default=PACK_SIZE,
+        help="In --batch mode, grade up to this many short text answers per model call.",
+    )
+    parser.add_argument("--max-tokens", type=int, help="Optional max_tokens.")
+    parser.add_argument("--out", help="Optional output file path.")
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        default=STREAM_ENABLED,
+        help="Stream the model response and stop once the JSON result is complete.",
+    )
+    parser.add_argument(
+        "--progress-fd",
+        type=int,
+        help="File descriptor that receives JSON progress events, one per line.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print the token estimate and request size instead of calling the API.",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="DIR",
+        help="Write cProfile stats and a tracemalloc report for this run to DIR.",
+    )
+    args = parser.parse_args()
+    if not args.json and not args.batch:
+        parser.error("one of --json or --batch is required")
+    if args.dry_run:
+        if args.batch:
+            parser.error("--dry-run needs --json")
+        return run_dry_run(args)
+
+    api_key = resolve_api_key()
+    key_error = validate_api_key(api_key)
+    if key_error:
+        print(key_error, file=sys.stderr)
+        return 2
+
+    with metrics.profile(args.profile):
+        return run_cli(args, api_key)
+
+
+def run_dry_run(args: argparse.Namespace) -> int:
+    try:
+        report = dry_run_report(
+            json_payload=load_json_payload(args.json),
+            image_paths=args.image or [],
+            model=resolve_model(args.model),
+            temperature=args.temperature,
+            max_tokens=args.max_tokens,
+        )
+    except GraderInputError as exc:
+        print(str(exc), file=sys.stderr)
+        return 2
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+def run_cli(args: argparse.Namespace, api_key: str) -> int:
+    if args.batch:
+        return run_batch(
+            manifest_path=args.batch,
+            out_path=args.out,
+            base_url=resolve_base_url(args.base_url),
+            api_key=api_key,
+            model=resolve_model(args.model),
+            temperature=args.temperature,
+            max_tokens=args.max_tokens,
+            concurrency=args.concurrency,
+            stream=args.stream,
+            pack_size=args.pack_size,
+        )
+
+    progress = None
+    progress_file = None
+    if args.progress_fd is not None:
+        progress_file = os.fdopen(args.progress_fd, "w", buffering=1, encoding="utf-8")
+
+        def write_progress(event: str) -> None:
+            progress_file.write(json.dumps({"event": event}) + "\n")
+
+        progress = write_progress
+
+    try:
+        content = grade_submission(
+            json_payload=load_json_payload(args.json),
+            image_paths=args.image or [],
+            base_url=resolve_base_url(args.base_url),
+            api_key=api_key,
+            model=resolve_model(args.model),
+            temperature=args.temperature,
+            max_tokens=args.max_tokens,
+            stream=args.stream,
+            progress=progress,
+            cascade_model=args.cascade_model,
+        )
+    except GraderInputError as exc:
+        print(str(exc), file=sys.stderr)
+        return 2
+    finally:
+        if progress_file is not None:
+            progress_file.close()
 
     if args.out:
         with open(args.out, "w", encoding="utf-8") as f:
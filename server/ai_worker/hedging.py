@@ -0,0 +1,304 @@
+"""Hedged model calls to cut tail latency.
+
+With ``AI_GRADING_HEDGE=true``, a model call that has not answered (or, when
+streaming, not produced its first token) after the
+``AI_GRADING_HEDGE_PERCENTILE`` of recent latencies gets a duplicate request.
+Whichever attempt completes first wins and the other one is cancelled: its
+connection is closed, so a plain (non-streamed) call is only hedged on a
+transport that can abort a request in flight (see ``http_transport``).
+
+Recent latencies are kept per kind (``response`` / ``first_token``) in a
+Redis list shared by every grader process, or in a JSON file under the temp
+directory without Redis, so one-shot ``grader.py`` invocations learn from each
+other. Hedges are capped by a budget: at most
+``AI_GRADING_HEDGE_BUDGET_PERCENT`` of the requests of the current minute,
+plus ``AI_GRADING_HEDGE_BUDGET_BURST``. Runs count ``hedges`` and
+``hedge_wins`` in their metrics.
+"""
+import contextvars
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Optional, TypeVar
+
+try:
+    import fcntl
+except Exception:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+import capabilities
+import metrics
+
+
+ENABLED = os.getenv("AI_GRADING_HEDGE", "false").lower() == "true"
+PERCENTILE = float(os.getenv("AI_GRADING_HEDGE_PERCENTILE", "95"))
+MIN_DELAY_SECONDS = float(os.getenv("AI_GRADING_HEDGE_MIN_DELAY_SECONDS", "1"))
+MIN_SAMPLES = int(os.getenv("AI_GRADING_HEDGE_MIN_SAMPLES", "20"))
+WINDOW_SIZE = int(os.getenv("AI_GRADING_HEDGE_WINDOW", "500"))
+BUDGET_PERCENT = float(os.getenv("AI_GRADING_HEDGE_BUDGET_PERCENT", "5"))
+BUDGET_BURST = int(os.getenv("AI_GRADING_HEDGE_BUDGET_BURST", "1"))
+REDIS_URL = (
+    os.getenv("AI_GRADING_HEDGE_REDIS_URL")
+    or os.getenv("AI_GRADING_PREFIX_CACHE_REDIS_URL")
+    or os.getenv("REDIS_URL", "")
+)
+STATE_PATH = os.getenv("AI_GRADING_HEDGE_STATE_FILE") or os.path.join(
+    tempfile.gettempdir(), "ai-grading-hedge-latency.json"
+)
+REDIS_KEY_PREFIX = "ai-grading:hedge:"
+# Re-read the shared window at most this often per process.
+WINDOW_REFRESH_SECONDS = 10.0
+POLL_SECONDS = 0.2
+
+T = TypeVar("T")
+
+_window_cache: Dict[str, tuple] = {}
+_window_lock = threading.Lock()
+_local_budget: Dict[str, int] = {}
+_budget_lock = threading.Lock()
+
+
+class AttemptProgress:
+    # Set when an attempt produced its first output (or finished).
+    def __init__(self):
+        self.event = threading.Event()
+        self.at: Optional[float] = None
+
+    def set(self) -> None:
+        if self.at is None:
+            self.at = time.perf_counter()
+        self.event.set()
+
+
+def get_redis_client():
+    return capabilities.redis_client(REDIS_URL)
+
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def update_state_file(update: Optional[Callable[[Dict], None]] = None) -> Dict:
+    # Read (and optionally modify) the shared window file under an exclusive lock.
+    os.makedirs(os.path.dirname(os.path.abspath(STATE_PATH)), exist_ok=True)
+    with open(STATE_PATH, "a+", encoding="utf-8") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        raw = f.read()
+        try:
+            state = json.loads(raw) if raw.strip() else {}
+        except ValueError:
+            state = {}
+        if update is not None:
+            update(state)
+            f.seek(0)
+            f.truncate()
+            json.dump(state, f)
+    return state
+
+
+def load_window(kind: str) -> List[float]:
+    client = get_redis_client()
+    if client:
+        try:
+            return [float(value) for value in client.lrange(f"{REDIS_KEY_PREFIX}{kind}", 0, -1)]
+        except Exception:
+            pass
+    try:
+        return [float(value) for value in update_state_file().get(kind) or []]
+    except (OSError, TypeError, ValueError):
+        return []
+
+
+def record_latency(kind: str, seconds: float) -> None:
+    client = get_redis_client()
+    if client:
+        try:
+            key = f"{REDIS_KEY_PREFIX}{kind}"
+            pipe = client.pipeline()
+            pipe.lpush(key, round(seconds, 3))
+            pipe.ltrim(key, 0, WINDOW_SIZE - 1)
+            pipe.execute()
+            return
+        except Exception:
+            pass
+
+    def append(state: Dict) -> None:
+        values = state.get(kind) or []
+        values.insert(0, round(seconds, 3))
+        state[kind] = values[:WINDOW_SIZE]
+
+    try:
+        update_state_file(append)
+    except OSError:
+        pass
+
+
+def hedge_delay(kind: str) -> Optional[float]:
+    # Seconds to wait before hedging, or None while the window is too small.
+    now = time.monotonic()
+    with _window_lock:
+        cached = _window_cache.get(kind)
+        if cached and now - cached[0] < WINDOW_REFRESH_SECONDS:
+            return cached[1]
+    values = load_window(kind)
+    if len(values) < MIN_SAMPLES:
+        return None
+    delay = max(MIN_DELAY_SECONDS, percentile(values, PERCENTILE))
+    with _window_lock:
+        _window_cache[kind] = (now, delay)
+    return delay
+
+
+def budget_keys() -> tuple:
+    minute = int(time.time() // 60)
+    return f"{REDIS_KEY_PREFIX}requests:{minute}", f"{REDIS_KEY_PREFIX}hedges:{minute}"
+
+
+def note_request() -> None:
+    requests_key, _hedges_key = budget_keys()
+    client = get_redis_client()
+    if client:
+        try:
+            pipe = client.pipeline()
+            pipe.incr(requests_key)
+            pipe.expire(requests_key, 120)
+            pipe.execute()
+            return
+        except Exception:
+            pass
+    minute = requests_key.rsplit(":", 1)[-1]
+    with _budget_lock:
+        for key in [key for key in _local_budget if key.rsplit(":", 1)[-1] != minute]:
+            del _local_budget[key]
+        _local_budget[requests_key] = _local_budget.get(requests_key, 0) + 1
+
+
+def try_acquire_hedge() -> bool:
+    requests_key, hedges_key = budget_keys()
+    client = get_redis_client()
+    if client:
+        try:
+            pipe = client.pipeline()
+            pipe.get(requests_key)
+            pipe.incr(hedges_key)
+            pipe.expire(hedges_key, 120)
+            requests, hedges, _ = pipe.execute()
+            if hedges <= BUDGET_BURST + int(requests or 0) * BUDGET_PERCENT / 100:
+                return True
+            client.decr(hedges_key)
+            return False
+        except Exception:
+            pass
+    with _budget_lock:
+        requests = _local_budget.get(requests_key, 0)
+        hedges = _local_budget.get(hedges_key, 0)
+        if hedges + 1 > BUDGET_BURST + requests * BUDGET_PERCENT / 100:
+            return False
+        _local_budget[hedges_key] = hedges + 1
+        return True
+
+
+def run(
+    attempt: Callable[[Optional[threading.Event], AttemptProgress], T],
+    *,
+    kind: str,
+    cancel_event: Optional[threading.Event] = None,
+    hedge: bool = True,
+) -> T:
+    # attempt(cancel_event, progress) performs one model call and calls
+    # progress.set() on its first output; it must stop once its cancel event
+    # is set. Without hedging it runs inline.
+    if not ENABLED or not hedge:
+        return attempt(cancel_event, AttemptProgress())
+    note_request()
+    delay = hedge_delay(kind)
+    if delay is None:
+        progress = AttemptProgress()
+        started = time.perf_counter()
+        result = attempt(cancel_event, progress)
+        record_latency(kind, (progress.at or time.perf_counter()) - started)
+        return result
+
+    outcomes: "queue.Queue" = queue.Queue()
+    attempts: List[Dict] = []
+
+    def launch(hedge: bool) -> Dict:
+        record = {
+            "cancel": threading.Event(),
+            "progress": AttemptProgress(),
+            "started": time.perf_counter(),
+            "hedge": hedge,
+        }
+        context = contextvars.copy_context()
+
+        def target() -> None:
+            try:
+                value = context.run(attempt, record["cancel"], record["progress"])
+            except BaseException as exc:
+                outcomes.put((record, None, exc))
+            else:
+                outcomes.put((record, value, None))
+            finally:
+                record["progress"].set()
+
+        attempts.append(record)
+        threading.Thread(target=target, daemon=True).start()
+        return record
+
+    def propagate_cancel() -> None:
+        if cancel_event is not None and cancel_event.is_set():
+            for record in attempts:
+                record["cancel"].set()
+
+    primary = launch(False)
+    deadline = time.perf_counter() + delay
+    while not primary["progress"].event.is_set():
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0 or (cancel_event is not None and cancel_event.is_set()):
+            break
+        primary["progress"].event.wait(min(POLL_SECONDS, remaining))
+    if (
+        not primary["progress"].event.is_set()
+        and not (cancel_event is not None and cancel_event.is_set())
+        and try_acquire_hedge()
+    ):
+        metrics.count("hedges")
+        launch(True)
+
+    errors: List[BaseException] = []
+    pending = len(attempts)
+    while pending:
+        propagate_cancel()
+        try:
+            record, value, exc = outcomes.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            continue
+        pending -= 1
+        if exc is not None:
+            record["failed"] = True
+            errors.append(exc)
+            continue
+        now = time.perf_counter()
+        latency = (record["progress"].at or now) - record["started"]
+        record_latency(kind, latency)
+        for other in attempts:
+            if other is record or other.get("failed"):
+                continue
+            other["cancel"].set()
+            # The loser's latency is at least its elapsed time. Leaving it
+            # out would only keep the fast samples and shrink the delay, so
+            # record it when it is known or exceeds the winner's.
+            elapsed = (other["progress"].at or now) - other["started"]
+            if other["progress"].at is not None or elapsed > latency:
+                record_latency(kind, elapsed)
+        if record["hedge"]:
+            metrics.count("hedge_wins")
+        return value
+    raise errors[0]
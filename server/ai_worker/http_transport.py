@@ -0,0 +1,487 @@
+"""HTTP transports for the ARK Responses API.
+
+grader.py talks to the model endpoint through ``get_transport().post(...)``
+(or ``open_stream(...)`` for SSE responses) so connections are reused across
+the prefix warmup, the graded request and, in serve/batch mode, across jobs.
+Three implementations are available:
+
+- ``httpx``: used when the optional ``httpx`` package is installed;
+- ``stdlib``: a small keep-alive pool on top of ``http.client``;
+- ``urllib``: one connection per request (the historical behaviour), picked
+  automatically when an HTTP(S) proxy is configured in the environment.
+
+Only the ``stdlib`` transport is ``abortable``: given a ``cancel_event``, it
+shuts the socket down as soon as the event is set, even while waiting for a
+response, so a cancelled request stops instead of running to completion.
+Processes that cancel or hedge requests call ``require_abortable()``, after
+which ``auto`` no longer picks ``httpx``.
+
+Request bodies are ``JsonBody`` objects: the JSON is serialized up front
+except for large streamed values (encoded images), which are written to the
+socket chunk by chunk.
+"""
+import http.client
+import json
+import os
+import re
+import socket
+import sys
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+import zlib
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+try:
+    import httpx  # type: ignore
+except Exception:  # pragma: no cover - optional dependency
+    httpx = None
+
+
+TRANSPORT_KIND = os.getenv("AI_GRADING_HTTP_TRANSPORT", "auto").strip().lower()
+CONNECT_TIMEOUT_SECONDS = float(
+    os.getenv("AI_GRADING_HTTP_CONNECT_TIMEOUT_SECONDS", "10")
+)
+READ_TIMEOUT_SECONDS = float(os.getenv("AI_GRADING_HTTP_READ_TIMEOUT_SECONDS", "120"))
+POOL_SIZE = int(os.getenv("AI_GRADING_HTTP_POOL_SIZE", "8"))
+GZIP_ENABLED = os.getenv("AI_GRADING_HTTP_GZIP", "false").lower() == "true"
+GZIP_MIN_BYTES = int(os.getenv("AI_GRADING_HTTP_GZIP_MIN_BYTES", "65536"))
+GZIP_LEVEL = int(os.getenv("AI_GRADING_HTTP_GZIP_LEVEL", "5"))
+CANCEL_POLL_SECONDS = 0.2
+
+_transport = None
+_transport_lock = threading.Lock()
+_abort_required = False
+
+
+class TransportError(RuntimeError):
+    # Network-level failure: DNS, connect, TLS, reset or timeout.
+    pass
+
+
+class StreamHandle:
+    # An open streaming response; read it line by line, then close().
+    def __init__(
+        self,
+        status: int,
+        readline,
+        close,
+        headers: Optional[Dict[str, str]] = None,
+    ):
+        self.status = status
+        self.headers = headers or {}
+        self._readline = readline
+        self._close = close
+
+    def iter_lines(self) -> Iterator[str]:
+        while True:
+            try:
+                line = self._readline()
+            except (OSError, http.client.HTTPException) as exc:
+                raise TransportError(str(exc)) from exc
+            if not line:
+                return
+            if isinstance(line, bytes):
+                line = line.decode("utf-8", errors="replace")
+            yield line.rstrip("\r\n")
+
+    def read(self) -> bytes:
+        return "\n".join(self.iter_lines()).encode("utf-8")
+
+    def close(self) -> None:
+        self._close()
+
+
+class JsonBody:
+    # JSON request body. Values exposing ``size`` and ``iter_bytes()`` (such
+    # as image_prep.EncodedImage) are emitted as JSON strings straight from
+    # their chunks; their bytes must already be JSON-safe ASCII.
+    def __init__(self, payload: Dict):
+        token = uuid.uuid4().hex
+        streams = []
+
+        def replace(value):
+            if isinstance(value, dict):
+                return {key: replace(item) for key, item in value.items()}
+            if isinstance(value, list):
+                return [replace(item) for item in value]
+            if hasattr(value, "iter_bytes"):
+                streams.append(value)
+                return f"{token}:{len(streams) - 1}"
+            return value
+
+        text = json.dumps(replace(payload))
+        pieces = re.split(f'"{token}:(\\d+)"', text)
+        self.parts: List[Union[bytes, object]] = []
+        for index, piece in enumerate(pieces):
+            if index % 2:
+                self.parts.extend([b'"', streams[int(piece)], b'"'])
+            elif piece:
+                self.parts.append(piece.encode("utf-8"))
+
+    def __len__(self) -> int:
+        return sum(
+            len(part) if isinstance(part, bytes) else part.size for part in self.parts
+        )
+
+    def __iter__(self) -> Iterator[bytes]:
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+            else:
+                yield from part.iter_bytes()
+
+
+Body = Union[bytes, JsonBody]
+
+
+def compresses(size: int) -> bool:
+    return GZIP_ENABLED and size >= GZIP_MIN_BYTES
+
+
+def encode_body(body: Body, headers: Dict[str, str]) -> Body:
+    # Gzip large request bodies (base64 images compress well) when enabled,
+    # unless the caller asked for Content-Encoding: identity.
+    headers["Content-Length"] = str(len(body))
+    if not compresses(len(body)) or headers.get("Content-Encoding") == "identity":
+        return body
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    chunks = [body] if isinstance(body, bytes) else body
+    data = b"".join(compressor.compress(chunk) for chunk in chunks) + compressor.flush()
+    headers["Content-Encoding"] = "gzip"
+    headers["Content-Length"] = str(len(data))
+    return data
+
+
+class CancelWatch:
+    # Shuts a connection's socket down once cancel_event is set, which wakes
+    # up the thread blocked on it; stop() once the request is over.
+    def __init__(
+        self, cancel_event: Optional[threading.Event], conn: http.client.HTTPConnection
+    ):
+        self.cancelled = False
+        self._done = threading.Event()
+        if cancel_event is not None:
+            threading.Thread(
+                target=self._watch, args=(cancel_event, conn), daemon=True
+            ).start()
+
+    def _watch(self, cancel_event: threading.Event, conn: http.client.HTTPConnection) -> None:
+        while not self._done.is_set():
+            if not cancel_event.wait(CANCEL_POLL_SECONDS):
+                continue
+            if self._done.is_set():
+                return
+            self.cancelled = True
+            sock = conn.sock
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            return
+
+    def stop(self) -> None:
+        self._done.set()
+
+
+def lower_headers(items) -> Dict[str, str]:
+    return {str(key).lower(): str(value) for key, value in items}
+
+
+class UrllibTransport:
+    name = "urllib"
+    abortable = False
+
+    def post(
+        self,
+        url: str,
+        body: Body,
+        headers: Dict[str, str],
+        cancel_event: Optional[threading.Event] = None,
+    ) -> Tuple[int, bytes, Dict[str, str]]:
+        headers = dict(headers)
+        data = encode_body(body, headers)
+        req = urllib.request.Request(url, data=data, headers=headers, method="POST")
+        try:
+            with urllib.request.urlopen(req, timeout=READ_TIMEOUT_SECONDS) as resp:
+                return resp.status, resp.read(), lower_headers(resp.headers.items())
+        except urllib.error.HTTPError as exc:
+            return exc.code, exc.read(), lower_headers(exc.headers.items())
+        except (urllib.error.URLError, OSError) as exc:
+            raise TransportError(str(exc)) from exc
+
+    def open_stream(
+        self,
+        url: str,
+        body: Body,
+        headers: Dict[str, str],
+        cancel_event: Optional[threading.Event] = None,
+    ) -> StreamHandle:
+        headers = dict(headers)
+        data = encode_body(body, headers)
+        req = urllib.request.Request(url, data=data, headers=headers, method="POST")
+        try:
+            resp = urllib.request.urlopen(req, timeout=READ_TIMEOUT_SECONDS)
+        except urllib.error.HTTPError as exc:
+            return StreamHandle(
+                exc.code, exc.readline, exc.close, lower_headers(exc.headers.items())
+            )
+        except (urllib.error.URLError, OSError) as exc:
+            raise TransportError(str(exc)) from exc
+        return StreamHandle(
+            resp.status, resp.readline, resp.close, lower_headers(resp.headers.items())
+        )
+
+    def close(self) -> None:
+        return
+
+
+class StdlibTransport:
+    # Keep-alive connection pool per (scheme, host, port) on http.client.
+    name = "stdlib"
+    abortable = True
+
+    def __init__(self, pool_size: int = POOL_SIZE):
+        self.pool_size = max(1, pool_size)
+        self._idle: Dict[Tuple[str, str, int], List[http.client.HTTPConnection]] = {}
+        self._lock = threading.Lock()
+
+    def _acquire(
+        self, origin: Tuple[str, str, int]
+    ) -> Tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            idle = self._idle.get(origin)
+            if idle:
+                return idle.pop(), True
+        scheme, host, port = origin
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(
+                host, port, timeout=CONNECT_TIMEOUT_SECONDS
+            )
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=CONNECT_TIMEOUT_SECONDS)
+        return conn, False
+
+    def _release(
+        self, origin: Tuple[str, str, int], conn: http.client.HTTPConnection
+    ) -> None:
+        with self._lock:
+            idle = self._idle.setdefault(origin, [])
+            if len(idle) < self.pool_size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _send(
+        self,
+        url: str,
+        body: Body,
+        headers: Dict[str, str],
+        cancel_event: Optional[threading.Event],
+    ) -> Tuple[
+        Tuple[str, str, int],
+        http.client.HTTPConnection,
+        http.client.HTTPResponse,
+        CancelWatch,
+    ]:
+        parsed = urllib.parse.urlsplit(url)
+        scheme = parsed.scheme or "https"
+        origin = (
+            scheme,
+            parsed.hostname or "",
+            parsed.port or (443 if scheme == "https" else 80),
+        )
+        path = parsed.path or "/"
+        if parsed.query:
+            path = f"{path}?{parsed.query}"
+        headers = dict(headers)
+        data = encode_body(body, headers)
+
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                raise TransportError("Request cancelled.")
+            conn, reused = self._acquire(origin)
+            watch = CancelWatch(cancel_event, conn)
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                conn.sock.settimeout(READ_TIMEOUT_SECONDS)
+                conn.request("POST", path, body=data, headers=headers)
+                return origin, conn, conn.getresponse(), watch
+            except (
+                http.client.RemoteDisconnected,
+                BrokenPipeError,
+                ConnectionResetError,
+            ) as exc:
+                watch.stop()
+                conn.close()
+                if reused and not watch.cancelled:
+                    # The server closed an idle keep-alive connection before
+                    # reading the request; retry once on a fresh socket.
+                    continue
+                raise TransportError(str(exc)) from exc
+            except (OSError, http.client.HTTPException) as exc:
+                watch.stop()
+                conn.close()
+                raise TransportError(str(exc)) from exc
+
+    def post(
+        self,
+        url: str,
+        body: Body,
+        headers: Dict[str, str],
+        cancel_event: Optional[threading.Event] = None,
+    ) -> Tuple[int, bytes, Dict[str, str]]:
+        origin, conn, resp, watch = self._send(url, body, headers, cancel_event)
+        try:
+            payload = resp.read()
+        except (OSError, http.client.HTTPException) as exc:
+            conn.close()
+            raise TransportError(str(exc)) from exc
+        finally:
+            watch.stop()
+        if resp.will_close or watch.cancelled:
+            conn.close()
+        else:
+            self._release(origin, conn)
+        return resp.status, payload, lower_headers(resp.getheaders())
+
+    def open_stream(
+        self,
+        url: str,
+        body: Body,
+        headers: Dict[str, str],
+        cancel_event: Optional[threading.Event] = None,
+    ) -> StreamHandle:
+        origin, conn, resp, watch = self._send(url, body, headers, cancel_event)
+
+        def close() -> None:
+            # A stream abandoned mid-body leaves unread bytes on the socket,
+            # so only fully drained connections go back to the pool.
+            watch.stop()
+            if resp.isclosed() and not resp.will_close and not watch.cancelled:
+                self._release(origin, conn)
+            else:
+                conn.close()
+
+        return StreamHandle(
+            resp.status, resp.readline, close, lower_headers(resp.getheaders())
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            pools = list(self._idle.values())
+            self._idle = {}
+        for idle in pools:
+            for conn in idle:
+                conn.close()
+
+
+class HttpxTransport:
+    name = "httpx"
+    abortable = False
+
+    def __init__(self, pool_size: int = POOL_SIZE):
+        self._client = httpx.Client(
+            timeout=httpx.Timeout(READ_TIMEOUT_SECONDS, connect=CONNECT_TIMEOUT_SECONDS),
+            limits=httpx.Limits(
+                max_connections=max(1, pool_size) * 4,
+                max_keepalive_connections=max(1, pool_size),
+            ),
+        )
+
+    def post(
+        self,
+        url: str,
+        body: Body,
+        headers: Dict[str, str],
+        cancel_event: Optional[threading.Event] = None,
+    ) -> Tuple[int, bytes, Dict[str, str]]:
+        headers = dict(headers)
+        data = encode_body(body, headers)
+        try:
+            resp = self._client.post(url, content=data, headers=headers)
+        except httpx.HTTPError as exc:
+            raise TransportError(str(exc)) from exc
+        return resp.status_code, resp.content, lower_headers(resp.headers.items())
+
+    def open_stream(
+        self,
+        url: str,
+        body: Body,
+        headers: Dict[str, str],
+        cancel_event: Optional[threading.Event] = None,
+    ) -> StreamHandle:
+        headers = dict(headers)
+        data = encode_body(body, headers)
+        try:
+            request = self._client.build_request(
+                "POST", url, content=data, headers=headers
+            )
+            resp = self._client.send(request, stream=True)
+        except httpx.HTTPError as exc:
+            raise TransportError(str(exc)) from exc
+        lines = resp.iter_lines()
+
+        def readline() -> str:
+            try:
+                return next(lines) + "\n"
+            except StopIteration:
+                return ""
+            except httpx.HTTPError as exc:
+                raise TransportError(str(exc)) from exc
+
+        return StreamHandle(
+            resp.status_code, readline, resp.close, lower_headers(resp.headers.items())
+        )
+
+    def close(self) -> None:
+        self._client.close()
+
+
+def proxy_configured(url: Optional[str] = None) -> bool:
+    proxies = urllib.request.getproxies()
+    if not proxies:
+        return False
+    if url:
+        host = urllib.parse.urlsplit(url).hostname or ""
+        scheme = urllib.parse.urlsplit(url).scheme or "https"
+        return scheme in proxies and not urllib.request.proxy_bypass(host)
+    return True
+
+
+def require_abortable() -> None:
+    # Call before the first request in processes whose requests get
+    # cancelled or hedged.
+    global _abort_required
+    _abort_required = True
+
+
+def create_transport(kind: str = TRANSPORT_KIND, url: Optional[str] = None):
+    if kind == "httpx" or (kind == "auto" and httpx is not None and not _abort_required):
+        if httpx is None:
+            raise TransportError("AI_GRADING_HTTP_TRANSPORT=httpx but httpx is not installed.")
+        transport = HttpxTransport()
+    elif kind == "urllib" or (kind == "auto" and proxy_configured(url)):
+        transport = UrllibTransport()
+    else:
+        transport = StdlibTransport()
+    if _abort_required and not transport.abortable:
+        print(
+            f"HTTP transport {transport.name} cannot abort requests: cancelled jobs run "
+            "to completion and non-streamed calls are not hedged.",
+            file=sys.stderr,
+        )
+    return transport
+
+
+def get_transport(url: Optional[str] = None):
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = create_transport(url=url)
+    return _transport
@@ -0,0 +1,248 @@
+"""Resolve storage refs to local image files inside the grader.
+
+The worker can pass the submission's storage refs straight to grader.py
+instead of materializing every image itself first. Refs follow the server's
+StorageService conventions:
+
+- local files: absolute paths, ``local://<key>``, ``/uploads/<key>`` (or
+  ``LOCAL_STORAGE_PUBLIC_BASE``) and bare keys under ``LOCAL_STORAGE_ROOT``
+  are used in place, with no copy. Requests can arrive over the Redis queue,
+  so only files under ``LOCAL_STORAGE_ROOT``, the worker's ``ai-grading-*``
+  temp dirs and ``AI_GRADING_LOCAL_IMAGE_ROOTS`` are read;
+- ``http(s)://`` URLs (including presigned S3 URLs) are downloaded;
+- ``s3://bucket/key`` is downloaded with the optional ``boto3`` package,
+  configured like the server (``S3_ENDPOINT``, ``S3_REGION``, ...).
+
+Downloads run concurrently (``AI_GRADING_FETCH_CONCURRENCY``) and are streamed
+into a download cache keyed by the ref, so the other questions, retries and
+cascade tiers of the same submission do not fetch the photo again. As in the
+worker, missing refs and images over ``AI_IMAGE_MAX_BYTES`` are skipped.
+"""
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+try:
+    import boto3  # type: ignore
+    from botocore.config import Config as BotoConfig  # type: ignore
+except Exception:  # pragma: no cover - optional dependency
+    boto3 = None
+    BotoConfig = None
+
+
+FETCH_CONCURRENCY = int(os.getenv("AI_GRADING_FETCH_CONCURRENCY", "4"))
+FETCH_TIMEOUT_SECONDS = float(os.getenv("AI_GRADING_FETCH_TIMEOUT_SECONDS", "30"))
+MAX_BYTES = int(os.getenv("AI_IMAGE_MAX_BYTES", str(9 * 1024 * 1024)))
+CACHE_DIR = os.getenv("AI_GRADING_FETCH_CACHE_DIR") or os.path.join(
+    tempfile.gettempdir(), "ai-grading-fetch"
+)
+CACHE_TTL_SECONDS = int(os.getenv("AI_GRADING_FETCH_CACHE_TTL_SECONDS", "3600"))
+LOCAL_ROOT = os.path.abspath(os.getenv("LOCAL_STORAGE_ROOT") or "uploads")
+LOCAL_PUBLIC_BASE = "/" + (os.getenv("LOCAL_STORAGE_PUBLIC_BASE") or "/uploads").strip("/")
+# More directories local refs may point into (os.pathsep separated), e.g. for
+# grading photos from the command line.
+EXTRA_LOCAL_ROOTS = [
+    os.path.abspath(root)
+    for root in os.getenv("AI_GRADING_LOCAL_IMAGE_ROOTS", "").split(os.pathsep)
+    if root.strip()
+]
+# The worker copies images into <tmp>/ai-grading-*/ when it materializes them
+# itself (AI_GRADING_DIRECT_FETCH=false).
+WORKER_TEMP_PREFIX = "ai-grading-"
+CHUNK_SIZE = 256 * 1024
+# Prune the download cache at most this often per process.
+PRUNE_INTERVAL_SECONDS = 600
+
+_s3_client = None
+_s3_lock = threading.Lock()
+_last_prune = 0.0
+
+
+class ImageTooLarge(RuntimeError):
+    pass
+
+
+def is_remote(ref: str) -> bool:
+    lower = ref.lower()
+    return lower.startswith(("http://", "https://", "s3://"))
+
+
+def normalize_key(raw: str) -> str:
+    parts = [part.strip() for part in raw.replace("\\", "/").split("/")]
+    return "/".join(part for part in parts if part and part not in (".", ".."))
+
+
+def local_path(ref: str) -> Optional[str]:
+    # Same precedence as StorageService.parseRef for non-remote refs, except
+    # that an existing relative path (CLI usage) is taken as it is.
+    if ref.startswith("local://"):
+        key = normalize_key(ref[len("local://") :])
+    elif ref.startswith(f"{LOCAL_PUBLIC_BASE}/"):
+        key = normalize_key(ref[len(LOCAL_PUBLIC_BASE) + 1 :])
+    elif ref.startswith("/uploads/"):
+        key = normalize_key(ref[len("/uploads/") :])
+    elif os.path.isabs(ref) or os.path.exists(ref):
+        return ref
+    else:
+        key = normalize_key(ref)
+    return os.path.join(LOCAL_ROOT, key) if key else None
+
+
+def is_allowed_local(path: str) -> bool:
+    # Checked on the resolved path, so ".." and symlinks cannot leave a root.
+    real = os.path.realpath(path)
+    for root in [LOCAL_ROOT, *EXTRA_LOCAL_ROOTS]:
+        if real.startswith(os.path.join(os.path.realpath(root), "")):
+            return True
+    try:
+        relative = os.path.relpath(real, os.path.realpath(tempfile.gettempdir()))
+    except ValueError:
+        return False
+    parts = relative.split(os.sep)
+    return len(parts) > 1 and parts[0].startswith(WORKER_TEMP_PREFIX)
+
+
+def cache_key(ref: str) -> str:
+    # Presigned URLs change their query on every signing; the object does not.
+    parsed = urllib.parse.urlsplit(ref)
+    query = urllib.parse.parse_qs(parsed.query)
+    if "X-Amz-Signature" in query or "Signature" in query:
+        ref = urllib.parse.urlunsplit((parsed.scheme, parsed.netloc, parsed.path, "", ""))
+    return hashlib.sha256(ref.encode("utf-8")).hexdigest()[:32]
+
+
+def cache_path(ref: str) -> str:
+    extension = os.path.splitext(urllib.parse.urlsplit(ref).path)[1].lower()
+    if len(extension) > 10 or not extension[1:].isalnum():
+        extension = ""
+    return os.path.join(CACHE_DIR, f"{cache_key(ref)}{extension}")
+
+
+def get_s3_client():
+    global _s3_client
+    with _s3_lock:
+        if _s3_client is None:
+            _s3_client = boto3.client(
+                "s3",
+                region_name=os.getenv("S3_REGION", "us-east-1"),
+                endpoint_url=os.getenv("S3_ENDPOINT") or None,
+                aws_access_key_id=os.getenv("S3_ACCESS_KEY_ID") or None,
+                aws_secret_access_key=os.getenv("S3_SECRET_ACCESS_KEY") or None,
+                config=BotoConfig(
+                    s3={
+                        "addressing_style": "path"
+                        if os.getenv("S3_FORCE_PATH_STYLE", "true").lower() != "false"
+                        else "auto"
+                    }
+                ),
+            )
+    return _s3_client
+
+
+def open_remote(ref: str):
+    # A file-like body with read(n).
+    if ref.startswith("s3://"):
+        if boto3 is None:
+            raise RuntimeError("s3:// refs need the boto3 package; pass a presigned URL instead.")
+        bucket, _, key = ref[len("s3://") :].partition("/")
+        response = get_s3_client().get_object(Bucket=bucket, Key=key)
+        if int(response.get("ContentLength") or 0) > MAX_BYTES:
+            response["Body"].close()
+            raise ImageTooLarge(f"{response.get('ContentLength')} bytes")
+        return response["Body"]
+    response = urllib.request.urlopen(ref, timeout=FETCH_TIMEOUT_SECONDS)
+    length = response.headers.get("Content-Length")
+    if length and int(length) > MAX_BYTES:
+        response.close()
+        raise ImageTooLarge(f"{length} bytes")
+    return response
+
+
+def download(ref: str) -> str:
+    target = cache_path(ref)
+    if os.path.isfile(target):
+        os.utime(target)
+        return target
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".part")
+    try:
+        body = open_remote(ref)
+        try:
+            size = 0
+            with os.fdopen(fd, "wb") as out:
+                while True:
+                    chunk = body.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > MAX_BYTES:
+                        raise ImageTooLarge(f"over {MAX_BYTES} bytes")
+                    out.write(chunk)
+        finally:
+            body.close()
+        os.replace(tmp_path, target)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    return target
+
+
+def resolve_one(ref: str) -> Optional[str]:
+    try:
+        if is_remote(ref):
+            return download(ref)
+        path = local_path(ref)
+        if path and not is_allowed_local(path):
+            print(f"Skip image outside the upload root: {ref}", file=sys.stderr)
+            return None
+        if path and os.path.isfile(path):
+            if os.path.getsize(path) > MAX_BYTES:
+                raise ImageTooLarge(f"{os.path.getsize(path)} bytes")
+            return path
+        print(f"Skip missing image: {ref}", file=sys.stderr)
+    except ImageTooLarge as exc:
+        print(f"Skip image over limit ({exc}): {ref}", file=sys.stderr)
+    except Exception as exc:
+        print(f"Skip image {ref}: {exc}", file=sys.stderr)
+    return None
+
+
+def prune_cache() -> None:
+    global _last_prune
+    now = time.time()
+    if now - _last_prune < PRUNE_INTERVAL_SECONDS:
+        return
+    _last_prune = now
+    try:
+        names = os.listdir(CACHE_DIR)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > CACHE_TTL_SECONDS:
+                os.unlink(path)
+        except OSError:
+            continue
+
+
+def resolve_images(refs: List[str]) -> List[str]:
+    # Local paths for the given refs, in order, without the skipped ones.
+    refs = [str(ref).strip() for ref in refs or [] if str(ref).strip()]
+    remote = [ref for ref in refs if is_remote(ref)]
+    if len(remote) > 1 and FETCH_CONCURRENCY > 1:
+        with ThreadPoolExecutor(max_workers=min(FETCH_CONCURRENCY, len(remote))) as executor:
+            fetched = dict(zip(remote, executor.map(resolve_one, remote)))
+    else:
+        fetched = {ref: resolve_one(ref) for ref in remote}
+    paths = [fetched[ref] if ref in fetched else resolve_one(ref) for ref in refs]
+    if remote:
+        prune_cache()
+    return [path for path in paths if path]
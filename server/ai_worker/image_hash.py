@@ -0,0 +1,226 @@
+"""Perceptual hashes of answer photos for image plagiarism checks.
+
+Each photo is reduced to a normalized grayscale thumbnail and fingerprinted
+with a 64-bit dHash (gradient of a 9x8 thumbnail) and a 64-bit pHash (signs
+of the low-frequency DCT coefficients of a 32x32 thumbnail against their
+median), plus its SHA-256. Two photos are near duplicates when they are
+byte-identical or their pHashes are within ``AI_PLAGIARISM_IMAGE_MAX_DISTANCE``
+bits (with the dHash within twice that as a cross-check). This survives
+re-compression, resizing, brightness changes, slight rotation and crops of
+about 1% per side; heavier crops are not caught.
+
+Hashes are computed once, when a submission is indexed, and kept in the same
+per (assignment, question) store as the text index (similarity.py). The
+pHash is split into 8 one-byte chunks used as multi-index buckets: by the
+pigeonhole principle two hashes at most 7 bits apart share a chunk, so a
+query only scores the entries found in its buckets. Needs Pillow.
+"""
+import hashlib
+import math
+import os
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from PIL import Image, ImageOps  # type: ignore
+except Exception:  # pragma: no cover - optional dependency
+    Image = None
+    ImageOps = None
+
+import similarity
+
+
+# Multi-index buckets guarantee recall up to 7 bits; cap the setting there.
+MAX_DISTANCE = min(7, int(os.getenv("AI_PLAGIARISM_IMAGE_MAX_DISTANCE", "6")))
+MAX_IMAGES = 4
+DCT_SIZE = 32
+DCT_KEEP = 8
+DCT_COS = [
+    [math.cos(math.pi * (2 * n + 1) * k / (2 * DCT_SIZE)) for n in range(DCT_SIZE)]
+    for k in range(DCT_KEEP)
+]
+
+
+def dct_low(values: List[float]) -> List[float]:
+    # First DCT_KEEP DCT-II coefficients; the scale factor does not matter.
+    return [sum(v * c for v, c in zip(values, row)) for row in DCT_COS]
+
+
+def load_gray(path: str):
+    with Image.open(path) as opened:
+        # JPEG decoders can downscale while decoding; thumbnails need little.
+        opened.draft("L", (DCT_SIZE * 8, DCT_SIZE * 8))
+        image = ImageOps.exif_transpose(opened).convert("L")
+    return ImageOps.autocontrast(image)
+
+
+def dhash(image) -> int:
+    pixels = list(image.resize((9, 8), Image.LANCZOS).getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            bits = (bits << 1) | int(left > pixels[row * 9 + col + 1])
+    return bits
+
+
+def phash(image) -> int:
+    pixels = list(image.resize((DCT_SIZE, DCT_SIZE), Image.LANCZOS).getdata())
+    rows = [dct_low(pixels[r * DCT_SIZE : (r + 1) * DCT_SIZE]) for r in range(DCT_SIZE)]
+    coefficients = []
+    for u in range(DCT_KEEP):
+        column = dct_low([rows[r][u] for r in range(DCT_SIZE)])
+        coefficients.extend(column)
+    # The DC term only reflects overall brightness; keep it out of the median.
+    median = sorted(coefficients[1:])[len(coefficients[1:]) // 2]
+    bits = 0
+    for value in coefficients:
+        bits = (bits << 1) | int(value > median)
+    return bits
+
+
+def hash_image(path: str) -> Optional[Dict[str, str]]:
+    if Image is None:
+        raise RuntimeError("Pillow is required for image hashing.")
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    try:
+        image = load_gray(path)
+    except Exception:
+        return None
+    return {
+        "sha256": digest.hexdigest(),
+        "phash": f"{phash(image):016x}",
+        "dhash": f"{dhash(image):016x}",
+    }
+
+
+def hamming(a: str, b: str) -> int:
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+def image_distance(a: Dict[str, str], b: Dict[str, str]) -> int:
+    # pHash distance, or 64 when the coarser dHash disagrees too much.
+    if a.get("sha256") and a.get("sha256") == b.get("sha256"):
+        return 0
+    if hamming(a["dhash"], b["dhash"]) > 2 * MAX_DISTANCE:
+        return 64
+    return hamming(a["phash"], b["phash"])
+
+
+def bucket_keys(hashes: List[Dict[str, str]]) -> List[str]:
+    keys = set()
+    for item in hashes:
+        value = item["phash"]
+        for chunk in range(8):
+            keys.add(f"p{chunk}:{value[chunk * 2 : chunk * 2 + 2]}")
+    return sorted(keys)
+
+
+def make_entry(item: Dict) -> Optional[Dict]:
+    # item: {"key", "submissionVersionId", "images": [paths]} or precomputed
+    # {"hashes": [{"sha256", "phash", "dhash"}]}.
+    key = str(item.get("key") or "")
+    hashes = [entry for entry in item.get("hashes") or [] if isinstance(entry, dict)]
+    if not hashes:
+        for path in list(item.get("images") or [])[:MAX_IMAGES]:
+            try:
+                hashed = hash_image(str(path))
+            except OSError:
+                continue
+            if hashed:
+                hashes.append(hashed)
+    if not key or not hashes:
+        return None
+    return {
+        "key": key,
+        "submissionVersionId": str(item.get("submissionVersionId") or ""),
+        "hashes": hashes,
+        "bands": bucket_keys(hashes),
+    }
+
+
+def set_similarity(
+    base: List[Dict[str, str]], other: List[Dict[str, str]]
+) -> Tuple[float, int]:
+    # Jaccard over near-duplicate photos: each base photo may match one
+    # photo of the other answer. Also returns the closest pair distance.
+    used = set()
+    matched = 0
+    closest = 64
+    for a in base:
+        best = None
+        for index, b in enumerate(other):
+            distance = image_distance(a, b)
+            closest = min(closest, distance)
+            if index not in used and distance <= MAX_DISTANCE:
+                if best is None or distance < best[0]:
+                    best = (distance, index)
+        if best is not None:
+            used.add(best[1])
+            matched += 1
+    union = len(base) + len(other) - matched
+    return (matched / union if union > 0 else 0.0), closest
+
+
+def index_name(assignment_id: str, question_id: str) -> str:
+    return f"image:{assignment_id}:{question_id}"
+
+
+def add(assignment_id: str, question_id: str, items: List[Dict]) -> Dict:
+    name = index_name(assignment_id, question_id)
+    entries = [entry for entry in (make_entry(item) for item in items) if entry]
+    if not entries:
+        return {"size": similarity.query_size(name), "added": 0}
+    return {"size": similarity.store(name, entries), "added": len(entries)}
+
+
+def query(
+    assignment_id: str,
+    question_id: str,
+    item: Dict,
+    *,
+    threshold: float,
+    limit: int = 20,
+    insert: bool = True,
+) -> Dict:
+    # Same reply shape as similarity.query; "hashes" returns the computed
+    # fingerprints so callers can reuse them.
+    name = index_name(assignment_id, question_id)
+    entry = make_entry(item)
+    if entry is None:
+        return {
+            "peers": similarity.query_size(name),
+            "candidates": 0,
+            "topSimilarity": 0.0,
+            "matches": [],
+            "hashes": [],
+        }
+    peers, candidates = similarity.lookup(name, entry)
+    matches = []
+    top = 0.0
+    for candidate in candidates:
+        if candidate.get("key") == entry["key"]:
+            continue
+        score, closest = set_similarity(entry["hashes"], candidate.get("hashes") or [])
+        top = max(top, score)
+        if score > 0 and score >= threshold:
+            matches.append(
+                {
+                    "key": candidate["key"],
+                    "submissionVersionId": candidate.get("submissionVersionId") or "",
+                    "similarity": round(score, 6),
+                    "distance": closest,
+                }
+            )
+    matches.sort(key=lambda match: (-match["similarity"], match["distance"]))
+    if insert:
+        similarity.store(name, [entry])
+    return {
+        "peers": peers,
+        "candidates": len(candidates),
+        "topSimilarity": round(top, 6),
+        "matches": matches[:limit],
+        "hashes": entry["hashes"],
+    }
@@ -0,0 +1,272 @@
+"""Image preprocessing and the encoded data URL cache for grader.py.
+
+Phone photos of handwriting are usually several megabytes each. Before an
+image is sent to the model it is auto-oriented, cropped to the written area,
+downscaled to ``AI_GRADING_IMAGE_MAX_EDGE`` pixels on its long edge, converted
+to grayscale and re-encoded as JPEG. The resulting data URL is stored in a
+content-addressed disk cache keyed by the SHA-256 of the original bytes and
+the preprocessing settings, so retries, regrades and multi-question uploads
+of the same photo skip both the decode and the base64 step. Entries unused
+for ``AI_GRADING_IMAGE_CACHE_TTL_SECONDS`` are removed, and the oldest ones go
+first once the cache exceeds ``AI_GRADING_IMAGE_CACHE_MAX_MB`` megabytes.
+
+Encoded images are handed around as ``EncodedImage`` references and streamed
+into the request body chunk by chunk, so a multi-megabyte data URL is never
+materialized as a Python string on the request path.
+
+Preprocessing needs the optional ``Pillow`` package; without it images are
+sent unchanged (but still cached).
+"""
+import base64
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+from typing import Dict, Iterator, Optional, Tuple
+
+try:
+    from PIL import Image, ImageOps  # type: ignore
+except Exception:  # pragma: no cover - optional dependency
+    Image = None
+    ImageOps = None
+
+
+PREPROCESS_ENABLED = os.getenv("AI_GRADING_IMAGE_PREPROCESS", "true").lower() == "true"
+MAX_EDGE = int(os.getenv("AI_GRADING_IMAGE_MAX_EDGE", "2048"))
+GRAYSCALE = os.getenv("AI_GRADING_IMAGE_GRAYSCALE", "true").lower() == "true"
+JPEG_QUALITY = int(os.getenv("AI_GRADING_IMAGE_QUALITY", "80"))
+CROP_MARGINS = os.getenv("AI_GRADING_IMAGE_CROP_MARGINS", "true").lower() == "true"
+# Pixels darker than this (0-255) count as ink when looking for blank margins.
+CROP_THRESHOLD = int(os.getenv("AI_GRADING_IMAGE_CROP_THRESHOLD", "200"))
+CROP_PADDING = int(os.getenv("AI_GRADING_IMAGE_CROP_PADDING", "24"))
+CACHE_DIR = os.getenv("AI_GRADING_IMAGE_CACHE_DIR") or os.path.join(
+    tempfile.gettempdir(), "ai-grading-image-cache"
+)
+CACHE_ENABLED = os.getenv("AI_GRADING_IMAGE_CACHE", "true").lower() == "true"
+CACHE_TTL_SECONDS = int(os.getenv("AI_GRADING_IMAGE_CACHE_TTL_SECONDS", "604800"))
+CACHE_MAX_BYTES = int(float(os.getenv("AI_GRADING_IMAGE_CACHE_MAX_MB", "1024")) * 1024 * 1024)
+# Prune the disk cache at most this often per process.
+PRUNE_INTERVAL_SECONDS = 60
+
+_last_prune = 0.0
+
+
+def guess_mime(path: str) -> str:
+    lower = path.lower()
+    if lower.endswith(".png"):
+        return "image/png"
+    if lower.endswith(".jpg") or lower.endswith(".jpeg"):
+        return "image/jpeg"
+    if lower.endswith(".webp"):
+        return "image/webp"
+    return "application/octet-stream"
+
+
+def preprocessing_settings() -> Dict:
+    if not PREPROCESS_ENABLED or Image is None:
+        return {"preprocess": False}
+    return {
+        "preprocess": True,
+        "maxEdge": MAX_EDGE,
+        "grayscale": GRAYSCALE,
+        "quality": JPEG_QUALITY,
+        "crop": CROP_MARGINS,
+        "cropThreshold": CROP_THRESHOLD,
+        "cropPadding": CROP_PADDING,
+    }
+
+
+def settings_digest() -> str:
+    raw = json.dumps(preprocessing_settings(), sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def crop_blank_margins(image):
+    # Bounding box of everything darker than the paper, plus some padding.
+    gray = image.convert("L")
+    mask = gray.point(lambda value: 255 if value < CROP_THRESHOLD else 0)
+    bbox = mask.getbbox()
+    if not bbox:
+        return image
+    left, top, right, bottom = bbox
+    width, height = image.size
+    box = (
+        max(0, left - CROP_PADDING),
+        max(0, top - CROP_PADDING),
+        min(width, right + CROP_PADDING),
+        min(height, bottom + CROP_PADDING),
+    )
+    if box == (0, 0, width, height):
+        return image
+    return image.crop(box)
+
+
+def preprocess_image(raw: bytes) -> Optional[Tuple[str, bytes]]:
+    # Returns (mime, bytes) of the processed image, or None to send raw bytes.
+    if not PREPROCESS_ENABLED or Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(raw)) as opened:
+            image = ImageOps.exif_transpose(opened)
+            if image.mode in ("RGBA", "LA", "P"):
+                image = image.convert("RGBA")
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                background.paste(image, mask=image.split()[-1])
+                image = background
+            if CROP_MARGINS:
+                image = crop_blank_margins(image)
+            if MAX_EDGE > 0 and max(image.size) > MAX_EDGE:
+                image.thumbnail((MAX_EDGE, MAX_EDGE), Image.LANCZOS)
+            image = image.convert("L" if GRAYSCALE else "RGB")
+            out = io.BytesIO()
+            image.save(out, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+    except Exception:
+        # Unreadable or unsupported images go to the model as they are.
+        return None
+    return "image/jpeg", out.getvalue()
+
+
+class EncodedImage:
+    # A data URL that is never held as one big string: it is streamed into the
+    # request body from the disk cache, the source file or the processed bytes.
+    # Messages hold a reference to it, so the full and suffix inputs share it.
+    CHUNK_SIZE = 3 * 64 * 1024
+
+    def __init__(
+        self,
+        mime: str,
+        *,
+        data_url_path: Optional[str] = None,
+        source_path: Optional[str] = None,
+        data: Optional[bytes] = None,
+    ):
+        self.mime = mime
+        self.data_url_path = data_url_path
+        self.source_path = source_path
+        self.data = data
+        if data_url_path:
+            self.size = os.path.getsize(data_url_path)
+        else:
+            raw_size = len(data) if data is not None else os.path.getsize(source_path)
+            self.size = len(self.header()) + 4 * ((raw_size + 2) // 3)
+
+    def header(self) -> bytes:
+        return f"data:{self.mime};base64,".encode("ascii")
+
+    def iter_bytes(self) -> Iterator[bytes]:
+        if self.data_url_path:
+            with open(self.data_url_path, "rb") as f:
+                while True:
+                    chunk = f.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        return
+                    yield chunk
+        yield self.header()
+        if self.data is not None:
+            view = memoryview(self.data)
+            for offset in range(0, len(view), self.CHUNK_SIZE):
+                yield base64.b64encode(view[offset : offset + self.CHUNK_SIZE])
+            return
+        with open(self.source_path, "rb") as f:
+            while True:
+                chunk = f.read(self.CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield base64.b64encode(chunk)
+
+    def read_text(self) -> str:
+        return b"".join(self.iter_bytes()).decode("ascii")
+
+
+def cache_path(content_sha256: str) -> str:
+    key = f"{content_sha256}-{settings_digest()}"
+    return os.path.join(CACHE_DIR, key[:2], f"{key}.txt")
+
+
+def write_cached(path: str, image: EncodedImage) -> bool:
+    tmp_path = None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            for chunk in image.iter_bytes():
+                f.write(chunk)
+        os.replace(tmp_path, path)
+        return True
+    except OSError:
+        if tmp_path and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        return False
+
+
+def prune_cache() -> None:
+    # Drop entries unused for CACHE_TTL_SECONDS (hits refresh the mtime),
+    # then the least recently used ones until under CACHE_MAX_BYTES.
+    global _last_prune
+    now = time.time()
+    if now - _last_prune < PRUNE_INTERVAL_SECONDS:
+        return
+    _last_prune = now
+    entries = []
+    total = 0
+    for root, _dirs, files in os.walk(CACHE_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if now - stat.st_mtime > CACHE_TTL_SECONDS:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+    entries.sort()
+    for _mtime, size, path in entries:
+        if total <= CACHE_MAX_BYTES:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        total -= size
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def prepare_image(path: str) -> EncodedImage:
+    # Preprocess a local image into a data URL that ARK accepts, going
+    # through the disk cache when it is enabled.
+    target = None
+    if CACHE_ENABLED:
+        target = cache_path(file_sha256(path))
+        try:
+            os.utime(target)
+            return EncodedImage("", data_url_path=target)
+        except OSError:
+            pass
+
+    image = EncodedImage(guess_mime(path), source_path=path)
+    if PREPROCESS_ENABLED and Image is not None:
+        with open(path, "rb") as f:
+            raw = f.read()
+        processed = preprocess_image(raw)
+        if processed is not None and len(processed[1]) < len(raw):
+            image = EncodedImage(processed[0], data=processed[1])
+    if target:
+        # Before writing, so the new entry is never the one evicted.
+        prune_cache()
+    if target and write_cached(target, image):
+        return EncodedImage(image.mime, data_url_path=target)
+    return image
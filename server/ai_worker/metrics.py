@@ -0,0 +1,274 @@
+"""Per-phase timings and counters for grader runs.
+
+Each graded submission (or warmup) runs inside ``metrics.run(mode)``; code on
+the request path records into the current run with ``phase(...)``,
+``count(...)`` and ``label(...)``. When the run ends:
+
+- a ``{"event": "grader-metrics", ...}`` JSON line is written to stderr
+  (``AI_GRADING_METRICS_LOG=false`` turns it off);
+- if ``AI_GRADING_METRICS_TEXTFILE`` is set, the run is merged into cumulative
+  counters shared by every grader process (a JSON state file next to it,
+  guarded by ``flock``) and the file is rewritten in the Prometheus text
+  format, ready for the node exporter textfile collector or the server's
+  ``/metrics`` endpoint;
+- if ``AI_GRADING_METRICS_PUSHGATEWAY_URL`` is set, the same cumulative
+  metrics are pushed to a Pushgateway.
+
+``profile(out_dir)`` wraps one run in cProfile and tracemalloc.
+"""
+import contextlib
+import contextvars
+import cProfile
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+from typing import Dict, Iterator, Optional
+
+try:
+    import fcntl
+except Exception:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+
+LOG_ENABLED = os.getenv("AI_GRADING_METRICS_LOG", "true").lower() == "true"
+TEXTFILE_PATH = os.getenv("AI_GRADING_METRICS_TEXTFILE", "")
+PUSHGATEWAY_URL = os.getenv("AI_GRADING_METRICS_PUSHGATEWAY_URL", "").rstrip("/")
+STATE_PATH = (
+    TEXTFILE_PATH or os.path.join(tempfile.gettempdir(), "ai-grader-metrics.prom")
+) + ".json"
+PUSH_TIMEOUT_SECONDS = 2.0
+PHASE_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160]
+
+_current: contextvars.ContextVar = contextvars.ContextVar("grader_run", default=None)
+
+
+class RunMetrics:
+    def __init__(self, mode: str):
+        self.mode = mode
+        self.started = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.counters: Dict[str, float] = {}
+        self.labels: Dict[str, str] = {}
+
+    def as_dict(self) -> Dict:
+        return {
+            "event": "grader-metrics",
+            "mode": self.mode,
+            "totalSeconds": round(time.perf_counter() - self.started, 4),
+            "phases": {name: round(value, 4) for name, value in self.phases.items()},
+            "counters": self.counters,
+            "labels": self.labels,
+        }
+
+
+def current() -> Optional[RunMetrics]:
+    return _current.get()
+
+
+@contextlib.contextmanager
+def phase(name: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(name, time.perf_counter() - started)
+
+
+def record_phase(name: str, seconds: float) -> None:
+    run = _current.get()
+    if run is not None:
+        run.phases[name] = run.phases.get(name, 0.0) + seconds
+
+
+def count(name: str, value: float = 1) -> None:
+    run = _current.get()
+    if run is not None:
+        run.counters[name] = run.counters.get(name, 0) + value
+
+
+def label(name: str, value: str) -> None:
+    run = _current.get()
+    if run is not None:
+        run.labels[name] = value
+
+
+def record_usage(usage: Optional[Dict]) -> None:
+    # Responses API usage, including prefix-cache hits on the provider side.
+    if not isinstance(usage, dict):
+        return
+    count("input_tokens", usage.get("input_tokens") or 0)
+    count("output_tokens", usage.get("output_tokens") or 0)
+    details = usage.get("input_tokens_details") or {}
+    if isinstance(details, dict):
+        count("cached_tokens", details.get("cached_tokens") or 0)
+
+
+@contextlib.contextmanager
+def run(mode: str) -> Iterator[RunMetrics]:
+    metrics = RunMetrics(mode)
+    token = _current.set(metrics)
+    outcome = "ok"
+    try:
+        yield metrics
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        _current.reset(token)
+        metrics.labels.setdefault("outcome", outcome)
+        emit(metrics)
+
+
+def emit(metrics: RunMetrics) -> None:
+    snapshot = metrics.as_dict()
+    if LOG_ENABLED:
+        print(json.dumps(snapshot, ensure_ascii=False), file=sys.stderr, flush=True)
+    if not TEXTFILE_PATH and not PUSHGATEWAY_URL:
+        return
+    try:
+        text = merge_and_render(snapshot)
+    except Exception as exc:
+        print(f"Metrics export failed: {exc}", file=sys.stderr)
+        return
+    if PUSHGATEWAY_URL:
+        push(text)
+
+
+def merge_and_render(snapshot: Dict) -> str:
+    # Cumulative state survives short-lived processes: read, merge, write
+    # back under an exclusive lock, then render the Prometheus text file.
+    os.makedirs(os.path.dirname(os.path.abspath(STATE_PATH)), exist_ok=True)
+    with open(STATE_PATH, "a+", encoding="utf-8") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        raw = f.read()
+        state = json.loads(raw) if raw.strip() else {}
+        merge(state, snapshot)
+        f.seek(0)
+        f.truncate()
+        json.dump(state, f)
+        f.flush()
+        text = render(state)
+        if TEXTFILE_PATH:
+            tmp_path = f"{TEXTFILE_PATH}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as out:
+                out.write(text)
+            os.replace(tmp_path, TEXTFILE_PATH)
+    return text
+
+
+def merge(state: Dict, snapshot: Dict) -> None:
+    mode = snapshot["mode"]
+    labels = snapshot.get("labels") or {}
+    runs = state.setdefault("runs", {})
+    run_key = f"{mode}|{labels.get('outcome', 'ok')}"
+    runs[run_key] = runs.get(run_key, 0) + 1
+    phases = dict(snapshot.get("phases") or {}, total=snapshot["totalSeconds"])
+    histograms = state.setdefault("phases", {})
+    for name, seconds in phases.items():
+        entry = histograms.setdefault(
+            name, {"buckets": [0] * len(PHASE_BUCKETS), "count": 0, "sum": 0.0}
+        )
+        for index, bound in enumerate(PHASE_BUCKETS):
+            if seconds <= bound:
+                entry["buckets"][index] += 1
+        entry["count"] += 1
+        entry["sum"] += seconds
+    counters = state.setdefault("counters", {})
+    for name, value in (snapshot.get("counters") or {}).items():
+        counters[name] = counters.get(name, 0) + value
+    for name in ("prefix_cache", "result_cache", "cascade_tier"):
+        if name in labels:
+            key = f"{name}|{labels[name]}"
+            counters[key] = counters.get(key, 0) + 1
+
+
+def render(state: Dict) -> str:
+    lines = [
+        "# HELP ai_grader_runs_total Grader runs by mode and outcome.",
+        "# TYPE ai_grader_runs_total counter",
+    ]
+    for key, value in sorted((state.get("runs") or {}).items()):
+        mode, outcome = key.split("|", 1)
+        lines.append(f'ai_grader_runs_total{{mode="{mode}",outcome="{outcome}"}} {value}')
+    lines += [
+        "# HELP ai_grader_phase_seconds Time spent per grader phase.",
+        "# TYPE ai_grader_phase_seconds histogram",
+    ]
+    for name, entry in sorted((state.get("phases") or {}).items()):
+        for bound, bucket in zip(PHASE_BUCKETS, entry["buckets"]):
+            lines.append(
+                f'ai_grader_phase_seconds_bucket{{phase="{name}",le="{bound}"}} {bucket}'
+            )
+        lines.append(
+            f'ai_grader_phase_seconds_bucket{{phase="{name}",le="+Inf"}} {entry["count"]}'
+        )
+        lines.append(f'ai_grader_phase_seconds_sum{{phase="{name}"}} {entry["sum"]:.6f}')
+        lines.append(f'ai_grader_phase_seconds_count{{phase="{name}"}} {entry["count"]}')
+    plain = {}
+    labelled: Dict[str, Dict[str, float]] = {}
+    for key, value in (state.get("counters") or {}).items():
+        if "|" in key:
+            name, result = key.split("|", 1)
+            labelled.setdefault(name, {})[result] = value
+        else:
+            plain[key] = value
+    for name, results in sorted(labelled.items()):
+        lines += [
+            f"# HELP ai_grader_{name}_total {name.replace('_', ' ').capitalize()} lookups by result.",
+            f"# TYPE ai_grader_{name}_total counter",
+        ]
+        for result, value in sorted(results.items()):
+            lines.append(f'ai_grader_{name}_total{{result="{result}"}} {value}')
+    for name, value in sorted(plain.items()):
+        lines += [f"# TYPE ai_grader_{name}_total counter", f"ai_grader_{name}_total {value}"]
+    return "\n".join(lines) + "\n"
+
+
+def push(text: str) -> None:
+    instance = socket.gethostname()
+    url = f"{PUSHGATEWAY_URL}/metrics/job/ai_grader/instance/{instance}"
+    req = urllib.request.Request(
+        url,
+        data=text.encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4"},
+        method="PUT",
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=PUSH_TIMEOUT_SECONDS) as resp:
+            resp.read()
+    except Exception as exc:
+        print(f"Metrics push failed: {exc}", file=sys.stderr)
+
+
+@contextlib.contextmanager
+def profile(out_dir: Optional[str]) -> Iterator[None]:
+    # cProfile stats (open with `python -m pstats` or snakeviz) and the top
+    # tracemalloc allocation sites for one run.
+    if not out_dir:
+        yield
+        return
+    os.makedirs(out_dir, exist_ok=True)
+    prefix = os.path.join(out_dir, f"grader-{os.getpid()}-{int(time.time())}")
+    profiler = cProfile.Profile()
+    tracemalloc.start(25)
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        _current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        profiler.dump_stats(f"{prefix}.prof")
+        with open(f"{prefix}-memory.txt", "w", encoding="utf-8") as f:
+            f.write(f"peak traced memory: {peak_bytes} bytes\n\n")
+            for stat in snapshot.statistics("lineno")[:40]:
+                f.write(f"{stat}\n")
+        print(f"Profile written to {prefix}.prof and {prefix}-memory.txt", file=sys.stderr)
@@ -0,0 +1,265 @@
+"""Redis queue consumer for grader requests (``grader.py consume``).
+
+``grader.py serve`` only ever grades for the Node process that spawned it.
+In consumer mode any number of grader processes, on any host, pop requests
+from the Redis list ``AI_GRADING_CONSUMER_QUEUE`` and push progress events
+and the final reply onto ``<AI_GRADING_CONSUMER_REPLY_PREFIX><id>``, where
+the waiting Node worker picks them up. Requests and replies have the same
+shape as serve mode's JSON lines. Postgres stays with the Node worker: it
+still takes jobs off ``ai_grading_jobs``, loads the submission and records
+the result; the consumer only grades.
+
+Each process runs up to ``--concurrency`` requests at a time on an asyncio
+loop (the grading itself runs in worker threads) and only pops a request when
+a slot is free, so the backlog stays in Redis for whichever consumer frees up
+first. Requests whose ``deadline`` (epoch milliseconds) passed while they
+were queued are answered with an error instead of being graded, and
+publishing a request id on ``AI_GRADING_CONSUMER_CANCEL_CHANNEL`` cancels it.
+SIGTERM or SIGINT stops popping and lets running requests finish for up to
+``AI_GRADING_CONSUMER_DRAIN_SECONDS`` before they are cancelled.
+
+A request is moved (``BLMOVE``) into this consumer's own processing list and
+only removed once its reply is out. Consumers keep a heartbeat key alive;
+when one stops refreshing it (the process crashed or was killed), the others
+move its processing list back onto the queue, so no request is lost.
+"""
+import asyncio
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Set
+
+try:
+    from redis import asyncio as redis_asyncio  # type: ignore
+except Exception:  # pragma: no cover - optional dependency
+    redis_asyncio = None
+
+
+REDIS_URL = os.getenv("AI_GRADING_CONSUMER_REDIS_URL") or os.getenv(
+    "REDIS_URL", "redis://localhost:6379"
+)
+QUEUE_KEY = os.getenv("AI_GRADING_CONSUMER_QUEUE", "ai_grading:grader_requests")
+REPLY_PREFIX = os.getenv("AI_GRADING_CONSUMER_REPLY_PREFIX", "ai_grading:grader_replies:")
+CANCEL_CHANNEL = os.getenv("AI_GRADING_CONSUMER_CANCEL_CHANNEL", "ai_grading:grader_cancel")
+REPLY_TTL_SECONDS = int(os.getenv("AI_GRADING_CONSUMER_REPLY_TTL_SECONDS", "600"))
+DRAIN_SECONDS = float(os.getenv("AI_GRADING_CONSUMER_DRAIN_SECONDS", "120"))
+# Short blocking pops, so a stop request is noticed quickly.
+POP_TIMEOUT_SECONDS = 1
+# After the drain, cancelled requests get this long to send their reply.
+CANCEL_GRACE_SECONDS = 10
+# Consumers refresh their heartbeat (and look for dead consumers) this often;
+# a consumer silent for HEARTBEAT_TTL_SECONDS counts as dead.
+HEARTBEAT_SECONDS = 10
+HEARTBEAT_TTL_SECONDS = 30
+CONSUMERS_KEY = f"{QUEUE_KEY}:consumers"
+
+# handle(request, reply, cancel_event) grades one request in a worker thread
+# and reports through reply(message).
+Handler = Callable[[Dict, Callable[[Dict], None], threading.Event], None]
+
+
+def parse_request(raw: str) -> Optional[Dict]:
+    try:
+        request = json.loads(raw)
+    except ValueError:
+        return None
+    if not isinstance(request, dict) or not request.get("id"):
+        return None
+    return request
+
+
+def processing_key(consumer_id: str) -> str:
+    return f"{QUEUE_KEY}:processing:{consumer_id}"
+
+
+def heartbeat_key(consumer_id: str) -> str:
+    return f"{QUEUE_KEY}:alive:{consumer_id}"
+
+
+async def requeue_dead_consumers(client, consumer_id: str) -> int:
+    # Put the unanswered requests of consumers without a heartbeat back at
+    # the head of the queue. LMOVE is atomic, so each request moves once
+    # even when several consumers recover the same list.
+    moved = 0
+    for other in await client.smembers(CONSUMERS_KEY):
+        if other == consumer_id or await client.exists(heartbeat_key(other)):
+            continue
+        while await client.lmove(processing_key(other), QUEUE_KEY, "RIGHT", "RIGHT"):
+            moved += 1
+        await client.srem(CONSUMERS_KEY, other)
+    return moved
+
+
+def is_expired(request: Dict) -> bool:
+    deadline = request.get("deadline")
+    try:
+        return bool(deadline) and time.time() * 1000 > float(deadline)
+    except (TypeError, ValueError):
+        return False
+
+
+async def consume(handle: Handler, *, concurrency: int) -> None:
+    client = redis_asyncio.Redis.from_url(REDIS_URL, decode_responses=True)
+    consumer_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    processing = processing_key(consumer_id)
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+    slots = asyncio.Semaphore(concurrency)
+    cancel_events: Dict[str, threading.Event] = {}
+    tasks: Set[asyncio.Task] = set()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def push(request_id: str, message: Dict) -> None:
+        key = f"{REPLY_PREFIX}{request_id}"
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.lpush(key, json.dumps(message, ensure_ascii=False))
+            pipe.expire(key, REPLY_TTL_SECONDS)
+            await pipe.execute()
+
+    def reply_for(request_id: str) -> Callable[[Dict], None]:
+        # Called from the grading thread; waiting keeps the events in order.
+        def reply(message: Dict) -> None:
+            asyncio.run_coroutine_threadsafe(push(request_id, message), loop).result()
+
+        return reply
+
+    async def ack(raw: str) -> None:
+        try:
+            await client.lrem(processing, 1, raw)
+        except Exception as exc:
+            print(f"Grader request ack failed: {exc}", file=sys.stderr)
+
+    async def run_request(request: Dict, raw: str) -> None:
+        request_id = str(request["id"])
+        cancel_event = threading.Event()
+        cancel_events[request_id] = cancel_event
+        try:
+            await loop.run_in_executor(
+                executor, handle, request, reply_for(request_id), cancel_event
+            )
+        except Exception as exc:
+            print(f"Grader request {request_id} failed: {exc}", file=sys.stderr)
+        finally:
+            cancel_events.pop(request_id, None)
+            # Acknowledged even when the handler failed, so a request that
+            # breaks the handler is not graded over and over.
+            await ack(raw)
+            slots.release()
+
+    async def keep_alive() -> None:
+        while True:
+            try:
+                await client.set(
+                    heartbeat_key(consumer_id), str(os.getpid()), ex=HEARTBEAT_TTL_SECONDS
+                )
+                await client.sadd(CONSUMERS_KEY, consumer_id)
+                moved = await requeue_dead_consumers(client, consumer_id)
+                if moved:
+                    print(f"Requeued {moved} requests of dead consumers.", file=sys.stderr)
+            except Exception as exc:
+                print(f"Grader consumer heartbeat failed: {exc}", file=sys.stderr)
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+
+    async def listen_for_cancels() -> None:
+        pubsub = client.pubsub()
+        await pubsub.subscribe(CANCEL_CHANNEL)
+        try:
+            async for message in pubsub.listen():
+                if message.get("type") != "message":
+                    continue
+                cancel_event = cancel_events.get(str(message.get("data")))
+                if cancel_event is not None:
+                    cancel_event.set()
+        finally:
+            await pubsub.aclose()
+
+    listener = asyncio.create_task(listen_for_cancels())
+    heartbeat = asyncio.create_task(keep_alive())
+    print(
+        json.dumps(
+            {
+                "event": "consumer-ready",
+                "pid": os.getpid(),
+                "concurrency": concurrency,
+                "queue": QUEUE_KEY,
+                "consumer": consumer_id,
+            }
+        ),
+        file=sys.stderr,
+        flush=True,
+    )
+    try:
+        while not stopping.is_set():
+            await slots.acquire()
+            if stopping.is_set():
+                slots.release()
+                break
+            try:
+                raw = await client.blmove(
+                    QUEUE_KEY, processing, POP_TIMEOUT_SECONDS, src="RIGHT", dest="LEFT"
+                )
+            except Exception as exc:
+                slots.release()
+                print(f"Grader queue pop failed: {exc}", file=sys.stderr)
+                await asyncio.sleep(1)
+                continue
+            if raw is None:
+                slots.release()
+                continue
+            request = parse_request(raw)
+            if request is None:
+                print(f"Skip invalid grader request: {raw[:200]}", file=sys.stderr)
+                await ack(raw)
+                slots.release()
+                continue
+            if is_expired(request):
+                try:
+                    await push(
+                        str(request["id"]),
+                        {"id": request["id"], "ok": False, "error": "Request expired in the queue."},
+                    )
+                finally:
+                    await ack(raw)
+                    slots.release()
+                continue
+            task = asyncio.create_task(run_request(request, raw))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            _done, pending = await asyncio.wait(set(tasks), timeout=DRAIN_SECONDS)
+            if pending:
+                for cancel_event in cancel_events.values():
+                    cancel_event.set()
+                await asyncio.wait(pending, timeout=CANCEL_GRACE_SECONDS)
+    finally:
+        listener.cancel()
+        # Grading threads still report through this loop: wait for them
+        # (cancelled ones stop at their next check) before it closes.
+        await loop.run_in_executor(None, executor.shutdown, True)
+        heartbeat.cancel()
+        try:
+            # Anything left unanswered goes back to the queue right away.
+            while await client.lmove(processing, QUEUE_KEY, "RIGHT", "RIGHT"):
+                pass
+            await client.delete(heartbeat_key(consumer_id))
+            await client.srem(CONSUMERS_KEY, consumer_id)
+        except Exception as exc:
+            print(f"Grader consumer cleanup failed: {exc}", file=sys.stderr)
+        await client.aclose()
+
+
+def run(handle: Handler, *, concurrency: int) -> int:
+    if redis_asyncio is None:
+        print("grader.py consume needs the redis package.", file=sys.stderr)
+        return 2
+    asyncio.run(consume(handle, concurrency=max(1, concurrency)))
+    return 0
@@ -0,0 +1,181 @@
+"""Shared request/token rate limit and retry backoff for model calls.
+
+Every grader process takes from the same two token buckets before calling the
+model: one for requests per minute (``AI_GRADING_RATE_LIMIT_RPM``) and one for
+estimated tokens per minute (``AI_GRADING_RATE_LIMIT_TPM``). The buckets live
+in Redis and are updated atomically by a Lua script, so serve pools, batch
+runs and one-shot processes on every worker node stay under the provider
+quota together. Without Redis each process falls back to a local bucket.
+A limit of 0 disables that bucket.
+"""
+import json
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+import capabilities
+
+
+RPM_LIMIT = int(os.getenv("AI_GRADING_RATE_LIMIT_RPM", "0"))
+TPM_LIMIT = int(os.getenv("AI_GRADING_RATE_LIMIT_TPM", "0"))
+MAX_WAIT_SECONDS = float(os.getenv("AI_GRADING_RATE_LIMIT_MAX_WAIT_SECONDS", "60"))
+REDIS_URL = (
+    os.getenv("AI_GRADING_RATE_LIMIT_REDIS_URL")
+    or os.getenv("AI_GRADING_PREFIX_CACHE_REDIS_URL")
+    or os.getenv("REDIS_URL", "")
+)
+REDIS_KEY_PREFIX = "ai-grading:ratelimit:"
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("AI_GRADING_RETRY_MAX_ATTEMPTS", "4"))
+RETRY_BASE_DELAY_SECONDS = float(os.getenv("AI_GRADING_RETRY_BASE_DELAY_SECONDS", "1"))
+RETRY_MAX_DELAY_SECONDS = float(os.getenv("AI_GRADING_RETRY_MAX_DELAY_SECONDS", "30"))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Rough request size estimate used for the TPM bucket.
+CHARS_PER_TOKEN = float(os.getenv("AI_GRADING_CHARS_PER_TOKEN", "1.5"))
+IMAGE_TOKENS = int(os.getenv("AI_GRADING_IMAGE_TOKENS", "1500"))
+DEFAULT_OUTPUT_TOKENS = int(os.getenv("AI_GRADING_DEFAULT_OUTPUT_TOKENS", "1024"))
+
+# Refill both buckets from Redis server time, then take the cost from both or
+# from neither. Returns 0 when granted, else the milliseconds to wait.
+TAKE_SCRIPT = """
+local now = redis.call("TIME")
+local now_ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local wait = 0
+local levels = {}
+for i = 1, #KEYS do
+    local capacity = tonumber(ARGV[i * 2 - 1])
+    local cost = tonumber(ARGV[i * 2])
+    local state = redis.call("HMGET", KEYS[i], "level", "ts")
+    local level = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now_ms
+    level = math.min(capacity, level + (now_ms - ts) * capacity / 60000)
+    levels[i] = level
+    if cost > level then
+        wait = math.max(wait, math.ceil((cost - level) * 60000 / capacity))
+    end
+end
+for i = 1, #KEYS do
+    local level = levels[i]
+    if wait == 0 then
+        level = level - tonumber(ARGV[i * 2])
+    end
+    redis.call("HSET", KEYS[i], "level", level, "ts", now_ms)
+    redis.call("PEXPIRE", KEYS[i], 120000)
+end
+return wait
+"""
+
+_local_buckets: Dict[str, Dict[str, float]] = {}
+_local_lock = threading.Lock()
+
+
+class RateLimitTimeout(RuntimeError):
+    pass
+
+
+def get_redis_client():
+    return capabilities.redis_client(REDIS_URL)
+
+
+def estimate_tokens(payload: Dict) -> int:
+    # Characters of text plus a flat cost per image plus the output budget.
+    chars = 0
+    images = 0
+    for message in payload.get("input") or []:
+        for part in message.get("content") or []:
+            if part.get("type") == "input_image":
+                images += 1
+            else:
+                chars += len(str(part.get("text") or ""))
+    output = payload.get("max_output_tokens") or DEFAULT_OUTPUT_TOKENS
+    return int(chars / CHARS_PER_TOKEN) + images * IMAGE_TOKENS + int(output)
+
+
+def take_local(buckets: Dict[str, tuple]) -> float:
+    now = time.monotonic()
+    with _local_lock:
+        wait = 0.0
+        levels = {}
+        for name, (capacity, cost) in buckets.items():
+            state = _local_buckets.setdefault(name, {"level": capacity, "ts": now})
+            level = min(
+                capacity, state["level"] + (now - state["ts"]) * capacity / 60.0
+            )
+            levels[name] = level
+            if cost > level:
+                wait = max(wait, (cost - level) * 60.0 / capacity)
+        for name, (capacity, cost) in buckets.items():
+            level = levels[name] - (cost if wait == 0 else 0)
+            _local_buckets[name] = {"level": level, "ts": now}
+        return wait
+
+
+def take(buckets: Dict[str, tuple]) -> float:
+    client = get_redis_client()
+    if client:
+        keys = [f"{REDIS_KEY_PREFIX}{name}" for name in buckets]
+        args = []
+        for capacity, cost in buckets.values():
+            args.extend([capacity, cost])
+        try:
+            return int(client.eval(TAKE_SCRIPT, len(keys), *keys, *args)) / 1000.0
+        except Exception:
+            pass
+    return take_local(buckets)
+
+
+def acquire(
+    payload: Dict, cancel_event: Optional[threading.Event] = None
+) -> None:
+    # Block until both buckets allow this request, or give up after
+    # MAX_WAIT_SECONDS so the caller can surface a retryable error.
+    buckets = {}
+    if RPM_LIMIT > 0:
+        buckets["rpm"] = (RPM_LIMIT, 1)
+    if TPM_LIMIT > 0:
+        buckets["tpm"] = (TPM_LIMIT, min(TPM_LIMIT, estimate_tokens(payload)))
+    if not buckets:
+        return
+    deadline = time.monotonic() + MAX_WAIT_SECONDS
+    while True:
+        wait = take(buckets)
+        if wait <= 0:
+            return
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise RateLimitTimeout(
+                f"Rate limit wait exceeded {MAX_WAIT_SECONDS:.0f}s: "
+                + json.dumps({name: limit for name, (limit, _cost) in buckets.items()})
+            )
+        # Small jitter so waiting processes do not retry in lockstep.
+        delay = min(remaining, wait + random.uniform(0, 0.05))
+        if cancel_event is not None:
+            if cancel_event.wait(delay):
+                return
+        else:
+            time.sleep(delay)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    # Full-jitter exponential backoff; Retry-After from the server wins.
+    if retry_after is not None:
+        return min(retry_after, RETRY_MAX_DELAY_SECONDS)
+    ceiling = min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * (2 ** attempt))
+    return random.uniform(0, ceiling)
@@ -0,0 +1,184 @@
+"""Opt-in cache of model outputs for byte-identical grading requests.
+
+Retries, stale-job recovery and teacher re-triggers often send exactly the
+same request again. When ``AI_GRADING_RESULT_CACHE`` is ``redis`` or ``disk``,
+grader.py looks the request up by a hash of everything that reaches the model
+(question, options, student payload, image bytes, model, temperature, output
+limit and system prompt version) and returns the stored output instead of
+calling the API. Entries expire after ``AI_GRADING_RESULT_CACHE_TTL_SECONDS``;
+the Redis backend keeps at most ``AI_GRADING_RESULT_CACHE_MAX_ENTRIES`` keys
+and the disk backend at most ``AI_GRADING_RESULT_CACHE_MAX_MB`` megabytes,
+evicting the oldest entries first.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import capabilities
+
+
+BACKEND = os.getenv("AI_GRADING_RESULT_CACHE", "off").strip().lower()
+TTL_SECONDS = int(os.getenv("AI_GRADING_RESULT_CACHE_TTL_SECONDS", "86400"))
+MAX_ENTRIES = int(os.getenv("AI_GRADING_RESULT_CACHE_MAX_ENTRIES", "50000"))
+MAX_BYTES = int(float(os.getenv("AI_GRADING_RESULT_CACHE_MAX_MB", "256")) * 1024 * 1024)
+CACHE_DIR = os.getenv("AI_GRADING_RESULT_CACHE_DIR") or os.path.join(
+    tempfile.gettempdir(), "ai-grading-result-cache"
+)
+REDIS_URL = (
+    os.getenv("AI_GRADING_RESULT_CACHE_REDIS_URL")
+    or os.getenv("AI_GRADING_PREFIX_CACHE_REDIS_URL")
+    or os.getenv("REDIS_URL", "")
+)
+REDIS_KEY_PREFIX = "ai-grading:result:"
+REDIS_INDEX_KEY = f"{REDIS_KEY_PREFIX}index"
+# Prune the disk cache at most this often per process.
+DISK_PRUNE_INTERVAL_SECONDS = 60
+
+_last_prune = 0.0
+
+
+def enabled() -> bool:
+    return BACKEND in ("redis", "disk")
+
+
+def build_result_key(
+    *,
+    model: str,
+    temperature: float,
+    max_tokens: Optional[int],
+    system_prompt_digest: str,
+    json_payload: Dict,
+    image_digests: List[str],
+) -> str:
+    payload = {
+        "model": model,
+        "temperature": temperature,
+        "maxTokens": max_tokens,
+        "systemPrompt": system_prompt_digest,
+        "payload": json_payload,
+        "images": image_digests,
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def is_cacheable(content: str) -> bool:
+    # Only keep outputs the worker can parse (same rules as parseModelOutput);
+    # caching a broken output would make every retry fail the same way.
+    trimmed = content.strip()
+    candidates = [trimmed]
+    start, end = trimmed.find("{"), trimmed.rfind("}")
+    if start != -1 and end > start:
+        candidates.append(trimmed[start : end + 1])
+    for candidate in candidates:
+        try:
+            parsed = json.loads(candidate)
+        except ValueError:
+            continue
+        return isinstance(parsed, dict) and isinstance(parsed.get("result"), dict)
+    return False
+
+
+def get_redis_client():
+    return capabilities.redis_client(REDIS_URL)
+
+
+def disk_path(key: str) -> str:
+    return os.path.join(CACHE_DIR, key[:2], f"{key}.txt")
+
+
+def get(key: str) -> Optional[str]:
+    if BACKEND == "redis":
+        client = get_redis_client()
+        if not client:
+            return None
+        try:
+            value = client.get(f"{REDIS_KEY_PREFIX}{key}")
+        except Exception:
+            return None
+        return value if isinstance(value, str) else None
+    if BACKEND == "disk":
+        path = disk_path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > TTL_SECONDS:
+                os.unlink(path)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+    return None
+
+
+def put(key: str, content: str) -> None:
+    if BACKEND == "redis":
+        client = get_redis_client()
+        if not client:
+            return
+        try:
+            now = time.time()
+            pipe = client.pipeline()
+            pipe.set(f"{REDIS_KEY_PREFIX}{key}", content, ex=TTL_SECONDS)
+            pipe.zadd(REDIS_INDEX_KEY, {key: now})
+            pipe.zremrangebyscore(REDIS_INDEX_KEY, "-inf", now - TTL_SECONDS)
+            pipe.execute()
+            overflow = client.zcard(REDIS_INDEX_KEY) - MAX_ENTRIES
+            if overflow > 0:
+                oldest = client.zrange(REDIS_INDEX_KEY, 0, overflow - 1)
+                if oldest:
+                    client.delete(*[f"{REDIS_KEY_PREFIX}{item}" for item in oldest])
+                    client.zrem(REDIS_INDEX_KEY, *oldest)
+        except Exception:
+            return
+    elif BACKEND == "disk":
+        path = disk_path(key)
+        tmp_path = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except OSError:
+            if tmp_path and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            return
+        prune_disk()
+
+
+def prune_disk() -> None:
+    # Drop expired entries, then the oldest ones until under MAX_BYTES.
+    global _last_prune
+    now = time.time()
+    if now - _last_prune < DISK_PRUNE_INTERVAL_SECONDS:
+        return
+    _last_prune = now
+    entries = []
+    total = 0
+    for root, _dirs, files in os.walk(CACHE_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if now - stat.st_mtime > TTL_SECONDS:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+    entries.sort()
+    for _mtime, size, path in entries:
+        if total <= MAX_BYTES:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        total -= size
@@ -0,0 +1,326 @@
+"""MinHash/LSH index of student answers for plagiarism checks.
+
+Every (assignment, question) pair has its own index with one entry per
+student (the latest submission replaces older ones). An entry keeps the
+normalized answer text and its LSH band hashes: a one-permutation MinHash
+signature over character bigrams is split into ``AI_PLAGIARISM_LSH_BANDS``
+bands, and two answers become candidates when any band hashes to the same
+bucket. Only candidates are re-scored with the exact n-gram Jaccard the
+worker used before, so a query costs a few bucket lookups instead of a pass
+over the whole cohort.
+
+Indexes live in Redis when ``REDIS_URL`` (or the prefix-cache URL) is
+reachable, so every grader process shares them, and otherwise in JSON files
+under ``AI_PLAGIARISM_INDEX_DIR`` guarded by ``flock``. Entries expire after
+``AI_PLAGIARISM_INDEX_TTL_DAYS`` without writes to their index.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+try:
+    import fcntl
+except Exception:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+import capabilities
+
+
+MINHASH_SIZE = int(os.getenv("AI_PLAGIARISM_MINHASH_SIZE", "128"))
+BANDS = int(os.getenv("AI_PLAGIARISM_LSH_BANDS", "16"))
+TTL_SECONDS = int(float(os.getenv("AI_PLAGIARISM_INDEX_TTL_DAYS", "60")) * 86400)
+INDEX_DIR = os.getenv("AI_PLAGIARISM_INDEX_DIR") or os.path.join(
+    tempfile.gettempdir(), "ai-plagiarism-index"
+)
+REDIS_URL = (
+    os.getenv("AI_PLAGIARISM_INDEX_REDIS_URL")
+    or os.getenv("AI_GRADING_PREFIX_CACHE_REDIS_URL")
+    or os.getenv("REDIS_URL", "")
+)
+REDIS_KEY_PREFIX = "ai-plagiarism:"
+MAX_TEXT_LENGTH = 12000
+# Same rule as the worker's exact comparison: bigrams for short answers.
+SHORT_TEXT_LENGTH = 80
+
+ROWS = max(1, MINHASH_SIZE // max(1, BANDS))
+SIGNATURE_SIZE = ROWS * max(1, BANDS)
+
+
+
+def get_redis_client():
+    return capabilities.redis_client(REDIS_URL)
+
+
+def ngram_set(text: str, n: int) -> Set[str]:
+    if len(text) <= n:
+        return {text}
+    return {text[i : i + n] for i in range(len(text) - n + 1)}
+
+
+def text_similarity(text_a: str, text_b: str) -> float:
+    # Exact n-gram Jaccard, identical to the worker's computeTextSimilarity.
+    if not text_a or not text_b:
+        return 0.0
+    if text_a == text_b:
+        return 1.0
+    n = 2 if len(text_a) < SHORT_TEXT_LENGTH or len(text_b) < SHORT_TEXT_LENGTH else 3
+    grams_a = ngram_set(text_a, n)
+    grams_b = ngram_set(text_b, n)
+    intersection = len(grams_a & grams_b)
+    union = len(grams_a) + len(grams_b) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def minhash_signature(text: str) -> List[int]:
+    # One-permutation MinHash: each bigram is hashed once and kept as the
+    # minimum of one of SIGNATURE_SIZE bins; empty bins borrow from the next
+    # non-empty bin to the right (rotation densification).
+    bins: List[Optional[int]] = [None] * SIGNATURE_SIZE
+    for gram in ngram_set(text, 2):
+        value = int.from_bytes(
+            hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest(), "big"
+        )
+        rank, slot = divmod(value, SIGNATURE_SIZE)
+        current = bins[slot]
+        if current is None or rank < current:
+            bins[slot] = rank
+    signature = []
+    for index, value in enumerate(bins):
+        offset = 0
+        while value is None:
+            offset += 1
+            value = bins[(index + offset) % SIGNATURE_SIZE]
+        signature.append(value + offset * (1 << 58))
+    return signature
+
+
+def band_hashes(text: str) -> List[str]:
+    signature = minhash_signature(text)
+    bands = []
+    for band in range(SIGNATURE_SIZE // ROWS):
+        rows = signature[band * ROWS : (band + 1) * ROWS]
+        digest = hashlib.blake2b(",".join(map(str, rows)).encode("ascii"), digest_size=8)
+        bands.append(f"{band}:{digest.hexdigest()}")
+    return bands
+
+
+def index_name(assignment_id: str, question_id: str) -> str:
+    return f"{assignment_id}:{question_id}"
+
+
+def make_entry(item: Dict) -> Optional[Dict]:
+    text = str(item.get("text") or "")[:MAX_TEXT_LENGTH]
+    key = str(item.get("key") or "")
+    if not text or not key:
+        return None
+    return {
+        "key": key,
+        "submissionVersionId": str(item.get("submissionVersionId") or ""),
+        "text": text,
+        "bands": band_hashes(text),
+    }
+
+
+def rank_matches(
+    text: str, key: str, candidates: Iterable[Dict], threshold: float, limit: int
+) -> Tuple[List[Dict], float]:
+    matches = []
+    top = 0.0
+    for candidate in candidates:
+        if not candidate or candidate.get("key") == key:
+            continue
+        score = text_similarity(text, candidate.get("text") or "")
+        top = max(top, score)
+        if score >= threshold:
+            matches.append(
+                {
+                    "key": candidate["key"],
+                    "submissionVersionId": candidate.get("submissionVersionId") or "",
+                    "similarity": round(score, 6),
+                }
+            )
+    matches.sort(key=lambda item: item["similarity"], reverse=True)
+    return matches[:limit], top
+
+
+def redis_docs_key(name: str) -> str:
+    return f"{REDIS_KEY_PREFIX}{name}:docs"
+
+
+def redis_bucket_key(name: str, band: str) -> str:
+    return f"{REDIS_KEY_PREFIX}{name}:lsh:{band}"
+
+
+def redis_add(client, name: str, entries: List[Dict]) -> int:
+    docs_key = redis_docs_key(name)
+    old_values = client.hmget(docs_key, [entry["key"] for entry in entries])
+    pipe = client.pipeline()
+    for entry, old_value in zip(entries, old_values):
+        if old_value:
+            try:
+                old_bands = json.loads(old_value).get("bands") or []
+            except ValueError:
+                old_bands = []
+            for band in set(old_bands) - set(entry["bands"]):
+                pipe.srem(redis_bucket_key(name, band), entry["key"])
+        pipe.hset(docs_key, entry["key"], json.dumps(entry, ensure_ascii=False))
+        for band in entry["bands"]:
+            bucket_key = redis_bucket_key(name, band)
+            pipe.sadd(bucket_key, entry["key"])
+            pipe.expire(bucket_key, TTL_SECONDS)
+    pipe.expire(docs_key, TTL_SECONDS)
+    pipe.hlen(docs_key)
+    return int(pipe.execute()[-1])
+
+
+def redis_query(client, name: str, entry: Dict) -> Tuple[int, List[Dict]]:
+    pipe = client.pipeline()
+    pipe.hlen(redis_docs_key(name))
+    pipe.hexists(redis_docs_key(name), entry["key"])
+    for band in entry["bands"]:
+        pipe.smembers(redis_bucket_key(name, band))
+    results = pipe.execute()
+    keys: Set[str] = set()
+    for members in results[2:]:
+        keys.update(members or ())
+    keys.discard(entry["key"])
+    candidates = []
+    if keys:
+        for value in client.hmget(redis_docs_key(name), sorted(keys)):
+            if value:
+                candidates.append(json.loads(value))
+    return int(results[0]) - int(bool(results[1])), candidates
+
+
+def index_path(name: str) -> str:
+    digest = hashlib.sha256(name.encode("utf-8")).hexdigest()[:32]
+    return os.path.join(INDEX_DIR, f"{digest}.json")
+
+
+def update_index_file(name: str, update: Optional[Callable[[Dict], None]] = None) -> Dict:
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    with open(index_path(name), "a+", encoding="utf-8") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        raw = f.read()
+        try:
+            state = json.loads(raw) if raw.strip() else {}
+        except ValueError:
+            state = {}
+        state.setdefault("docs", {})
+        state.setdefault("buckets", {})
+        if update is not None:
+            update(state)
+            f.seek(0)
+            f.truncate()
+            json.dump(state, f, ensure_ascii=False)
+    return state
+
+
+def file_add(name: str, entries: List[Dict]) -> int:
+    def apply(state: Dict) -> None:
+        docs = state["docs"]
+        buckets = state["buckets"]
+        for entry in entries:
+            old = docs.get(entry["key"]) or {}
+            for band in set(old.get("bands") or []) - set(entry["bands"]):
+                members = buckets.get(band) or []
+                if entry["key"] in members:
+                    members.remove(entry["key"])
+                if not members:
+                    buckets.pop(band, None)
+            docs[entry["key"]] = entry
+            for band in entry["bands"]:
+                members = buckets.setdefault(band, [])
+                if entry["key"] not in members:
+                    members.append(entry["key"])
+
+    return len(update_index_file(name, apply)["docs"])
+
+
+def file_query(name: str, entry: Dict) -> Tuple[int, List[Dict]]:
+    path = index_path(name)
+    if not os.path.exists(path):
+        return 0, []
+    if time.time() - os.path.getmtime(path) > TTL_SECONDS:
+        os.remove(path)
+        return 0, []
+    state = update_index_file(name)
+    keys: Set[str] = set()
+    for band in entry["bands"]:
+        keys.update(state["buckets"].get(band) or ())
+    keys.discard(entry["key"])
+    peers = len(state["docs"]) - int(entry["key"] in state["docs"])
+    return peers, [state["docs"][key] for key in keys if key in state["docs"]]
+
+
+def store(name: str, entries: List[Dict]) -> int:
+    client = get_redis_client()
+    if client:
+        try:
+            return redis_add(client, name, entries)
+        except Exception:
+            pass
+    return file_add(name, entries)
+
+
+def lookup(name: str, entry: Dict) -> Tuple[int, List[Dict]]:
+    # Number of other entries and the entries sharing a bucket with entry.
+    client = get_redis_client()
+    if client:
+        try:
+            return redis_query(client, name, entry)
+        except Exception:
+            pass
+    return file_query(name, entry)
+
+
+def add(assignment_id: str, question_id: str, items: List[Dict]) -> Dict:
+    # Insert or replace entries ({"key", "submissionVersionId", "text"}).
+    name = index_name(assignment_id, question_id)
+    entries = [entry for entry in (make_entry(item) for item in items) if entry]
+    if not entries:
+        return {"size": query_size(name), "added": 0}
+    return {"size": store(name, entries), "added": len(entries)}
+
+
+def query_size(name: str) -> int:
+    client = get_redis_client()
+    if client:
+        try:
+            return int(client.hlen(redis_docs_key(name)))
+        except Exception:
+            pass
+    path = index_path(name)
+    return len(update_index_file(name)["docs"]) if os.path.exists(path) else 0
+
+
+def query(
+    assignment_id: str,
+    question_id: str,
+    item: Dict,
+    *,
+    threshold: float,
+    limit: int = 20,
+    insert: bool = True,
+) -> Dict:
+    # Peers whose exact similarity to item reaches threshold. "peers" counts
+    # the other entries of the index, so 0 means it was never populated.
+    name = index_name(assignment_id, question_id)
+    entry = make_entry(item)
+    if entry is None:
+        return {"peers": query_size(name), "candidates": 0, "topSimilarity": 0.0, "matches": []}
+    size, candidates = lookup(name, entry)
+    matches, top = rank_matches(entry["text"], entry["key"], candidates, threshold, limit)
+    if insert:
+        store(name, [entry])
+    return {
+        "peers": size,
+        "candidates": len(candidates),
+        "topSimilarity": round(top, 6),
+        "matches": matches,
+    }
@@ -0,0 +1,115 @@
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import grader  # noqa: E402
+
+QUESTION = {
+    "questionIndex": 3,
+    "rubric": [
+        {"rubricItemKey": "method", "maxScore": 6, "description": "思路"},
+        {"rubricItemKey": "answer", "maxScore": 4, "description": "结果"},
+    ],
+}
+
+# The regular output the Node worker's parseModelOutput/assertResultShape reads.
+FULL = {
+    "result": {
+        "comment": "思路正确，结果有误",
+        "confidence": 0.82,
+        "isUncertain": False,
+        "uncertaintyReasons": [{"code": "LOW_CONFIDENCE", "message": "置信度低于阈值"}],
+        "items": [
+            {
+                "questionIndex": 3,
+                "rubricItemKey": "method",
+                "score": 6,
+                "maxScore": 6,
+                "reason": "思路完整",
+                "uncertaintyScore": 0.1,
+            },
+            {
+                "questionIndex": 3,
+                "rubricItemKey": "answer",
+                "score": 1,
+                "maxScore": 4,
+                "reason": "计算错误",
+                "uncertaintyScore": 0.3,
+            },
+        ],
+        "totalScore": 7,
+    },
+    "extracted": {"studentMarkdown": "$x = 2$"},
+}
+
+COMPACT = {
+    "r": {
+        "c": "思路正确，结果有误",
+        "f": 0.82,
+        "u": False,
+        "w": [["LOW_CONFIDENCE", "置信度低于阈值"]],
+        "i": [[6, "思路完整", 0.1], [1, "计算错误", 0.3]],
+        "t": 7,
+    },
+    "m": "$x = 2$",
+}
+
+
+class CompactOutputTest(unittest.TestCase):
+    def test_compact_output_expands_to_full_shape(self):
+        content = grader.expand_compact_output(json.dumps(COMPACT, ensure_ascii=False), QUESTION)
+        self.assertEqual(json.loads(content), FULL)
+
+    def test_total_score_and_flags_are_filled_in(self):
+        compact = {"r": {"c": "", "f": 0.9, "u": 0, "w": [], "i": [[6, "", 0], [4, "", 0]]}}
+        result = json.loads(grader.expand_compact_output(json.dumps(compact), QUESTION))["result"]
+        self.assertIs(result["isUncertain"], False)
+        self.assertEqual(result["totalScore"], 10)
+        self.assertNotIn("extracted", json.loads(grader.expand_compact_output(json.dumps(compact), QUESTION)))
+
+    def test_regular_output_is_unchanged(self):
+        content = json.dumps(FULL, ensure_ascii=False)
+        self.assertEqual(grader.expand_compact_output(content, QUESTION), content)
+
+    def test_packed_entry_keeps_submission_version_id(self):
+        entry = {"submissionVersionId": "sv-1", "result": COMPACT["r"], "m": COMPACT["m"]}
+        expanded = grader.expand_compact_entry(entry, QUESTION)
+        self.assertEqual(expanded, dict(FULL, submissionVersionId="sv-1"))
+        self.assertIsNone(grader.validate_question_result({"questionIndex": 3, "question": QUESTION}, expanded))
+
+
+class ValidateQuestionResultTest(unittest.TestCase):
+    ENTRY = {"questionIndex": 3, "question": QUESTION}
+
+    def validate(self, mutate):
+        output = json.loads(json.dumps(FULL))
+        mutate(output["result"]["items"])
+        return grader.validate_question_result(self.ENTRY, output)
+
+    def test_every_rubric_item_is_graded_once(self):
+        self.assertEqual(self.validate(lambda items: items.pop()), "missing rubricItemKey answer")
+        self.assertEqual(
+            self.validate(lambda items: items.append(dict(items[0]))),
+            "duplicate rubricItemKey method",
+        )
+
+    def test_score_stays_within_max_score(self):
+        self.assertIsNotNone(self.validate(lambda items: items[1].update(score=5)))
+        self.assertIsNotNone(self.validate(lambda items: items[0].update(score=-1)))
+        self.assertIsNotNone(self.validate(lambda items: items[0].update(score="6")))
+
+
+class TruncationTest(unittest.TestCase):
+    def test_incomplete_response_is_truncated(self):
+        self.assertTrue(grader.is_truncated({"status": "incomplete"}))
+        self.assertTrue(
+            grader.is_truncated({"incomplete_details": {"reason": "max_output_tokens"}})
+        )
+        self.assertFalse(grader.is_truncated({"status": "completed", "incomplete_details": None}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,231 @@
+"""Prompt token estimates and the per-job input token budget for grader.py.
+
+Before a model call the grader estimates the input tokens of the prefix
+(system prompt and question) and of the suffix (student answer and photos).
+Text costs ``AI_GRADING_CHARS_PER_TOKEN`` characters per token, the same rate
+as the TPM rate limit; a photo costs one token per 28x28 pixel patch of the
+image the model sees, i.e. after the downscale to ``AI_GRADING_IMAGE_MAX_EDGE``
+and the provider's pixel cap for the requested detail level.
+
+When ``AI_GRADING_TOKEN_BUDGET`` is set and a job is over it, the request is
+degraded step by step until it fits:
+
+1. the tail of the student's answer text is cut, keeping at least
+   ``AI_GRADING_TOKEN_BUDGET_MIN_ANSWER_CHARS`` characters of every answer;
+2. photos are sent with ``detail: low``;
+3. duplicate photos (same bytes or the same pHash) are dropped.
+
+A job that still does not fit is rejected instead of being sent.
+
+Unless ``--max-tokens`` is given, ``max_output_tokens`` is derived from the
+question as well: a base for the comment and uncertainty reasons, a share per
+rubric item (smaller with ``AI_GRADING_COMPACT_OUTPUT``, which drops the
+repeated keys) and room for the transcription when ``returnStudentMarkdown``
+is on. ``AI_GRADING_AUTO_MAX_OUTPUT_TOKENS=false`` leaves it unset.
+"""
+import math
+import os
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from PIL import Image  # type: ignore
+except Exception:  # pragma: no cover - optional dependency
+    Image = None
+
+import image_hash
+import image_prep
+import rate_limit
+
+
+TOKEN_BUDGET = int(os.getenv("AI_GRADING_TOKEN_BUDGET", "0"))
+MIN_ANSWER_CHARS = int(os.getenv("AI_GRADING_TOKEN_BUDGET_MIN_ANSWER_CHARS", "1000"))
+TRUNCATION_MARK = "\n……（作答过长，以下内容已截断）"
+# One visual token per 28x28 patch; pixel caps per detail level (ARK vision).
+PIXELS_PER_TOKEN = 28 * 28
+MIN_IMAGE_PIXELS = 4 * PIXELS_PER_TOKEN
+MAX_IMAGE_PIXELS = {"high": 4014080, "low": 1048576}
+# Opt-in: a derived max_output_tokens that is too tight truncates the answer
+# (grader.py then retries once without it).
+AUTO_OUTPUT_TOKENS = os.getenv("AI_GRADING_AUTO_MAX_OUTPUT_TOKENS", "false").lower() == "true"
+OUTPUT_BASE_TOKENS = int(os.getenv("AI_GRADING_OUTPUT_BASE_TOKENS", "384"))
+OUTPUT_ITEM_TOKENS = int(os.getenv("AI_GRADING_OUTPUT_ITEM_TOKENS", "128"))
+# Transcription allowance per photo with returnStudentMarkdown.
+OUTPUT_MARKDOWN_TOKENS = int(os.getenv("AI_GRADING_OUTPUT_MARKDOWN_TOKENS", "2048"))
+# Reasoning ("thinking") tokens count against max_output_tokens as well.
+OUTPUT_REASONING_TOKENS = int(os.getenv("AI_GRADING_OUTPUT_REASONING_TOKENS", "4096"))
+# questionIndex / rubricItemKey / maxScore / uncertaintyScore keys per item.
+OUTPUT_ITEM_KEY_TOKENS = 32
+
+
+def text_tokens(text: str) -> int:
+    return math.ceil(len(text or "") / rate_limit.CHARS_PER_TOKEN)
+
+
+def output_tokens(
+    rubric_items: int,
+    *,
+    student_markdown: bool,
+    compact: bool,
+    images: int = 0,
+    answer_text: str = "",
+) -> int:
+    # max_output_tokens for one graded answer; 0 when the limit is not derived.
+    if not AUTO_OUTPUT_TOKENS:
+        return 0
+    per_item = OUTPUT_ITEM_TOKENS + (0 if compact else OUTPUT_ITEM_KEY_TOKENS)
+    tokens = OUTPUT_REASONING_TOKENS + OUTPUT_BASE_TOKENS + max(1, rubric_items) * per_item
+    if student_markdown:
+        # The markdown transcribes every photo plus the typed answer.
+        tokens += OUTPUT_MARKDOWN_TOKENS * max(1, images) + text_tokens(answer_text)
+    return tokens
+
+
+def sent_image_size(path: str) -> Optional[Tuple[int, int]]:
+    # Size after preprocessing (margin cropping aside), read from the header.
+    if Image is None:
+        return None
+    try:
+        with Image.open(path) as opened:
+            width, height = opened.size
+    except Exception:
+        return None
+    if image_prep.PREPROCESS_ENABLED and image_prep.MAX_EDGE > 0:
+        scale = min(1.0, image_prep.MAX_EDGE / max(width, height, 1))
+        width, height = int(width * scale), int(height * scale)
+    return width, height
+
+
+def image_tokens(size: Optional[Tuple[int, int]], detail: Optional[str] = None) -> int:
+    max_pixels = MAX_IMAGE_PIXELS["low" if detail == "low" else "high"]
+    if size is None:
+        # Unknown size: the flat rate-limit estimate, capped by the detail level.
+        return min(rate_limit.IMAGE_TOKENS, max_pixels // PIXELS_PER_TOKEN)
+    pixels = min(max(size[0] * size[1], MIN_IMAGE_PIXELS), max_pixels)
+    return math.ceil(pixels / PIXELS_PER_TOKEN)
+
+
+def duplicate_images(image_paths: List[str]) -> List[int]:
+    # Indexes of photos that repeat an earlier one.
+    kept: List[Dict[str, str]] = []
+    duplicates = []
+    for index, path in enumerate(image_paths):
+        try:
+            hashed = image_hash.hash_image(path) if image_hash.Image is not None else None
+        except OSError:
+            hashed = None
+        if hashed is None:
+            hashed = {"sha256": image_prep.file_sha256(path)}
+        if any(
+            hashed["sha256"] == other["sha256"]
+            or (
+                "phash" in hashed
+                and "phash" in other
+                and image_hash.image_distance(hashed, other) <= image_hash.MAX_DISTANCE
+            )
+            for other in kept
+        ):
+            duplicates.append(index)
+        else:
+            kept.append(hashed)
+    return duplicates
+
+
+def trim_answers(answers: List[str], excess_chars: int) -> List[str]:
+    # Cut the longest answers first: every answer keeps up to a common cap,
+    # chosen so the total shrinks by excess_chars, but never below
+    # MIN_ANSWER_CHARS.
+    total = sum(len(answer) for answer in answers)
+    target = max(0, total - excess_chars)
+    cap = max((len(answer) for answer in answers), default=0)
+    low = MIN_ANSWER_CHARS
+    if cap <= low:
+        return list(answers)
+    while low < cap:
+        middle = (low + cap + 1) // 2
+        if sum(min(len(answer), middle) for answer in answers) <= target:
+            low = middle
+        else:
+            cap = middle - 1
+    return [
+        answer if len(answer) <= low else answer[:low] + TRUNCATION_MARK
+        for answer in answers
+    ]
+
+
+def estimate(
+    *,
+    prefix_text: str,
+    suffix_text: str,
+    image_sizes: List[Optional[Tuple[int, int]]],
+    image_detail: Optional[str] = None,
+) -> Dict:
+    prefix_tokens = text_tokens(prefix_text)
+    image_total = sum(image_tokens(size, image_detail) for size in image_sizes)
+    suffix_tokens = text_tokens(suffix_text) + image_total
+    return {
+        "prefixTokens": prefix_tokens,
+        "suffixTokens": suffix_tokens,
+        "imageTokens": image_total,
+        "inputTokens": prefix_tokens + suffix_tokens,
+    }
+
+
+def fit(
+    *,
+    prefix_text: str,
+    suffix_text: str,
+    answers: List[str],
+    image_paths: List[str],
+    budget: int = TOKEN_BUDGET,
+) -> Dict:
+    # Degrade the request until its estimate fits the budget. suffix_text is
+    # the serialized student part, answers included. Returns the answers and
+    # photos to send, the image detail level, the estimate and the steps taken.
+    sizes = [sent_image_size(path) for path in image_paths]
+    detail = None
+    steps = []
+    result = estimate(prefix_text=prefix_text, suffix_text=suffix_text, image_sizes=sizes)
+
+    def over() -> int:
+        return result["inputTokens"] - budget if budget > 0 else 0
+
+    if over() > 0 and answers:
+        trimmed = trim_answers(
+            answers, math.ceil(over() * rate_limit.CHARS_PER_TOKEN) + len(TRUNCATION_MARK)
+        )
+        removed = sum(map(len, answers)) - sum(map(len, trimmed))
+        if removed > 0:
+            answers = trimmed
+            suffix_text = suffix_text[: max(0, len(suffix_text) - removed)]
+            steps.append("trim_answer")
+            result = estimate(
+                prefix_text=prefix_text, suffix_text=suffix_text, image_sizes=sizes
+            )
+    if over() > 0 and image_paths:
+        detail = "low"
+        steps.append("low_detail")
+        result = estimate(
+            prefix_text=prefix_text,
+            suffix_text=suffix_text,
+            image_sizes=sizes,
+            image_detail=detail,
+        )
+    if over() > 0 and len(image_paths) > 1:
+        duplicates = set(duplicate_images(image_paths))
+        if duplicates:
+            image_paths = [p for i, p in enumerate(image_paths) if i not in duplicates]
+            sizes = [s for i, s in enumerate(sizes) if i not in duplicates]
+            steps.append("drop_duplicate_images")
+            result = estimate(
+                prefix_text=prefix_text,
+                suffix_text=suffix_text,
+                image_sizes=sizes,
+                image_detail=detail,
+            )
+    result.update({"budget": budget, "steps": steps, "overBudget": over() > 0})
+    return {
+        "answers": answers,
+        "image_paths": image_paths,
+        "image_detail": detail,
+        "estimate": result,
+    }
@@ -229,6 +229,27 @@ export class StorageService {
     return downloaded ? { filePath: downloaded, temporary: true } : null;
   }
 
+  /**
+   * 供 grader.py 直接读取的引用：本地文件返回绝对路径，S3 返回预签名下载地址，
+   * HTTP 原样返回；由 grader 并发下载，不再先落地到临时目录。
+   */
+  async resolveFetchRef(fileRef: string): Promise<string> {
+    const parsed = this.parseRef(fileRef);
+    if (parsed.kind === 'empty') {
+      return '';
+    }
+    if (parsed.kind === 'http') {
+      return parsed.url;
+    }
+    if (parsed.kind === 'legacy-path') {
+      return parsed.absolutePath;
+    }
+    if (parsed.kind === 'local') {
+      return path.join(this.localRoot, parsed.key);
+    }
+    return this.buildSignedS3Url(parsed.bucket, parsed.key, this.signedUrlTtlSeconds);
+  }
+
   private async buildSignedS3Url(
     bucket: string,
     key: string,
@@ -11,7 +11,7 @@ import { AccountType, UserEntity, UserRole, UserStatus } from './modules/auth/en
 import { json, urlencoded } from 'express';
 import * as express from 'express';
 import { join } from 'path';
-import { existsSync } from 'fs';
+import { existsSync, promises as fsPromises } from 'fs';
 import { collectDefaultMetrics, Histogram, register } from 'prom-client';
 
 async function seedTestUser(dataSource: DataSource) {
@@ -109,10 +109,15 @@ async function bootstrap() {
       next();
     });
 
+    // grader.py 写出的 Prometheus 文本文件（AI_GRADING_METRICS_TEXTFILE）一并暴露
+    const graderMetricsPath = process.env.AI_GRADING_METRICS_TEXTFILE;
     const expressApp = app.getHttpAdapter().getInstance();
     expressApp.get('/metrics', async (_req: any, res: any) => {
       res.setHeader('Content-Type', register.contentType);
-      res.end(await register.metrics());
+      const graderMetrics = graderMetricsPath
+        ? await fsPromises.readFile(graderMetricsPath, 'utf-8').catch(() => '')
+        : '';
+      res.end(`${await register.metrics()}\n${graderMetrics}`);
     });
   }
   const storageBackend = String(process.env.STORAGE_BACKEND || 'local').toLowerCase();
@@ -0,0 +1,19 @@
+import type { MigrationInterface, QueryRunner } from 'typeorm';
+
+export class AddAiJobStreamOutputStage20260310000100 implements MigrationInterface {
+  name = 'AddAiJobStreamOutputStage20260310000100';
+
+  public async up(queryRunner: QueryRunner): Promise<void> {
+    await queryRunner.query(`
+      ALTER TYPE "ai_job_stage" ADD VALUE IF NOT EXISTS 'STREAM_OUTPUT' AFTER 'CALL_MODEL'
+    `);
+  }
+
+  public async down(queryRunner: QueryRunner): Promise<void> {
+    // PostgreSQL cannot drop a single enum value; move rows back so the
+    // value is unused, and leave the type itself as is.
+    await queryRunner.query(`
+      UPDATE "ai_jobs" SET "stage" = 'CALL_MODEL' WHERE "stage" = 'STREAM_OUTPUT'
+    `);
+  }
+}
@@ -0,0 +1,406 @@
+import { Injectable, Logger, OnModuleDestroy } from '@nestjs/common';
+import { ChildProcessWithoutNullStreams, spawn } from 'child_process';
+import { randomUUID } from 'crypto';
+import * as path from 'path';
+import { createInterface } from 'readline';
+import { AiGradingQueueService } from './ai-grading.queue';
+
+export type GraderPoolRequest = {
+  payload: Record<string, unknown>;
+  images: string[];
+  model?: string;
+  temperature?: number;
+};
+
+/** grader.py serve 中的非评分操作，例如抄袭比对索引（similarity.py / image_hash.py） */
+export type GraderPoolOpRequest = {
+  op: 'similarity-add' | 'similarity-query' | 'image-hash-add' | 'image-hash-query';
+  [key: string]: unknown;
+};
+
+export type GraderProgressEvent =
+  | 'prefix-ready'
+  | 'request-sent'
+  | 'first-token'
+  | 'cache-hit'
+  | 'done';
+
+export type GraderPoolOptions = {
+  onProgress?: (event: GraderProgressEvent) => void;
+  /** 流式模式下，请求发出后等待首个输出的最长时间 */
+  firstTokenTimeoutMs?: number;
+};
+
+type PendingRequest = {
+  resolve: (content: string) => void;
+  reject: (error: Error) => void;
+  timer: NodeJS.Timeout;
+  firstTokenTimer?: NodeJS.Timeout;
+  resetTimer: () => void;
+  options: GraderPoolOptions;
+};
+
+type WaitingRequest = {
+  start: (worker: GraderProcess) => void;
+  reject: (error: Error) => void;
+};
+
+type GraderProcess = {
+  child: ChildProcessWithoutNullStreams;
+  pending: Map<string, PendingRequest>;
+  ready: Promise<void>;
+  alive: boolean;
+  stderrTail: string;
+};
+
+/**
+ * 维护少量常驻的 `grader.py serve` 进程，避免每个任务都重新启动 Python、
+ * 重建 Redis 连接与 ARK TLS 连接。AI_GRADING_POOL_SIZE=0 时关闭，走单次 execFile。
+ * AI_GRADING_CONSUMER=true 时不启动子进程，请求经 Redis 交给独立部署的
+ * `grader.py consume` 进程，回复与进度事件从 Redis 读取。
+ * 每个子进程同时处理的请求不超过 AI_GRADING_POOL_CONCURRENCY，其余在 Node 侧排队，
+ * 超时只从请求真正交给子进程时开始计算。
+ */
+@Injectable()
+export class AiGradingGraderPoolService implements OnModuleDestroy {
+  private readonly logger = new Logger(AiGradingGraderPoolService.name);
+  private readonly size = Math.max(
+    0,
+    Math.floor(this.readNumberEnv('AI_GRADING_POOL_SIZE', 0)),
+  );
+  private readonly concurrency = Math.max(
+    1,
+    Math.floor(this.readNumberEnv('AI_GRADING_POOL_CONCURRENCY', 4)),
+  );
+  private readonly stream = process.env.AI_GRADING_STREAM === 'true';
+  private readonly remote = process.env.AI_GRADING_CONSUMER === 'true';
+  private readonly processes: Array<GraderProcess | undefined> = [];
+  private readonly waiting: WaitingRequest[] = [];
+  private sequence = 0;
+  private closing = false;
+
+  constructor(private readonly queue: AiGradingQueueService) {}
+
+  isEnabled() {
+    return (this.size > 0 || this.remote) && !this.closing;
+  }
+
+  isStreaming() {
+    return this.stream;
+  }
+
+  /**
+   * 流式模式下 timeoutMs 是“无进展”超时：每收到一个进度事件就重新计时，
+   * 慢但仍在输出的模型不会被整体时限误杀；首个输出另由 firstTokenTimeoutMs 约束。
+   */
+  grade(
+    request: GraderPoolRequest | GraderPoolOpRequest,
+    timeoutMs: number,
+    options: GraderPoolOptions = {},
+  ): Promise<string> {
+    if (this.remote) {
+      return this.gradeRemote(request, timeoutMs, options);
+    }
+    return new Promise<string>((resolve, reject) => {
+      const start = (worker: GraderProcess) =>
+        this.dispatch(worker, request, timeoutMs, options, resolve, reject);
+      const worker = this.pickProcess();
+      if (worker.pending.size < this.concurrency) {
+        start(worker);
+      } else {
+        this.waiting.push({ start, reject });
+      }
+    });
+  }
+
+  private dispatch(
+    worker: GraderProcess,
+    request: GraderPoolRequest | GraderPoolOpRequest,
+    timeoutMs: number,
+    options: GraderPoolOptions,
+    resolve: (content: string) => void,
+    reject: (error: Error) => void,
+  ) {
+    const id = `${process.pid}-${++this.sequence}`;
+    const onTimeout = (message: string) => {
+      this.settle(worker, id, new Error(message));
+      if (worker.alive) {
+        worker.child.stdin.write(`${JSON.stringify({ op: 'cancel', id })}\n`);
+      }
+    };
+    const pending: PendingRequest = {
+      resolve,
+      reject,
+      timer: setTimeout(() => onTimeout(`模型调用超时(${timeoutMs}ms)`), timeoutMs),
+      resetTimer: () => {
+        if (!this.stream) {
+          return;
+        }
+        clearTimeout(pending.timer);
+        pending.timer = setTimeout(
+          () => onTimeout(`模型调用超时(${timeoutMs}ms)`),
+          timeoutMs,
+        );
+      },
+      options,
+    };
+    if (this.stream && options.firstTokenTimeoutMs) {
+      const firstTokenTimeoutMs = options.firstTokenTimeoutMs;
+      pending.options = {
+        ...options,
+        onProgress: (event) => {
+          if (event === 'request-sent' && !pending.firstTokenTimer) {
+            pending.firstTokenTimer = setTimeout(
+              () => onTimeout(`模型首个输出超时(${firstTokenTimeoutMs}ms)`),
+              firstTokenTimeoutMs,
+            );
+          } else if (event === 'first-token' && pending.firstTokenTimer) {
+            clearTimeout(pending.firstTokenTimer);
+          }
+          options.onProgress?.(event);
+        },
+      };
+    }
+    worker.pending.set(id, pending);
+    worker.ready
+      .then(() => {
+        if (!worker.pending.has(id)) {
+          return;
+        }
+        worker.child.stdin.write(
+          `${JSON.stringify({ id, stream: this.stream, ...request })}\n`,
+        );
+      })
+      .catch((error) => {
+        this.settle(worker, id, error instanceof Error ? error : new Error(String(error)));
+      });
+  }
+
+  /** 执行非评分操作，返回 content 中的 JSON 结果 */
+  async call<T>(request: GraderPoolOpRequest, timeoutMs: number): Promise<T> {
+    const content = await this.grade(request, timeoutMs);
+    return JSON.parse(content) as T;
+  }
+
+  onModuleDestroy(): void {
+    this.closing = true;
+    this.startWaiting();
+    for (const worker of this.processes) {
+      if (!worker?.alive) {
+        continue;
+      }
+      worker.child.stdin.end();
+      setTimeout(() => {
+        if (worker.alive) {
+          worker.child.kill('SIGTERM');
+        }
+      }, 5000).unref();
+    }
+  }
+
+  /**
+   * 经 Redis 交给 `grader.py consume`：deadline 之前仍未被领取的请求由 consumer 直接拒绝；
+   * 超时（含流式首个输出超时）后发布取消通知。
+   */
+  private async gradeRemote(
+    request: GraderPoolRequest | GraderPoolOpRequest,
+    timeoutMs: number,
+    options: GraderPoolOptions,
+  ): Promise<string> {
+    const id = randomUUID();
+    let deadline = Date.now() + timeoutMs;
+    let firstTokenDeadline = Number.POSITIVE_INFINITY;
+    let firstTokenSeen = false;
+    await this.queue.pushGraderRequest({ id, stream: this.stream, deadline, ...request });
+    for (;;) {
+      const waitUntil = Math.min(deadline, firstTokenDeadline);
+      const remainingMs = waitUntil - Date.now();
+      if (remainingMs <= 0) {
+        await this.queue.cancelGraderRequest(id);
+        throw new Error(
+          waitUntil === firstTokenDeadline
+            ? `模型首个输出超时(${options.firstTokenTimeoutMs}ms)`
+            : `模型调用超时(${timeoutMs}ms)`,
+        );
+      }
+      const message = await this.queue.popGraderReply(id, Math.ceil(remainingMs / 1000));
+      if (!message) {
+        continue;
+      }
+      if (typeof message.event === 'string') {
+        const event = message.event as GraderProgressEvent;
+        if (this.stream) {
+          deadline = Date.now() + timeoutMs;
+          if (event === 'first-token') {
+            firstTokenSeen = true;
+            firstTokenDeadline = Number.POSITIVE_INFINITY;
+          } else if (
+            event === 'request-sent' &&
+            options.firstTokenTimeoutMs &&
+            !firstTokenSeen &&
+            firstTokenDeadline === Number.POSITIVE_INFINITY
+          ) {
+            firstTokenDeadline = Date.now() + options.firstTokenTimeoutMs;
+          }
+        }
+        try {
+          options.onProgress?.(event);
+        } catch (error) {
+          const detail = error instanceof Error ? error.message : String(error);
+          this.logger.warn(`Grader progress handler failed: ${detail}`);
+        }
+        continue;
+      }
+      await this.queue.clearGraderReplies(id);
+      if (message.ok) {
+        return String(message.content ?? '');
+      }
+      throw new Error(`模型调用失败: ${String(message.error ?? 'unknown error')}`);
+    }
+  }
+
+  private pickProcess(): GraderProcess {
+    let picked: GraderProcess | undefined;
+    for (let index = 0; index < this.size; index += 1) {
+      let worker = this.processes[index];
+      if (!worker?.alive) {
+        worker = this.spawnProcess(index);
+        this.processes[index] = worker;
+      }
+      if (!picked || worker.pending.size < picked.pending.size) {
+        picked = worker;
+      }
+    }
+    if (!picked) {
+      throw new Error('grader 进程池未启用');
+    }
+    return picked;
+  }
+
+  private spawnProcess(index: number): GraderProcess {
+    const scriptPath = path.resolve(process.cwd(), 'ai_worker', 'grader.py');
+    const python = process.env.AI_GRADING_PYTHON || 'python3';
+    const child = spawn(
+      python,
+      [scriptPath, 'serve', '--concurrency', String(this.concurrency)],
+      { env: process.env, stdio: ['pipe', 'pipe', 'pipe'] },
+    );
+    let markReady: () => void = () => undefined;
+    let failReady: (error: Error) => void = () => undefined;
+    const worker: GraderProcess = {
+      child,
+      pending: new Map(),
+      ready: new Promise<void>((resolve, reject) => {
+        markReady = resolve;
+        failReady = reject;
+      }),
+      alive: true,
+      stderrTail: '',
+    };
+    worker.ready.catch(() => undefined);
+
+    createInterface({ input: child.stdout }).on('line', (line) => {
+      this.handleLine(worker, line, markReady);
+    });
+    child.stderr.on('data', (chunk: Buffer) => {
+      worker.stderrTail = `${worker.stderrTail}${chunk.toString('utf-8')}`.slice(-4000);
+    });
+    const onExit = (reason: string) => {
+      if (!worker.alive) {
+        return;
+      }
+      worker.alive = false;
+      const detail = worker.stderrTail.trim();
+      const error = new Error(
+        `模型调用失败: grader 进程退出(${reason})${detail ? `: ${detail}` : ''}`,
+      );
+      failReady(error);
+      for (const id of Array.from(worker.pending.keys())) {
+        this.settle(worker, id, error);
+      }
+      if (!this.closing) {
+        this.logger.warn(`Grader process #${index} exited (${reason}).`);
+      }
+    };
+    child.on('exit', (code, signal) => onExit(`code=${code}, signal=${signal}`));
+    child.on('error', (error) => onExit(error.message));
+    this.logger.log(`Grader process #${index} started (pid=${child.pid}).`);
+    return worker;
+  }
+
+  private handleLine(worker: GraderProcess, line: string, markReady: () => void) {
+    let message: Record<string, unknown>;
+    try {
+      message = JSON.parse(line);
+    } catch {
+      this.logger.warn(`Unparseable grader output: ${line.slice(0, 200)}`);
+      return;
+    }
+    if (message.event === 'ready') {
+      markReady();
+      return;
+    }
+    const id = String(message.id ?? '');
+    const pending = worker.pending.get(id);
+    if (!pending) {
+      return;
+    }
+    if (typeof message.event === 'string') {
+      pending.resetTimer();
+      try {
+        pending.options.onProgress?.(message.event as GraderProgressEvent);
+      } catch (error) {
+        const detail = error instanceof Error ? error.message : String(error);
+        this.logger.warn(`Grader progress handler failed: ${detail}`);
+      }
+      return;
+    }
+    if (message.ok) {
+      this.settle(worker, id, null, String(message.content ?? ''));
+    } else {
+      this.settle(worker, id, new Error(`模型调用失败: ${String(message.error ?? 'unknown error')}`));
+    }
+  }
+
+  private settle(worker: GraderProcess, id: string, error: Error | null, content = '') {
+    const pending = worker.pending.get(id);
+    if (!pending) {
+      return;
+    }
+    worker.pending.delete(id);
+    this.startWaiting();
+    clearTimeout(pending.timer);
+    if (pending.firstTokenTimer) {
+      clearTimeout(pending.firstTokenTimer);
+    }
+    if (error) {
+      pending.reject(error);
+    } else {
+      pending.resolve(content);
+    }
+  }
+
+  /** 有子进程空出名额时，按先来后到把 Node 侧排队的请求交给它 */
+  private startWaiting() {
+    if (this.closing) {
+      for (const waiting of this.waiting.splice(0)) {
+        waiting.reject(new Error('模型调用失败: grader 进程池已关闭'));
+      }
+      return;
+    }
+    while (this.waiting.length) {
+      const worker = this.pickProcess();
+      if (worker.pending.size >= this.concurrency) {
+        return;
+      }
+      this.waiting.shift()?.start(worker);
+    }
+  }
+
+  private readNumberEnv(name: string, fallback: number) {
+    const raw = process.env[name];
+    if (!raw) return fallback;
+    const value = Number(raw);
+    return Number.isFinite(value) ? value : fallback;
+  }
+}
@@ -10,6 +10,7 @@ import { AssignmentEntity } from '../assignment/entities/assignment.entity';
 import { AssignmentSnapshotEntity } from '../assignment/entities/assignment-snapshot.entity';
 import { CourseEntity } from '../assignment/entities/course.entity';
 import { AiGradingWorkerService } from './ai-grading.worker';
+import { AiGradingGraderPoolService } from './ai-grading.grader-pool';
 import { AuthModule } from '../auth/auth.module';
 import { BillingModule } from '../billing/billing.module';
 
@@ -31,7 +32,12 @@ import { BillingModule } from '../billing/billing.module';
     ]),
   ],
   controllers: [AiGradingController],
-  providers: [AiGradingService, AiGradingQueueService, AiGradingWorkerService],
+  providers: [
+    AiGradingService,
+    AiGradingQueueService,
+    AiGradingWorkerService,
+    AiGradingGraderPoolService,
+  ],
   exports: [AiGradingService],
 })
 export class AiGradingModule {}
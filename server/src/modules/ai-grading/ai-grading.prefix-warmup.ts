@@ -0,0 +1,114 @@
+import { Injectable, Logger } from '@nestjs/common';
+import { execFile } from 'child_process';
+import { promisify } from 'util';
+import { promises as fs } from 'fs';
+import * as os from 'os';
+import * as path from 'path';
+import { AssignmentEntity } from '../assignment/entities/assignment.entity';
+
+const execFileAsync = promisify(execFile);
+
+type WarmupReport = {
+  questions?: Array<{ questionId?: string; status?: string; error?: string }>;
+  warmed?: number;
+  hit?: number;
+  failed?: number;
+  skipped?: number;
+};
+
+/**
+ * 作业发布后调用 `grader.py warm --snapshot`，为快照中所有 AI_RUBRIC 题目预先建立
+ * ARK 前缀缓存，使发布后第一份提交与后续提交的批改延迟一致。
+ * 预热失败只记录日志，不影响发布；AI_GRADING_WARM_ON_PUBLISH=false 时关闭。
+ */
+@Injectable()
+export class AiGradingPrefixWarmupService {
+  private readonly logger = new Logger(AiGradingPrefixWarmupService.name);
+  private readonly enabled = process.env.AI_GRADING_WARM_ON_PUBLISH !== 'false';
+
+  warmSnapshotInBackground(
+    assignment: AssignmentEntity,
+    snapshotId: string,
+    snapshot: Record<string, unknown>,
+  ) {
+    if (!this.enabled || !assignment.aiEnabled) {
+      return;
+    }
+    void this.warmSnapshot(assignment, snapshotId, snapshot).catch((error) => {
+      const message = error instanceof Error ? error.message : String(error);
+      this.logger.warn(`Prefix warmup for snapshot ${snapshotId} failed: ${message}`);
+    });
+  }
+
+  async warmSnapshot(
+    assignment: AssignmentEntity,
+    snapshotId: string,
+    snapshot: Record<string, unknown>,
+  ): Promise<WarmupReport> {
+    const tempDir = await fs.mkdtemp(path.join(os.tmpdir(), 'ai-grading-warm-'));
+    const snapshotPath = path.join(tempDir, 'snapshot.json');
+    const customGuidance = (assignment.aiPromptGuidance ?? '').trim();
+    // 与 AiGradingService 触发任务时的默认选项保持一致，否则前缀缓存键对不上
+    await fs.writeFile(
+      snapshotPath,
+      JSON.stringify({
+        snapshotId,
+        snapshot,
+        options: {
+          handwritingRecognition: assignment.handwritingRecognition ?? false,
+          plagiarismDetection: assignment.plagiarismDetection ?? true,
+          jumpStepDetection: assignment.jumpStepDetection ?? true,
+          stepConflictDetection: assignment.stepConflictDetection ?? true,
+          requiredStepDetection: assignment.requiredStepDetection ?? true,
+          gradingStrictness: assignment.aiGradingStrictness ?? 'BALANCED',
+          customGuidance,
+          minConfidence: this.clampConfidenceThreshold(
+            Number(assignment.aiConfidenceThreshold ?? 0.75),
+          ),
+        },
+      }),
+      'utf-8',
+    );
+
+    const scriptPath = path.resolve(process.cwd(), 'ai_worker', 'grader.py');
+    const python = process.env.AI_GRADING_PYTHON || 'python3';
+    try {
+      let stdout = '';
+      try {
+        ({ stdout } = await execFileAsync(
+          python,
+          [scriptPath, 'warm', '--snapshot', snapshotPath],
+          { timeout: 5 * 60 * 1000, maxBuffer: 2 * 1024 * 1024, env: process.env },
+        ));
+      } catch (error) {
+        // 部分题目预热失败时进程以 1 退出，但 stdout 仍包含完整报告
+        stdout = String((error as { stdout?: string })?.stdout ?? '');
+        if (!stdout.trim()) {
+          throw error;
+        }
+      }
+      const report = JSON.parse(stdout) as WarmupReport;
+      this.logger.log(
+        `Prefix warmup for snapshot ${snapshotId}: warmed=${report.warmed ?? 0}, ` +
+          `hit=${report.hit ?? 0}, failed=${report.failed ?? 0}, skipped=${report.skipped ?? 0}`,
+      );
+      for (const item of report.questions ?? []) {
+        if (item.status === 'failed') {
+          this.logger.warn(
+            `Prefix warmup failed for question ${item.questionId ?? '?'}: ${item.error ?? ''}`,
+          );
+        }
+      }
+      return report;
+    } finally {
+      await fs.rm(tempDir, { recursive: true, force: true }).catch(() => undefined);
+    }
+  }
+
+  private clampConfidenceThreshold(value: number) {
+    if (!Number.isFinite(value)) return 0.75;
+    if (value < 0) return 0;
+    if (value > 1) return 1;
+    return Number(value.toFixed(3));
+  }
+}
@@ -9,7 +9,14 @@ export class AiGradingQueueService implements OnModuleDestroy {
   private workerClient?: ReturnType<typeof createClient>;
   private running = false;
   private stopped = false;
+  private readonly inFlight = new Set<Promise<void>>();
   private readonly queueKey = 'ai_grading_jobs';
+  private readonly graderQueueKey =
+    process.env.AI_GRADING_CONSUMER_QUEUE || 'ai_grading:grader_requests';
+  private readonly graderReplyPrefix =
+    process.env.AI_GRADING_CONSUMER_REPLY_PREFIX || 'ai_grading:grader_replies:';
+  private readonly graderCancelChannel =
+    process.env.AI_GRADING_CONSUMER_CANCEL_CHANNEL || 'ai_grading:grader_cancel';
   private readonly redisUrl = process.env.REDIS_URL || 'redis://localhost:6379';
   private readonly payloadTtlSeconds = this.readNumberEnv(
     'AI_JOB_PAYLOAD_TTL_SECONDS',
@@ -158,6 +165,18 @@ export class AiGradingQueueService implements OnModuleDestroy {
     }, delayMs);
   }
 
+  /**
+   * 立即重新入队，且队列中只保留一份：原条目可能仍在队列中，也可能已被取出跳过，
+   * 先删后推保证任务既不丢失也不重复。
+   */
+  async requeueUnique(jobId: string): Promise<void> {
+    const client = await this.getClient();
+    await this.withRedisRetry(
+      () => client.multi().lRem(this.queueKey, 0, jobId).lPush(this.queueKey, jobId).exec(),
+      'requeueUnique',
+    );
+  }
+
   async getPayload(jobId: string): Promise<TriggerAiGradingDto | null> {
     const client = await this.getClient();
     const raw = await this.withRedisRetry(() => client.get(this.payloadKey(jobId)), 'getPayload');
@@ -182,6 +201,39 @@ export class AiGradingQueueService implements OnModuleDestroy {
     }
   }
 
+  /** 投递给 `grader.py consume` 的评分请求，回复写入 graderReplyKey(id) */
+  async pushGraderRequest(request: { id: string } & Record<string, unknown>): Promise<void> {
+    const client = await this.getClient();
+    await this.withRedisRetry(
+      () => client.lPush(this.graderQueueKey, JSON.stringify(request)),
+      'grader:lpush',
+    );
+  }
+
+  /** 阻塞等待 grader 的下一条消息（进度事件或最终结果），超时返回 null */
+  async popGraderReply(
+    id: string,
+    timeoutSeconds: number,
+  ): Promise<Record<string, unknown> | null> {
+    const client = await this.getClient();
+    const result = await client.executeIsolated((isolated) =>
+      isolated.brPop(this.graderReplyKey(id), timeoutSeconds),
+    );
+    return result ? (JSON.parse(result.element) as Record<string, unknown>) : null;
+  }
+
+  /** 放弃等待：通知 consumer 取消该请求并清理回复队列 */
+  async cancelGraderRequest(id: string): Promise<void> {
+    const client = await this.getClient();
+    await client.publish(this.graderCancelChannel, id).catch(() => undefined);
+    await client.del(this.graderReplyKey(id)).catch(() => undefined);
+  }
+
+  async clearGraderReplies(id: string): Promise<void> {
+    const client = await this.getClient();
+    await client.del(this.graderReplyKey(id)).catch(() => undefined);
+  }
+
   async getQueueMetrics() {
     const client = await this.getClient();
     const queueLength = await this.withRedisRetry(() => client.lLen(this.queueKey), 'llen');
@@ -189,26 +241,46 @@ export class AiGradingQueueService implements OnModuleDestroy {
       queueLength,
       redisConnected: client.isOpen,
       workerRedisConnected: Boolean(this.workerClient?.isOpen),
+      workerInFlight: this.inFlight.size,
     };
   }
 
+  /**
+   * 同时处理至多 concurrency 个任务：有空位时才取下一个 jobId，
+   * 其余任务留在 Redis 中由其他 worker 进程领取。
+   */
   async startWorker(
     handler: (jobId: string) => Promise<void>,
+    concurrency = 1,
   ): Promise<void> {
     if (this.running) {
       return;
     }
     this.running = true;
     this.stopped = false;
-    this.logger.log('AI grading queue worker started.');
+    const limit = Math.max(1, Math.floor(concurrency));
+    this.logger.log(`AI grading queue worker started (concurrency=${limit}).`);
     while (!this.stopped) {
       try {
+        if (this.inFlight.size >= limit) {
+          await Promise.race(this.inFlight);
+          continue;
+        }
         const client = await this.getWorkerClient();
-        const result = await client.brPop(this.queueKey, 0);
+        // 短超时阻塞，便于及时响应 stopWorker
+        const result = await client.brPop(this.queueKey, 1);
         if (!result) {
           continue;
         }
-        await handler(result.element);
+        const task: Promise<void> = handler(result.element)
+          .catch((error) => {
+            const message = error instanceof Error ? error.message : String(error);
+            this.logger.error(`Job ${result.element} failed: ${message}`);
+          })
+          .finally(() => {
+            this.inFlight.delete(task);
+          });
+        this.inFlight.add(task);
       } catch (error) {
         const message =
           error instanceof Error ? error.message : String(error);
@@ -223,6 +295,8 @@ export class AiGradingQueueService implements OnModuleDestroy {
 
   async stopWorker(): Promise<void> {
     this.stopped = true;
+    // 等待进行中的任务收尾（它们仍需 Redis 读取参数、重新入队）
+    await Promise.allSettled(Array.from(this.inFlight));
     if (this.client) {
       await this.client.quit();
       this.client = undefined;
@@ -241,4 +315,8 @@ export class AiGradingQueueService implements OnModuleDestroy {
   private payloadKey(jobId: string): string {
     return `ai_grading:payload:${jobId}`;
   }
+
+  private graderReplyKey(id: string): string {
+    return `${this.graderReplyPrefix}${id}`;
+  }
 }
@@ -3,6 +3,7 @@ import { TypeOrmModule } from '@nestjs/typeorm';
 import { AiGradingService } from './ai-grading.service';
 import { AiGradingQueueService } from './ai-grading.queue';
 import { AiGradingWorkerService } from './ai-grading.worker';
+import { AiGradingGraderPoolService } from './ai-grading.grader-pool';
 import { AiJobEntity } from './entities/ai-job.entity';
 import { AiGradingEntity } from './entities/ai-grading.entity';
 import { SubmissionVersionEntity } from '../submission/entities/submission-version.entity';
@@ -23,6 +24,11 @@ import { BillingModule } from '../billing/billing.module';
       CourseEntity,
     ]),
   ],
-  providers: [AiGradingService, AiGradingQueueService, AiGradingWorkerService],
+  providers: [
+    AiGradingService,
+    AiGradingQueueService,
+    AiGradingWorkerService,
+    AiGradingGraderPoolService,
+  ],
 })
 export class AiGradingWorkerModule {}
@@ -6,8 +6,12 @@ import * as os from 'os';
 import * as path from 'path';
 import { createHash } from 'crypto';
 import { InjectRepository } from '@nestjs/typeorm';
-import { LessThan, Repository } from 'typeorm';
+import { In, IsNull, LessThan, Not, Repository } from 'typeorm';
 import { AiGradingQueueService } from './ai-grading.queue';
+import {
+  AiGradingGraderPoolService,
+  GraderProgressEvent,
+} from './ai-grading.grader-pool';
 import { AiGradingEntity } from './entities/ai-grading.entity';
 import { AiJobEntity, AiJobStage, AiJobStatus } from './entities/ai-job.entity';
 import { SubmissionVersionEntity, AiStatus, SubmissionStatus } from '../submission/entities/submission-version.entity';
@@ -34,6 +38,38 @@ type ParsedAiOutput = {
   extracted?: Record<string, unknown>;
 };
 
+type GraderModelInput = {
+  submissionVersionId: string;
+  assignmentSnapshotId: string;
+  studentAnswerText: string;
+  studentAnswerPayload?: Record<string, unknown> | null;
+  answerFormat?: string | null;
+  question: SnapshotQuestion;
+  minConfidence?: number;
+  returnStudentMarkdown?: boolean;
+  handwritingRecognition?: boolean;
+  plagiarismDetection?: boolean;
+  jumpStepDetection?: boolean;
+  stepConflictDetection?: boolean;
+  requiredStepDetection?: boolean;
+  gradingStrictness?: string;
+  customGuidance?: string;
+};
+
+type MultiQuestionMember = {
+  job: AiJobEntity;
+  submissionVersion: SubmissionVersionEntity;
+  question: SnapshotQuestion;
+};
+
+type MultiQuestionOutput = {
+  questionIndex: number;
+  submissionVersionId?: string;
+  ok: boolean;
+  content?: string;
+  error?: string;
+};
+
 type StudentIdentity = {
   studentId: string;
   name: string;
@@ -48,6 +84,13 @@ type PlagiarismSuspect = {
   similarity: number;
 };
 
+type PlagiarismIndexResult = {
+  peers: number;
+  candidates: number;
+  topSimilarity: number;
+  matches: Array<{ key: string; submissionVersionId: string; similarity: number }>;
+};
+
 @Injectable()
 export class AiGradingWorkerService implements OnModuleInit, OnModuleDestroy {
   private readonly logger = new Logger(AiGradingWorkerService.name);
@@ -64,6 +107,7 @@ export class AiGradingWorkerService implements OnModuleInit, OnModuleDestroy {
     @InjectRepository(AssignmentSnapshotEntity)
     private readonly snapshotRepo: Repository<AssignmentSnapshotEntity>,
     private readonly storageService: StorageService,
+    private readonly graderPool: AiGradingGraderPoolService,
   ) {}
 
   onModuleInit(): void {
@@ -79,7 +123,10 @@ export class AiGradingWorkerService implements OnModuleInit, OnModuleDestroy {
     this.staleRecoverTimer = setInterval(() => {
       void this.recoverStaleRunningJobs();
     }, Math.max(5, recoverIntervalSeconds) * 1000);
-    void this.queue.startWorker((jobId) => this.handleJob(jobId));
+    void this.queue.startWorker(
+      (jobId) => this.handleJob(jobId),
+      this.readNumberEnv('AI_JOB_WORKER_CONCURRENCY', 1),
+    );
   }
 
   onModuleDestroy(): void {
@@ -100,6 +147,9 @@ export class AiGradingWorkerService implements OnModuleInit, OnModuleDestroy {
     if (job.status === AiJobStatus.FAILED) {
       return;
     }
+    if (this.isClaimedElsewhere(job)) {
+      return;
+    }
 
     const maxAttempts = this.readNumberEnv('AI_JOB_MAX_ATTEMPTS', 3);
     const timeoutSeconds = this.readNumberEnv('AI_JOB_TIMEOUT_SECONDS', 180);
@@ -183,77 +233,67 @@ export class AiGradingWorkerService implements OnModuleInit, OnModuleDestroy {
         modelName = 'AUTO_RULE';
         modelVersion = auto.modelVersion;
       } else {
-        const result = await this.runModelWithTimeout(
-          payload,
-          {
-            submissionVersionId: submissionVersion.id,
-            assignmentSnapshotId: snapshotId,
-            studentAnswerText: submissionVersion.contentText ?? '',
-            studentAnswerPayload:
-              (submissionVersion.answerPayload as Record<string, unknown> | null) ?? null,
-            answerFormat: submissionVersion.answerFormat ?? null,
-            question,
-            minConfidence: payload.uncertaintyPolicy?.minConfidence,
-            returnStudentMarkdown: payload.options?.returnStudentMarkdown,
-            handwritingRecognition: payload.options?.handwritingRecognition,
-            plagiarismDetection: payload.options?.plagiarismDetection,
-            jumpStepDetection: payload.options?.jumpStepDetection,
-            stepConflictDetection: payload.options?.stepConflictDetection,
-            requiredStepDetection: payload.options?.requiredStepDetection,
-            gradingStrictness: payload.options?.gradingStrictness,
-            customGuidance: payload.options?.customGuidance,
-          },
-          submissionVersion.fileUrl,
-          timeoutSeconds * 1000,
-        );
-        parsed = this.parseModelOutput(result.outputText);
-        modelName = result.modelName;
-        modelVersion = result.modelVersion;
+        // 被退回的任务 attempts 已归零，靠退回原因（error）识别，仍按单题批改
+        const siblings =
+          nextAttempt === 1 && !job.error
+            ? await this.claimSiblingJobs({
+                job,
+                submissionVersion,
+                snapshot: snapshot.snapshot,
+                snapshotId,
+                question,
+                payload,
+              })
+            : [];
+        const progress = this.trackModelProgress(job.id);
+        let outputText: string;
+        if (siblings.length) {
+          const result = await this.runMultiQuestionModel(
+            payload,
+            [{ job, submissionVersion, question }, ...siblings],
+            snapshotId,
+            timeoutSeconds * 1000,
+            progress.onProgress,
+          );
+          await progress.flush();
+          outputText = await this.settleSiblingJobs({
+            siblings,
+            outputs: result.outputs,
+            submissionVersion,
+            payload,
+            snapshotId,
+            modelName: result.modelName,
+            modelVersion: result.modelVersion,
+          });
+          modelName = result.modelName;
+          modelVersion = result.modelVersion;
+        } else {
+          const result = await this.runModelWithTimeout(
+            payload,
+            this.buildModelInput(payload, submissionVersion, snapshotId, question),
+            submissionVersion.fileUrl,
+            timeoutSeconds * 1000,
+            progress.onProgress,
+          );
+          await progress.flush();
+          outputText = result.outputText;
+          modelName = result.modelName;
+          modelVersion = result.modelVersion;
+        }
+        parsed = this.parseModelOutput(outputText);
       }
 
-      this.applyScoreLeniency(parsed.result, {
-        gradingMode,
-        gradingStrictness: payload.options?.gradingStrictness,
-      });
-      this.normalizeReasonChannels(parsed.result);
-
-      await this.applyPlagiarismCheck({
-        enabled: payload.options?.plagiarismDetection !== false,
-        parsed,
+      await this.saveGradingResult({
+        job,
         submissionVersion,
         question,
-      });
-
-      await this.jobRepo.update(
-        { id: job.id },
-        { stage: AiJobStage.PARSE_OUTPUT, updatedAt: new Date() },
-      );
-
-      await this.jobRepo.update(
-        { id: job.id },
-        { stage: AiJobStage.SAVE_RESULT, updatedAt: new Date() },
-      );
-
-      const grading = this.gradingRepo.create({
-        submissionVersionId: submissionVersion.id,
-        assignmentId: submissionVersion.assignmentId,
-        assignmentSnapshotId: snapshotId,
+        payload,
+        snapshotId,
+        parsed,
+        gradingMode,
         modelName,
-        modelVersion: modelVersion ?? null,
-        result: parsed.result,
-        extracted: parsed.extracted ?? null,
+        modelVersion,
       });
-      await this.gradingRepo.save(grading);
-
-      await this.submissionVersionRepo.update(
-        { id: submissionVersion.id },
-        { status: SubmissionStatus.AI_FINISHED, aiStatus: AiStatus.SUCCESS, updatedAt: new Date() },
-      );
-
-      await this.jobRepo.update(
-        { id: job.id },
-        { status: AiJobStatus.SUCCEEDED, updatedAt: new Date() },
-      );
     } catch (error) {
       const { message, retryable } = this.classifyJobError(error);
       const delaySeconds = Math.min(
@@ -288,37 +328,29 @@ export class AiGradingWorkerService implements OnModuleInit, OnModuleDestroy {
 
   private async runModelWithTimeout(
     payload: TriggerAiGradingDto,
-    input: {
-      submissionVersionId: string;
-      assignmentSnapshotId: string;
-      studentAnswerText: string;
-      studentAnswerPayload?: Record<string, unknown> | null;
-      answerFormat?: string | null;
-      question: SnapshotQuestion;
-      minConfidence?: number;
-      returnStudentMarkdown?: boolean;
-      handwritingRecognition?: boolean;
-      plagiarismDetection?: boolean;
-      jumpStepDetection?: boolean;
-      stepConflictDetection?: boolean;
-      requiredStepDetection?: boolean;
-      gradingStrictness?: string;
-      customGuidance?: string;
-    },
+    input: GraderModelInput,
     fileUrlValue: string,
     timeoutMs: number,
+    onProgress?: (event: GraderProgressEvent) => void,
   ) {
-    const tempDir = await fs.mkdtemp(path.join(os.tmpdir(), 'ai-grading-'));
-    const inputPath = path.join(tempDir, 'input.json');
-    const outputPath = path.join(tempDir, 'output.json');
+    return this.runGrader(
+      payload,
+      this.buildGraderPayload(input),
+      fileUrlValue,
+      timeoutMs,
+      onProgress,
+    );
+  }
 
-    const jsonPayload = {
+  private buildGraderPayload(input: GraderModelInput) {
+    return {
       submissionVersionId: input.submissionVersionId,
       assignmentSnapshotId: input.assignmentSnapshotId,
       studentAnswerText: input.studentAnswerText,
       studentAnswerPayload: input.studentAnswerPayload ?? null,
       answerFormat: input.answerFormat ?? null,
         question: {
+          questionId: input.question.questionId,
           questionIndex: input.question.questionIndex,
           questionType: input.question.questionType ?? 'SHORT_ANSWER',
           questionSchema: input.question.questionSchema ?? null,
@@ -342,40 +374,76 @@ export class AiGradingWorkerService implements OnModuleInit, OnModuleDestroy {
         customGuidance: input.customGuidance ?? '',
       },
     };
+  }
 
-    await fs.writeFile(inputPath, JSON.stringify(jsonPayload, null, 2), 'utf-8');
-
-    const images = await this.collectImagePaths(fileUrlValue, tempDir);
-    const scriptPath = path.resolve(process.cwd(), 'ai_worker', 'grader.py');
-    const python = process.env.AI_GRADING_PYTHON || 'python3';
-
-    const args = [
-      scriptPath,
-      '--json',
-      inputPath,
-      '--out',
-      outputPath,
-    ];
-    for (const image of images) {
-      args.push('--image', image);
-    }
-    if (payload.modelHint?.name) {
-      args.push('--model', payload.modelHint.name);
-    }
-    if (typeof payload.options?.temperature === 'number') {
-      args.push('--temperature', String(payload.options.temperature));
-    }
+  private async runGrader(
+    payload: TriggerAiGradingDto,
+    jsonPayload: Record<string, unknown>,
+    fileUrlValue: string,
+    timeoutMs: number,
+    onProgress?: (event: GraderProgressEvent) => void,
+  ) {
+    const directFetch = process.env.AI_GRADING_DIRECT_FETCH !== 'false';
+    const tempDir = directFetch
+      ? null
+      : await fs.mkdtemp(path.join(os.tmpdir(), 'ai-grading-'));
 
     const modelName = payload.modelHint?.name || process.env.ARK_MODEL || 'unknown';
     const modelVersion = payload.modelHint?.version || null;
 
     try {
+      const images = tempDir
+        ? await this.collectImagePaths(fileUrlValue, tempDir)
+        : await this.resolveImageRefs(fileUrlValue);
+      if (this.graderPool.isEnabled()) {
+        const outputText = await this.graderPool.grade(
+          {
+            payload: jsonPayload,
+            images,
+            model: payload.modelHint?.name,
+            temperature:
+              typeof payload.options?.temperature === 'number'
+                ? payload.options.temperature
+                : undefined,
+          },
+          timeoutMs,
+          {
+            onProgress,
+            firstTokenTimeoutMs:
+              this.readNumberEnv('AI_JOB_FIRST_TOKEN_TIMEOUT_SECONDS', 60) * 1000,
+          },
+        );
+        return {
+          outputText,
+          modelName: this.readCascadeModel(outputText) ?? modelName,
+          modelVersion,
+        };
+      }
+
+      const scriptPath = path.resolve(process.cwd(), 'ai_worker', 'grader.py');
+      const python = process.env.AI_GRADING_PYTHON || 'python3';
+
+      // 题目与作答通过 stdin 传入，结果从 stdout 读取，不再经过临时文件
+      const args = [scriptPath, '--json', '-'];
+      for (const image of images) {
+        args.push('--image', image);
+      }
+      if (payload.modelHint?.name) {
+        args.push('--model', payload.modelHint.name);
+      }
+      if (typeof payload.options?.temperature === 'number') {
+        args.push('--temperature', String(payload.options.temperature));
+      }
+
+      let outputText: string;
       try {
-        await execFileAsync(python, args, {
+        const running = execFileAsync(python, args, {
           timeout: timeoutMs,
           maxBuffer: 2 * 1024 * 1024,
           env: process.env,
         });
+        running.child.stdin?.end(JSON.stringify(jsonPayload));
+        outputText = String((await running).stdout);
       } catch (error) {
         const message = error instanceof Error ? error.message : String(error);
         if (
@@ -388,11 +456,395 @@ export class AiGradingWorkerService implements OnModuleInit, OnModuleDestroy {
         throw new Error(`模型调用失败: ${message}`);
       }
 
-      const outputText = await fs.readFile(outputPath, 'utf-8');
-      return { outputText, modelName, modelVersion };
+      return {
+        outputText,
+        modelName: this.readCascadeModel(outputText) ?? modelName,
+        modelVersion,
+      };
     } finally {
-      await fs.rm(tempDir, { recursive: true, force: true }).catch(() => undefined);
+      if (tempDir) {
+        await fs.rm(tempDir, { recursive: true, force: true }).catch(() => undefined);
+      }
+    }
+  }
+
+  /** 前 4 张图片的可直接读取引用（本地路径或下载地址），由 grader 并发获取 */
+  private async resolveImageRefs(fileUrlValue: string) {
+    const refs: string[] = [];
+    for (const fileRef of this.parseFileUrls(fileUrlValue).slice(0, 4)) {
+      try {
+        const resolved = await this.storageService.resolveFetchRef(fileRef);
+        if (resolved) {
+          refs.push(resolved);
+        }
+      } catch (error) {
+        this.logger.warn(`Skip invalid image ref: ${fileRef}`);
+      }
+    }
+    return refs;
+  }
+
+  /**
+   * 开启 AI_GRADING_CASCADE_MODEL 时，grader 在输出中记录实际给出结果的模型层级
+   * （cascade.tier / cascade.model），批改记录的 modelName 以此为准。
+   */
+  private readCascadeModel(outputText: string): string | null {
+    const parsed = this.tryParseJson(outputText.trim());
+    const cascade = parsed?.cascade as { model?: unknown } | undefined;
+    return cascade && typeof cascade.model === 'string' && cascade.model ? cascade.model : null;
+  }
+
+  private buildModelInput(
+    payload: TriggerAiGradingDto,
+    submissionVersion: SubmissionVersionEntity,
+    snapshotId: string,
+    question: SnapshotQuestion,
+  ): GraderModelInput {
+    return {
+      submissionVersionId: submissionVersion.id,
+      assignmentSnapshotId: snapshotId,
+      studentAnswerText: submissionVersion.contentText ?? '',
+      studentAnswerPayload:
+        (submissionVersion.answerPayload as Record<string, unknown> | null) ?? null,
+      answerFormat: submissionVersion.answerFormat ?? null,
+      question,
+      minConfidence: payload.uncertaintyPolicy?.minConfidence,
+      returnStudentMarkdown: payload.options?.returnStudentMarkdown,
+      handwritingRecognition: payload.options?.handwritingRecognition,
+      plagiarismDetection: payload.options?.plagiarismDetection,
+      jumpStepDetection: payload.options?.jumpStepDetection,
+      stepConflictDetection: payload.options?.stepConflictDetection,
+      requiredStepDetection: payload.options?.requiredStepDetection,
+      gradingStrictness: payload.options?.gradingStrictness,
+      customGuidance: payload.options?.customGuidance,
+    };
+  }
+
+  private async saveGradingResult(input: {
+    job: AiJobEntity;
+    submissionVersion: SubmissionVersionEntity;
+    question: SnapshotQuestion;
+    payload: TriggerAiGradingDto;
+    snapshotId: string;
+    parsed: ParsedAiOutput;
+    gradingMode: 'AUTO_RULE' | 'AI_RUBRIC';
+    modelName: string;
+    modelVersion: string | null;
+  }) {
+    const { job, submissionVersion, question, payload, parsed } = input;
+    this.applyScoreLeniency(parsed.result, {
+      gradingMode: input.gradingMode,
+      gradingStrictness: payload.options?.gradingStrictness,
+    });
+    this.normalizeReasonChannels(parsed.result);
+
+    await this.applyPlagiarismCheck({
+      enabled: payload.options?.plagiarismDetection !== false,
+      parsed,
+      submissionVersion,
+      question,
+    });
+
+    await this.jobRepo.update(
+      { id: job.id },
+      { stage: AiJobStage.PARSE_OUTPUT, updatedAt: new Date() },
+    );
+
+    await this.jobRepo.update(
+      { id: job.id },
+      { stage: AiJobStage.SAVE_RESULT, updatedAt: new Date() },
+    );
+
+    const grading = this.gradingRepo.create({
+      submissionVersionId: submissionVersion.id,
+      assignmentId: submissionVersion.assignmentId,
+      assignmentSnapshotId: input.snapshotId,
+      modelName: input.modelName,
+      modelVersion: input.modelVersion ?? null,
+      result: parsed.result,
+      extracted: parsed.extracted ?? null,
+    });
+    await this.gradingRepo.save(grading);
+
+    await this.submissionVersionRepo.update(
+      { id: submissionVersion.id },
+      { status: SubmissionStatus.AI_FINISHED, aiStatus: AiStatus.SUCCESS, updatedAt: new Date() },
+    );
+
+    await this.jobRepo.update(
+      { id: job.id },
+      { status: AiJobStatus.SUCCEEDED, updatedAt: new Date() },
+    );
+  }
+
+  /**
+   * 被其他任务的多题合并批改认领的任务仍留在队列里，认领未过期时取出直接跳过。
+   */
+  private isClaimedElsewhere(job: AiJobEntity) {
+    if (job.status !== AiJobStatus.RUNNING || !job.lastStartedAt) {
+      return false;
+    }
+    const staleSeconds = this.readNumberEnv('AI_JOB_STALE_SECONDS', 300);
+    return Date.now() - new Date(job.lastStartedAt).getTime() < staleSeconds * 1000;
+  }
+
+  private multiQuestionOptionsKey(payload: TriggerAiGradingDto) {
+    return JSON.stringify([
+      payload.modelHint ?? null,
+      payload.options ?? null,
+      payload.uncertaintyPolicy ?? null,
+    ]);
+  }
+
+  /**
+   * AI_GRADING_MULTI_QUESTION=true 时，认领同一学生同一次提交、图片完全相同的其余
+   * AI_RUBRIC 排队任务，与当前任务合并为一次模型调用，图片与系统提示词只上传一次。
+   * 只在首次尝试时合并；重试与被退回的任务按单题批改。
+   */
+  private async claimSiblingJobs(input: {
+    job: AiJobEntity;
+    submissionVersion: SubmissionVersionEntity;
+    snapshot: Record<string, unknown>;
+    snapshotId: string;
+    question: SnapshotQuestion;
+    payload: TriggerAiGradingDto;
+  }): Promise<MultiQuestionMember[]> {
+    if (process.env.AI_GRADING_MULTI_QUESTION !== 'true') {
+      return [];
+    }
+    const { submissionVersion } = input;
+    const maxQuestions = Math.floor(this.readNumberEnv('AI_GRADING_MULTI_QUESTION_MAX', 8));
+    if (maxQuestions < 2 || !this.parseFileUrls(submissionVersion.fileUrl).length) {
+      return [];
+    }
+
+    const versions = await this.submissionVersionRepo.find({
+      where: {
+        id: Not(submissionVersion.id),
+        assignmentId: submissionVersion.assignmentId,
+        studentId: submissionVersion.studentId,
+        submitNo: submissionVersion.submitNo,
+        fileUrl: submissionVersion.fileUrl,
+      },
+    });
+    if (!versions.length) {
+      return [];
+    }
+    const candidates = await this.jobRepo.find({
+      where: {
+        submissionVersionId: In(versions.map((version) => version.id)),
+        assignmentSnapshotId: input.snapshotId,
+        status: AiJobStatus.QUEUED,
+        attempts: 0,
+        error: IsNull(),
+      },
+      order: { createdAt: 'ASC' },
+    });
+
+    const versionById = new Map(versions.map((version) => [version.id, version]));
+    const optionsKey = this.multiQuestionOptionsKey(input.payload);
+    const questionIndexes = new Set([input.question.questionIndex]);
+    const members: MultiQuestionMember[] = [];
+    for (const candidate of candidates) {
+      if (members.length >= maxQuestions - 1) {
+        break;
+      }
+      const version = versionById.get(candidate.submissionVersionId);
+      const question = version
+        ? this.findSnapshotQuestion(input.snapshot, version.questionId)
+        : null;
+      if (
+        !version ||
+        !question ||
+        questionIndexes.has(question.questionIndex) ||
+        this.resolveGradingMode(question) !== 'AI_RUBRIC'
+      ) {
+        continue;
+      }
+      const siblingPayload = await this.queue.getPayload(candidate.id);
+      if (!siblingPayload || this.multiQuestionOptionsKey(siblingPayload) !== optionsKey) {
+        continue;
+      }
+      const claimedAt = new Date();
+      const claimed = await this.jobRepo.update(
+        { id: candidate.id, status: AiJobStatus.QUEUED, attempts: 0, error: IsNull() },
+        {
+          status: AiJobStatus.RUNNING,
+          stage: AiJobStage.CALL_MODEL,
+          attempts: 1,
+          lastStartedAt: claimedAt,
+          error: null,
+          updatedAt: claimedAt,
+        },
+      );
+      if (!claimed.affected) {
+        continue;
+      }
+      await this.submissionVersionRepo.update(
+        { id: version.id },
+        { status: SubmissionStatus.AI_GRADING, aiStatus: AiStatus.RUNNING, updatedAt: new Date() },
+      );
+      questionIndexes.add(question.questionIndex);
+      members.push({
+        job: { ...candidate, status: AiJobStatus.RUNNING, attempts: 1 },
+        submissionVersion: version,
+        question,
+      });
+    }
+    if (members.length) {
+      this.logger.log(
+        `Job ${input.job.id} grading ${members.length + 1} questions in one model request.`,
+      );
+    }
+    return members;
+  }
+
+  private async runMultiQuestionModel(
+    payload: TriggerAiGradingDto,
+    members: MultiQuestionMember[],
+    snapshotId: string,
+    timeoutMs: number,
+    onProgress?: (event: GraderProgressEvent) => void,
+  ) {
+    const parts = members.map((member) =>
+      this.buildGraderPayload(
+        this.buildModelInput(payload, member.submissionVersion, snapshotId, member.question),
+      ),
+    );
+    const jsonPayload = {
+      assignmentSnapshotId: snapshotId,
+      questions: parts.map((part) => ({
+        submissionVersionId: part.submissionVersionId,
+        studentAnswerText: part.studentAnswerText,
+        studentAnswerPayload: part.studentAnswerPayload,
+        answerFormat: part.answerFormat,
+        question: part.question,
+      })),
+      options: parts[0].options,
+    };
+    try {
+      const result = await this.runGrader(
+        payload,
+        jsonPayload,
+        members[0].submissionVersion.fileUrl,
+        timeoutMs,
+        onProgress,
+      );
+      const parsed = this.tryParseJson(result.outputText.trim());
+      if (!parsed || !Array.isArray(parsed.results)) {
+        throw new Error('多题批改输出缺少 results 字段');
+      }
+      const outputs = new Map<string, MultiQuestionOutput>();
+      for (const output of parsed.results as MultiQuestionOutput[]) {
+        if (output?.submissionVersionId) {
+          outputs.set(output.submissionVersionId, output);
+        }
+      }
+      return { outputs, modelName: result.modelName, modelVersion: result.modelVersion };
+    } catch (error) {
+      const message = error instanceof Error ? error.message : String(error);
+      for (const member of members.slice(1)) {
+        await this.releaseSiblingJob(member.job, `多题合并批改失败，改为单题批改: ${message}`);
+      }
+      throw error;
+    }
+  }
+
+  /**
+   * 保存其余题目的结果；缺失或无法解析的题目退回队列单独批改。
+   * 返回当前任务自己的单题输出，交由 handleJob 按原流程处理。
+   */
+  private async settleSiblingJobs(input: {
+    siblings: MultiQuestionMember[];
+    outputs: Map<string, MultiQuestionOutput>;
+    submissionVersion: SubmissionVersionEntity;
+    payload: TriggerAiGradingDto;
+    snapshotId: string;
+    modelName: string;
+    modelVersion: string | null;
+  }): Promise<string> {
+    for (const sibling of input.siblings) {
+      const output = input.outputs.get(sibling.submissionVersion.id);
+      if (!output?.ok || !output.content) {
+        await this.releaseSiblingJob(
+          sibling.job,
+          `多题合并批改未返回有效结果，改为单题批改: ${output?.error ?? '缺少该题结果'}`,
+        );
+        continue;
+      }
+      try {
+        await this.saveGradingResult({
+          job: sibling.job,
+          submissionVersion: sibling.submissionVersion,
+          question: sibling.question,
+          payload: input.payload,
+          snapshotId: input.snapshotId,
+          parsed: this.parseModelOutput(output.content),
+          gradingMode: 'AI_RUBRIC',
+          modelName: input.modelName,
+          modelVersion: input.modelVersion,
+        });
+      } catch (error) {
+        const message = error instanceof Error ? error.message : String(error);
+        await this.releaseSiblingJob(sibling.job, `多题合并批改结果保存失败，改为单题批改: ${message}`);
+      }
+    }
+    const own = input.outputs.get(input.submissionVersion.id);
+    if (!own?.ok || !own.content) {
+      throw new Error(`多题合并批改未返回本题结果: ${own?.error ?? '缺少该题结果'}`);
     }
+    return own.content;
+  }
+
+  /**
+   * 退回被认领的兄弟任务：它没有单独运行过，认领时记的那次尝试一并退回；
+   * 退回原因写入 error，下次按单题批改。原队列条目若已被取出跳过就会丢失，
+   * 因此重新入队，但队列中只保留一份。
+   */
+  private async releaseSiblingJob(job: AiJobEntity, reason: string) {
+    await this.jobRepo.update(
+      { id: job.id },
+      {
+        status: AiJobStatus.QUEUED,
+        stage: AiJobStage.PREPARE_INPUT,
+        attempts: 0,
+        lastStartedAt: null,
+        error: reason,
+        updatedAt: new Date(),
+      },
+    );
+    await this.submissionVersionRepo.update(
+      { id: job.submissionVersionId },
+      { aiStatus: AiStatus.PENDING, updatedAt: new Date() },
+    );
+    await this.queue.requeueUnique(job.id);
+    this.logger.warn(`Job ${job.id} released from multi-question grading: ${reason}`);
+  }
+
+  /**
+   * 将 grader 的进度事件映射为任务阶段。更新按顺序串行写入，
+   * 调用方在进入后续阶段前需 await flush()，避免迟到的进度覆盖新阶段。
+   */
+  private trackModelProgress(jobId: string) {
+    let chain: Promise<unknown> = Promise.resolve();
+    const onProgress = (event: GraderProgressEvent) => {
+      if (event === 'cache-hit') {
+        this.logger.log(`Job ${jobId} reused a cached model output.`);
+      }
+      const stage =
+        event === 'first-token'
+          ? AiJobStage.STREAM_OUTPUT
+          : event === 'done'
+            ? AiJobStage.PARSE_OUTPUT
+            : AiJobStage.CALL_MODEL;
+      chain = chain
+        .then(() => this.jobRepo.update({ id: jobId }, { stage, updatedAt: new Date() }))
+        .catch((error) => {
+          const message = error instanceof Error ? error.message : String(error);
+          this.logger.warn(`Job ${jobId} stage update failed: ${message}`);
+        });
+    };
+    return { onProgress, flush: () => chain };
   }
 
   private resolveGradingMode(question: SnapshotQuestion): 'AUTO_RULE' | 'AI_RUBRIC' {
@@ -1213,86 +1665,96 @@ export class AiGradingWorkerService implements OnModuleInit, OnModuleDestroy {
     }
 
     try {
-      const effectiveLimit =
-        mode === 'image' ? Math.min(compareLimit, 40) : compareLimit;
-      const rows = await this.submissionVersionRepo.query(
-        `
-          SELECT DISTINCT ON (sv.student_id)
-            sv.id,
-            sv.student_id AS "studentId",
-            u.name AS "studentName",
-            u.account AS "studentAccount",
-            sv.content_text AS "contentText",
-            sv.answer_payload AS "answerPayload",
-            sv.file_url AS "fileUrl",
-            ag.extracted->>'studentMarkdown' AS "studentMarkdown"
-          FROM submission_versions sv
-          LEFT JOIN users u ON u.id = sv.student_id
-          LEFT JOIN LATERAL (
-            SELECT extracted
-            FROM ai_gradings
-            WHERE submission_version_id = sv.id
-            ORDER BY created_at DESC
-            LIMIT 1
-          ) ag ON true
-          WHERE sv.assignment_id = $1
-            AND sv.question_id = $2
-            AND sv.id <> $3
-            AND sv.status <> 'INVALID'
-          ORDER BY sv.student_id, sv.submit_no DESC, sv.submitted_at DESC
-          LIMIT ${effectiveLimit}
-        `,
-        [
-          input.submissionVersion.assignmentId,
-          input.submissionVersion.questionId,
-          input.submissionVersion.id,
-        ],
-      );
-
-      if (!Array.isArray(rows) || rows.length === 0) {
-        return;
-      }
-
       let comparedCount = 0;
       let matchedCount = 0;
       let topSimilarity = 0;
-      const suspects: PlagiarismSuspect[] = [];
+      let suspects: PlagiarismSuspect[] = [];
+      const indexed = await this.compareWithPlagiarismIndex({
+        submissionVersion: input.submissionVersion,
+        mode,
+        baseText,
+        threshold,
+        minTextLength,
+      });
+      if (indexed) {
+        ({ comparedCount, matchedCount, topSimilarity, suspects } = indexed);
+      } else {
+        const effectiveLimit =
+          mode === 'image' ? Math.min(compareLimit, 40) : compareLimit;
+        const rows = await this.submissionVersionRepo.query(
+          `
+            SELECT DISTINCT ON (sv.student_id)
+              sv.id,
+              sv.student_id AS "studentId",
+              u.name AS "studentName",
+              u.account AS "studentAccount",
+              sv.content_text AS "contentText",
+              sv.answer_payload AS "answerPayload",
+              sv.file_url AS "fileUrl",
+              ag.extracted->>'studentMarkdown' AS "studentMarkdown"
+            FROM submission_versions sv
+            LEFT JOIN users u ON u.id = sv.student_id
+            LEFT JOIN LATERAL (
+              SELECT extracted
+              FROM ai_gradings
+              WHERE submission_version_id = sv.id
+              ORDER BY created_at DESC
+              LIMIT 1
+            ) ag ON true
+            WHERE sv.assignment_id = $1
+              AND sv.question_id = $2
+              AND sv.id <> $3
+              AND sv.status <> 'INVALID'
+            ORDER BY sv.student_id, sv.submit_no DESC, sv.submitted_at DESC
+            LIMIT ${effectiveLimit}
+          `,
+          [
+            input.submissionVersion.assignmentId,
+            input.submissionVersion.questionId,
+            input.submissionVersion.id,
+          ],
+        );
 
-      for (const row of rows) {
-        let similarity = 0;
-        if (mode === 'text') {
-          const candidateRaw = this.extractComparableAnswerText(
-            row?.contentText,
-            row?.answerPayload,
-            row?.studentMarkdown,
-          );
-          const candidate = this.normalizeSimilarityText(candidateRaw);
-          if (candidate.length < minTextLength) {
-            continue;
+        if (!Array.isArray(rows) || rows.length === 0) {
+          return;
+        }
+
+        for (const row of rows) {
+          let similarity = 0;
+          if (mode === 'text') {
+            const candidateRaw = this.extractComparableAnswerText(
+              row?.contentText,
+              row?.answerPayload,
+              row?.studentMarkdown,
+            );
+            const candidate = this.normalizeSimilarityText(candidateRaw);
+            if (candidate.length < minTextLength) {
+              continue;
+            }
+            similarity = this.computeTextSimilarity(baseText, candidate);
+          } else {
+            const candidateHashes = await this.extractImageHashes(
+              String(row?.fileUrl ?? ''),
+            );
+            if (!candidateHashes.size || !baseImageHashes) {
+              continue;
+            }
+            similarity = this.computeSetSimilarity(baseImageHashes, candidateHashes);
           }
-          similarity = this.computeTextSimilarity(baseText, candidate);
-        } else {
-          const candidateHashes = await this.extractImageHashes(
-            String(row?.fileUrl ?? ''),
-          );
-          if (!candidateHashes.size || !baseImageHashes) {
-            continue;
+          comparedCount += 1;
+          if (similarity > topSimilarity) {
+            topSimilarity = similarity;
+          }
+          if (similarity >= threshold) {
+            matchedCount += 1;
+            suspects.push({
+              submissionVersionId: String(row?.id ?? ''),
+              studentId: String(row?.studentId ?? ''),
+              name: String(row?.studentName ?? '').trim(),
+              account: String(row?.studentAccount ?? '').trim(),
+              similarity: Number(similarity.toFixed(6)),
+            });
           }
-          similarity = this.computeSetSimilarity(baseImageHashes, candidateHashes);
-        }
-        comparedCount += 1;
-        if (similarity > topSimilarity) {
-          topSimilarity = similarity;
-        }
-        if (similarity >= threshold) {
-          matchedCount += 1;
-          suspects.push({
-            submissionVersionId: String(row?.id ?? ''),
-            studentId: String(row?.studentId ?? ''),
-            name: String(row?.studentName ?? '').trim(),
-            account: String(row?.studentAccount ?? '').trim(),
-            similarity: Number(similarity.toFixed(6)),
-          });
         }
       }
 
@@ -1358,6 +1820,241 @@ export class AiGradingWorkerService implements OnModuleInit, OnModuleDestroy {
     }
   }
 
+  /**
+   * 走 grader 进程中的抄袭比对索引（AI_PLAGIARISM_INDEX=true 且进程池启用）：
+   * 文本用 MinHash/LSH，图片用感知哈希（pHash/dHash）近重复检索，只对候选计算相似度，
+   * 可覆盖整个班级而不受 AI_PLAGIARISM_COMPARE_LIMIT 限制，同学的图片也无需每次重新下载。
+   * 索引为空时先用同题全部提交回填；索引不可用时返回 null，回退到逐份比对。
+   */
+  private async compareWithPlagiarismIndex(input: {
+    submissionVersion: SubmissionVersionEntity;
+    mode: 'text' | 'image';
+    baseText: string;
+    threshold: number;
+    minTextLength: number;
+  }) {
+    if (process.env.AI_PLAGIARISM_INDEX !== 'true' || !this.graderPool.isEnabled()) {
+      return null;
+    }
+    const submissionVersion = input.submissionVersion;
+    const timeoutMs = this.readNumberEnv('AI_PLAGIARISM_INDEX_TIMEOUT_SECONDS', 30) * 1000;
+    const tempDir =
+      input.mode === 'image'
+        ? await fs.mkdtemp(path.join(os.tmpdir(), 'ai-plag-index-'))
+        : null;
+    try {
+      const entry: Record<string, unknown> = {
+        key: submissionVersion.studentId,
+        submissionVersionId: submissionVersion.id,
+      };
+      if (tempDir) {
+        entry.images = await this.materializeImages(submissionVersion.fileUrl, tempDir);
+        if (!(entry.images as string[]).length) {
+          return null;
+        }
+      } else {
+        entry.text = input.baseText;
+      }
+      const query = {
+        op: input.mode === 'image' ? ('image-hash-query' as const) : ('similarity-query' as const),
+        assignmentId: submissionVersion.assignmentId,
+        questionId: submissionVersion.questionId,
+        entry,
+        threshold: input.threshold,
+        limit: 20,
+      };
+      let result = await this.graderPool.call<PlagiarismIndexResult>(query, timeoutMs);
+      if (!result.peers) {
+        const added =
+          input.mode === 'image'
+            ? await this.backfillImageIndex(submissionVersion, timeoutMs)
+            : await this.backfillPlagiarismIndex(
+                submissionVersion,
+                input.minTextLength,
+                timeoutMs,
+              );
+        if (added > 0) {
+          result = await this.graderPool.call<PlagiarismIndexResult>(query, timeoutMs);
+        }
+      }
+
+      const matchIds = result.matches
+        .map((item) => item.submissionVersionId)
+        .filter(Boolean);
+      const rows: Array<Record<string, unknown>> = matchIds.length
+        ? await this.submissionVersionRepo.query(
+            `
+              SELECT sv.id, sv.student_id AS "studentId",
+                u.name AS "studentName", u.account AS "studentAccount"
+              FROM submission_versions sv
+              LEFT JOIN users u ON u.id = sv.student_id
+              WHERE sv.id = ANY($1)
+                AND sv.status <> 'INVALID'
+            `,
+            [matchIds],
+          )
+        : [];
+      const rowById = new Map(rows.map((row) => [String(row.id), row]));
+      const suspects: PlagiarismSuspect[] = [];
+      for (const match of result.matches) {
+        const row = rowById.get(match.submissionVersionId);
+        if (!row) {
+          // 已作废或被更新提交替换的旧条目
+          continue;
+        }
+        suspects.push({
+          submissionVersionId: match.submissionVersionId,
+          studentId: String(row.studentId ?? ''),
+          name: String(row.studentName ?? '').trim(),
+          account: String(row.studentAccount ?? '').trim(),
+          similarity: Number(match.similarity.toFixed(6)),
+        });
+      }
+      return {
+        comparedCount: result.peers,
+        matchedCount: suspects.length,
+        topSimilarity: Number(result.topSimilarity) || 0,
+        suspects,
+      };
+    } catch (error) {
+      const message = error instanceof Error ? error.message : String(error);
+      this.logger.warn(`Plagiarism index unavailable, falling back to pairwise check: ${message}`);
+      return null;
+    } finally {
+      if (tempDir) {
+        await fs.rm(tempDir, { recursive: true, force: true }).catch(() => undefined);
+      }
+    }
+  }
+
+  /** 图片索引为空时下载同题其他学生的最新提交并计算感知哈希，之后不再重复下载 */
+  private async backfillImageIndex(
+    submissionVersion: SubmissionVersionEntity,
+    timeoutMs: number,
+  ) {
+    const rows = await this.submissionVersionRepo.query(
+      `
+        SELECT DISTINCT ON (sv.student_id)
+          sv.id,
+          sv.student_id AS "studentId",
+          sv.file_url AS "fileUrl"
+        FROM submission_versions sv
+        WHERE sv.assignment_id = $1
+          AND sv.question_id = $2
+          AND sv.student_id <> $3
+          AND sv.status <> 'INVALID'
+          AND sv.file_url IS NOT NULL
+        ORDER BY sv.student_id, sv.submit_no DESC, sv.submitted_at DESC
+      `,
+      [
+        submissionVersion.assignmentId,
+        submissionVersion.questionId,
+        submissionVersion.studentId,
+      ],
+    );
+    const list: Array<Record<string, unknown>> = Array.isArray(rows) ? rows : [];
+    const chunkSize = 20;
+    let added = 0;
+    for (let offset = 0; offset < list.length; offset += chunkSize) {
+      const tempDir = await fs.mkdtemp(path.join(os.tmpdir(), 'ai-plag-backfill-'));
+      try {
+        const entries: Array<Record<string, unknown>> = [];
+        for (const row of list.slice(offset, offset + chunkSize)) {
+          const rowDir = path.join(tempDir, String(row.id));
+          await fs.mkdir(rowDir, { recursive: true });
+          const images = await this.materializeImages(String(row.fileUrl ?? ''), rowDir);
+          if (images.length) {
+            entries.push({
+              key: String(row.studentId ?? ''),
+              submissionVersionId: String(row.id ?? ''),
+              images,
+            });
+          }
+        }
+        if (entries.length) {
+          const result = await this.graderPool.call<{ added: number }>(
+            {
+              op: 'image-hash-add',
+              assignmentId: submissionVersion.assignmentId,
+              questionId: submissionVersion.questionId,
+              entries,
+            },
+            timeoutMs,
+          );
+          added += Number(result.added) || 0;
+        }
+      } finally {
+        await fs.rm(tempDir, { recursive: true, force: true }).catch(() => undefined);
+      }
+    }
+    return added;
+  }
+
+  private async backfillPlagiarismIndex(
+    submissionVersion: SubmissionVersionEntity,
+    minTextLength: number,
+    timeoutMs: number,
+  ) {
+    const rows = await this.submissionVersionRepo.query(
+      `
+        SELECT DISTINCT ON (sv.student_id)
+          sv.id,
+          sv.student_id AS "studentId",
+          sv.content_text AS "contentText",
+          sv.answer_payload AS "answerPayload",
+          ag.extracted->>'studentMarkdown' AS "studentMarkdown"
+        FROM submission_versions sv
+        LEFT JOIN LATERAL (
+          SELECT extracted
+          FROM ai_gradings
+          WHERE submission_version_id = sv.id
+          ORDER BY created_at DESC
+          LIMIT 1
+        ) ag ON true
+        WHERE sv.assignment_id = $1
+          AND sv.question_id = $2
+          AND sv.student_id <> $3
+          AND sv.status <> 'INVALID'
+        ORDER BY sv.student_id, sv.submit_no DESC, sv.submitted_at DESC
+      `,
+      [
+        submissionVersion.assignmentId,
+        submissionVersion.questionId,
+        submissionVersion.studentId,
+      ],
+    );
+    const entries: Array<{ key: string; submissionVersionId: string; text: string }> = [];
+    for (const row of Array.isArray(rows) ? rows : []) {
+      const text = this.normalizeSimilarityText(
+        this.extractComparableAnswerText(
+          row?.contentText,
+          row?.answerPayload,
+          row?.studentMarkdown,
+        ),
+      );
+      if (text.length >= minTextLength) {
+        entries.push({
+          key: String(row?.studentId ?? ''),
+          submissionVersionId: String(row?.id ?? ''),
+          text,
+        });
+      }
+    }
+    const chunkSize = 200;
+    for (let offset = 0; offset < entries.length; offset += chunkSize) {
+      await this.graderPool.call(
+        {
+          op: 'similarity-add',
+          assignmentId: submissionVersion.assignmentId,
+          questionId: submissionVersion.questionId,
+          entries: entries.slice(offset, offset + chunkSize),
+        },
+        timeoutMs,
+      );
+    }
+    return entries.length;
+  }
+
   private setPlagiarismCheckMeta(
     result: Record<string, unknown>,
     input: {
@@ -1769,25 +2466,16 @@ export class AiGradingWorkerService implements OnModuleInit, OnModuleDestroy {
   }
 
   private async extractImageHashes(fileUrlValue: string): Promise<Set<string>> {
-    const refs = this.parseFileUrls(fileUrlValue).slice(0, 4);
-    if (!refs.length) {
+    if (!this.parseFileUrls(fileUrlValue).length) {
       return new Set();
     }
     const tempDir = await fs.mkdtemp(path.join(os.tmpdir(), 'ai-plag-img-'));
     const hashes = new Set<string>();
     try {
-      for (const ref of refs) {
+      for (const filePath of await this.materializeImages(fileUrlValue, tempDir)) {
         try {
-          const materialized = await this.storageService.materializeForProcessing(
-            ref,
-            tempDir,
-          );
-          if (!materialized) {
-            continue;
-          }
-          const buffer = await fs.readFile(materialized.filePath);
-          const digest = createHash('sha256').update(buffer).digest('hex');
-          hashes.add(digest);
+          const buffer = await fs.readFile(filePath);
+          hashes.add(createHash('sha256').update(buffer).digest('hex'));
         } catch {
           continue;
         }
@@ -1798,6 +2486,25 @@ export class AiGradingWorkerService implements OnModuleInit, OnModuleDestroy {
     return hashes;
   }
 
+  /** 把提交中的前 4 张图片落地到 tempDir，跳过无法读取的引用 */
+  private async materializeImages(fileUrlValue: string, tempDir: string) {
+    const paths: string[] = [];
+    for (const ref of this.parseFileUrls(fileUrlValue).slice(0, 4)) {
+      try {
+        const materialized = await this.storageService.materializeForProcessing(
+          ref,
+          tempDir,
+        );
+        if (materialized) {
+          paths.push(materialized.filePath);
+        }
+      } catch {
+        continue;
+      }
+    }
+    return paths;
+  }
+
   private async collectImagePaths(value: string, tempDir: string): Promise<string[]> {
     const maxBytes = this.readNumberEnv('AI_IMAGE_MAX_BYTES', 9 * 1024 * 1024);
     const candidates = this.parseFileUrls(value);
@@ -10,6 +10,7 @@ export enum AiJobStatus {
 export enum AiJobStage {
   PREPARE_INPUT = 'PREPARE_INPUT',
   CALL_MODEL = 'CALL_MODEL',
+  STREAM_OUTPUT = 'STREAM_OUTPUT',
   PARSE_OUTPUT = 'PARSE_OUTPUT',
   SAVE_RESULT = 'SAVE_RESULT',
 }
@@ -8,6 +8,7 @@ export enum AiJobStatus {
 export enum AiJobStage {
   PREPARE_INPUT = 'PREPARE_INPUT', // 准备输入数据
   CALL_MODEL = 'CALL_MODEL',       // 调用多模态模型
+  STREAM_OUTPUT = 'STREAM_OUTPUT', // 模型已开始流式输出
   PARSE_OUTPUT = 'PARSE_OUTPUT',   // 解析模型结果
   SAVE_RESULT = 'SAVE_RESULT',     // 保存结果
 }
@@ -8,6 +8,7 @@ import { AssignmentSnapshotEntity } from './entities/assignment-snapshot.entity'
 import { AssignmentQuestionEntity } from './entities/assignment-question.entity';
 import { CourseEntity } from './entities/course.entity';
 import { AuthModule } from '../auth/auth.module';
+import { AiGradingPrefixWarmupService } from '../ai-grading/ai-grading.prefix-warmup';
 
 // 负责人: 邓翀宸
 // 功能: 教师发布作业、后端框架搭建
@@ -24,7 +25,7 @@ import { AuthModule } from '../auth/auth.module';
     ]),
   ],
   controllers: [AssignmentController, AssignmentSnapshotController],
-  providers: [AssignmentService],
+  providers: [AssignmentService, AiGradingPrefixWarmupService],
   exports: [AssignmentService],
 })
 export class AssignmentModule {}
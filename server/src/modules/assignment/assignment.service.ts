@@ -24,6 +24,7 @@ import {
 import { CourseEntity } from './entities/course.entity';
 import { UserRole } from '../auth/entities/user.entity';
 import { StorageService } from '../../common/storage/storage.service';
+import { AiGradingPrefixWarmupService } from '../ai-grading/ai-grading.prefix-warmup';
 
 @Injectable()
 export class AssignmentService {
@@ -38,6 +39,7 @@ export class AssignmentService {
     @InjectRepository(CourseEntity)
     private readonly courseRepo: Repository<CourseEntity>,
     private readonly storageService: StorageService,
+    private readonly prefixWarmup: AiGradingPrefixWarmupService,
   ) {}
 
   async createAssignment(
@@ -400,6 +402,11 @@ export class AssignmentService {
     assignment.status = AssignmentStatus.OPEN;
     assignment.updatedAt = new Date();
     const savedAssignment = await this.assignmentRepo.save(assignment);
+    this.prefixWarmup.warmSnapshotInBackground(
+      savedAssignment,
+      savedSnapshot.id,
+      snapshotPayload,
+    );
 
     return {
       message: 'Assignment published successfully',